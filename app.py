@@ -1,14 +1,37 @@
+import asyncio
 import os
-from flask import (Flask, flash, render_template, request, redirect, url_for,
-                   session)
+import json
+import mimetypes
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from flask import (Flask, abort, flash, jsonify, render_template, request,
+                   redirect, send_file, url_for, session)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, insert, select, Table
+from markupsafe import escape
+from sqlalchemy import (Column, delete, Index, insert, literal, select,
+                        Table, tuple_, type_coerce, update)
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import relationship, registry
 from sqlalchemy.sql import func
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 from dotenv import load_dotenv
-from open_ai import ai_create_podcast
-from gemini import gemini_create_podcast
+from providers import (is_male_voice, podcast_creator, preload,
+                       PRELOAD_PROVIDERS)
+from gateway import (breakers, choose_provider, FALLBACK_PROVIDER,
+                     ProviderUnavailable)
+from storage import (AUDIO_FOLDER, AUDIO_QUOTA_BYTES, AUDIO_SWEEP_SECONDS,
+                     file_digest, is_stored_name, remove_file,
+                     stale_staging_files, STAGING_FOLDER, store_file,
+                     stored_files, stored_name, ORPHAN_GRACE_SECONDS)
+from metrics import render as render_metrics, track_generation
+from jobs import executor, GENERATION_ENGINE, pid_alive, QueueFullError
+from passwords import hasher, HASHER_BUSY_ERRORS, needs_rehash
+from tavili import news_cache
+from scripts import script_cache
+from cache import clip_cache, normalize_topic
 
 load_dotenv()
 app = Flask(__name__)
@@ -33,6 +56,50 @@ default_options = {
         "host1_mood": "analytical but witty",
         "host2_mood": "lighthearted and curious"
         }
+# Voice of each host gender when a Podcast falls back to another provider
+FALLBACK_VOICES = {"OpenAI": {"male": "ash", "female": "shimmer"},
+                   "Gemini": {"male": "Puck", "female": "Kore"}}
+# Word overlap (0 to 1) above which a topic counts as an existing Podcast
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.6"))
+# Number of Podcasts per page of the user library
+LIBRARY_PAGE_SIZE = int(os.getenv("LIBRARY_PAGE_SIZE", "50"))
+# Number of the latest user Podcasts listed in the page footer
+RECENT_PODCASTS = 3
+# A generation that stops renewing its lease for this long is taken over
+GENERATION_LEASE_SECONDS = int(os.getenv("GENERATION_LEASE_SECONDS", "300"))
+# SQLite FTS5 indexes: the indexed table, its columns, and the feature that
+# is disabled when SQLite is built without FTS5
+SEARCH_INDEXES = {
+    'podcast_fts': ('podcast', ('normalized_title',),
+                    "Near-duplicate topic matching"),
+    'transcript_fts': ('transcript_turn', ('speaker', 'text'),
+                       "Transcript search"),
+}
+# Versioned audio URLs never change content, so browsers keep them for a year
+AUDIO_MAX_AGE = 365 * 24 * 3600
+# When set, e.g. to /protected-audio/, the audio transfer is handed to the
+# reverse proxy (nginx X-Accel-Redirect) and Flask only sends the headers
+AUDIO_ACCEL_REDIRECT = os.getenv("AUDIO_ACCEL_REDIRECT", "")
+# A play is recorded at most this often per Podcast, for the quota eviction
+PLAYED_RESOLUTION = timedelta(hours=1)
+# How often a live stream checks for new audio of a Podcast being generated
+LIVE_POLL_SECONDS = 0.5
+LIVE_CHUNK_SIZE = 64 * 1024
+# Longest time a request waits for a generation job before it answers
+JOB_WAIT_SECONDS = float(os.getenv("JOB_WAIT_SECONDS", "25"))
+# Futures of the generation jobs running in this process, by job id
+running_jobs = {}
+# The process that ran start_app(): a forked worker runs it again
+_started_pid = None
+_start_lock = threading.Lock()
+# Seconds after which a login refused under load may be tried again
+LOGIN_RETRY_AFTER = 5
+# Number of transcript turns returned by a search
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "20"))
+# The provider modules are otherwise loaded by the first Podcast of each
+# provider, which then waits for the import
+if PRELOAD_PROVIDERS:
+    preload()
 
 # Association Table
 podcasts_per_user = Table(
@@ -40,7 +107,12 @@ podcasts_per_user = Table(
     Column('user_id', db.Integer, db.ForeignKey('user.id'),
            primary_key=True),
     Column('podcast_id', db.Integer, db.ForeignKey('podcast.id'),
-           primary_key=True)
+           primary_key=True),
+    # When the Podcast was added to the user library
+    Column('created_at', db.DateTime, default=func.now()),
+    # Serves the user library pages in order, without sorting
+    Index('ix_podcasts_per_user_user_id', 'user_id', 'created_at',
+          'podcast_id')
 )
 
 # SQLAlchemy Models
@@ -62,8 +134,29 @@ class Podcast(db.Model):
     __tablename__ = 'podcast'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80), unique=True, nullable=False)
-    podcast_url = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=func.now(),
+    # The title as normalize_topic() reduces it, for the "already exists" check
+    normalized_title = db.Column(
+        db.String(200), index=True,
+        default=lambda ctx: normalize_topic(
+            ctx.get_current_parameters()['title']))
+    podcast_url = db.Column(db.String(200), index=True, nullable=False)
+    # SHA-256 of the audio file, the ETag and version of its URL
+    content_hash = db.Column(db.String(64))
+    # What the generation cost: AI provider tokens, size of the audio file
+    # and seconds
+    prompt_tokens = db.Column(db.Integer)
+    completion_tokens = db.Column(db.Integer)
+    audio_bytes = db.Column(db.Integer)
+    generation_seconds = db.Column(db.Float)
+    # SHA-256 of the news the script is based on, so that the Podcast can be
+    # voiced again with its cached script, without searching the news again
+    news_digest = db.Column(db.String(64))
+    # When the Podcast was last played, the least recently played ones are
+    # evicted first when the audio files exceed AUDIO_QUOTA_BYTES
+    last_played_at = db.Column(db.DateTime)
+    # The audio file was evicted, it is generated again when played
+    needs_regeneration = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=func.now(), index=True,
                            nullable=False)  # Date stamp column
     updated_at = Column(db.DateTime, default=func.now(), onupdate=func.now(),
                         nullable=False)  # Auto-updating timestamp
@@ -72,11 +165,862 @@ class Podcast(db.Model):
                          back_populates="podcasts")
 
 
+class TranscriptTurn(db.Model):
+    """
+    One dialogue turn of a Podcast transcript, with where it starts in the
+    audio, so that a search result can be played from that turn
+    """
+    __tablename__ = 'transcript_turn'
+    id = db.Column(db.Integer, primary_key=True)
+    podcast_id = db.Column(db.Integer, db.ForeignKey('podcast.id'),
+                           nullable=False)
+    position = db.Column(db.Integer, nullable=False)  # order in the dialogue
+    speaker = db.Column(db.String(80), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    start_ms = db.Column(db.Integer, nullable=False)
+    __table_args__ = (Index('ix_transcript_turn_podcast_id', 'podcast_id',
+                            'position'),)
+
+
+class GenerationJob(db.Model):
+    __tablename__ = 'generation_job'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    topic = db.Column(db.String(80), nullable=False)
+    options = db.Column(db.Text, nullable=False)  # Podcast settings as JSON
+    # queued -> running -> done or failed
+    status = db.Column(db.String(20), default='queued', nullable=False)
+    stage = db.Column(db.String(20), default='queued', nullable=False)
+    progress = db.Column(db.Integer, default=0, nullable=False)
+    worker_pid = db.Column(db.Integer)  # process that owns the job
+    # Audio file of the Podcast while it is generated, for live playback
+    live_file = db.Column(db.String(200))
+    podcast_id = db.Column(db.Integer, db.ForeignKey('podcast.id'))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=func.now(),
+                           nullable=False)  # Date stamp column
+    updated_at = Column(db.DateTime, default=func.now(), onupdate=func.now(),
+                        nullable=False)  # Auto-updating timestamp
+
+
+# Users waiting for a generation job started by somebody else
+job_subscribers = Table(
+    'job_subscribers', db.Model.metadata,
+    Column('job_id', db.String(32), db.ForeignKey('generation_job.id'),
+           primary_key=True),
+    Column('user_id', db.Integer, db.ForeignKey('user.id'),
+           primary_key=True)
+)
+
+
+class GenerationLease(db.Model):
+    """
+    One row per topic being generated, so that concurrent requests for the
+    same topic, from any worker process, join the running job. A topic
+    generated by pregenerate.py is leased with an id that has no job
+    """
+    __tablename__ = 'generation_lease'
+    topic_key = db.Column(db.String(200), primary_key=True)  # normalized
+    job_id = db.Column(db.String(32), db.ForeignKey('generation_job.id'),
+                       nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)  # UTC
+
+
+def utc_now():
+    """
+    :return: the current UTC time, naive like the SQLite timestamps
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def init_db():
     """
     Initializes the database and creates all necessary tables.
     """
     db.create_all()
+    migrate_db()
+
+
+def migrate_db():
+    """
+    Brings a database created by an older version of the app up to date:
+    create_all() only creates missing tables, so the columns and indexes
+    added later to existing tables are created here
+    """
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.Model.metadata.sorted_tables:
+            existing = {column['name']
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(
+                        dialect=db.engine.dialect)
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN "
+                        f"{column.name} {column_type}")
+        # Libraries of older versions: the Podcast creation time is the best
+        # guess of when it was added
+        conn.execute(update(podcasts_per_user).where(
+            podcasts_per_user.c.created_at.is_(None)).values(
+            created_at=select(Podcast.created_at).where(
+                Podcast.id == podcasts_per_user.c.podcast_id
+            ).scalar_subquery()))
+        # Podcasts stored before the normalized title existed
+        rows = conn.execute(select(Podcast.id, Podcast.title).where(
+            Podcast.normalized_title.is_(None))).all()
+        for podcast_id, title in rows:
+            conn.execute(update(Podcast).where(
+                Podcast.id == podcast_id).values(
+                normalized_title=normalize_topic(title)))
+    for table in db.Model.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    create_search_indexes()
+
+
+def create_search_indexes():
+    """
+    Creates the SQLite FTS5 indexes of SEARCH_INDEXES, kept up to date by
+    triggers, and fills them with the existing rows
+    """
+    existing = set(db.inspect(db.engine).get_table_names())
+    for index, (table, columns, feature) in SEARCH_INDEXES.items():
+        if index in existing:
+            continue
+        names = ", ".join(columns)
+        new = ", ".join(f"new.{column}" for column in columns)
+        old = ", ".join(f"old.{column}" for column in columns)
+        try:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(
+                    f"CREATE VIRTUAL TABLE {index} USING fts5("
+                    f"{names}, content='{table}', content_rowid='id')")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER {index}_insert AFTER INSERT ON {table} "
+                    f"BEGIN INSERT INTO {index}(rowid, {names}) "
+                    f"VALUES (new.id, {new}); END")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER {index}_delete AFTER DELETE ON {table} "
+                    f"BEGIN INSERT INTO {index}({index}, rowid, {names}) "
+                    f"VALUES ('delete', old.id, {old}); END")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER {index}_update AFTER UPDATE OF {names} "
+                    f"ON {table} "
+                    f"BEGIN INSERT INTO {index}({index}, rowid, {names}) "
+                    f"VALUES ('delete', old.id, {old}); "
+                    f"INSERT INTO {index}(rowid, {names}) "
+                    f"VALUES (new.id, {new}); END")
+                conn.exec_driver_sql(
+                    f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+        except OperationalError as e:   # SQLite built without FTS5
+            print(f"{feature} is disabled: {e}")
+
+
+def find_similar_podcast(topic):
+    """
+    Looks for an existing Podcast on nearly the same topic: the FTS5 index
+    finds the titles sharing words with the topic, and the one with the
+    largest word overlap is returned if it reaches NEAR_DUPLICATE_THRESHOLD
+    :param topic: Podcast topic
+    :return: the similar Podcast, or None
+    """
+    words = set(normalize_topic(topic).split())
+    if not words:
+        return None
+    query = " OR ".join('"{}"'.format(word) for word in sorted(words))
+    try:
+        candidates = db.session.execute(db.text(
+            "SELECT rowid FROM podcast_fts WHERE podcast_fts MATCH :query "
+            "ORDER BY rank LIMIT 20"), {"query": query}).scalars().all()
+    except OperationalError:   # no FTS5 index
+        return None
+    best, best_score = None, 0.0
+    for podcast in Podcast.query.filter(Podcast.id.in_(candidates)):
+        title_words = set(podcast.normalized_title.split())
+        score = len(words & title_words) / len(words | title_words)
+        if score > best_score:
+            best, best_score = podcast, score
+    return best if best_score >= NEAR_DUPLICATE_THRESHOLD else None
+
+
+def user_library(user_id, cursor=None, limit=LIBRARY_PAGE_SIZE):
+    """
+    Loads one page of the user Podcasts, the most recently added first,
+    with one joined query. Pages are found by keyset on the library index,
+    so every page costs the same no matter how large the library is
+    :param user_id: the id of the user
+    :param cursor: the cursor returned with the previous page, if any
+    :param limit: the number of Podcasts per page
+    :return: list of Podcasts, and the cursor of the next page or None
+    """
+    added_at = podcasts_per_user.c.created_at
+    # The cursor compares the stored timestamp text, as SQLite does
+    added_at_text = type_coerce(added_at, db.String)
+    stmt = select(Podcast, added_at_text.label('added_at')).join(
+        podcasts_per_user, podcasts_per_user.c.podcast_id == Podcast.id
+    ).where(podcasts_per_user.c.user_id == user_id)
+    if cursor:
+        created_at, podcast_id = cursor.rsplit('_', 1)
+        stmt = stmt.where(tuple_(added_at_text,
+                                 podcasts_per_user.c.podcast_id) <
+                          tuple_(literal(created_at, db.String),
+                                 literal(int(podcast_id))))
+    stmt = stmt.order_by(added_at.desc(),
+                         podcasts_per_user.c.podcast_id.desc()
+                         ).limit(limit + 1)
+    rows = db.session.execute(stmt).all()
+    podcasts = [row[0] for row in rows[:limit]]
+    if len(rows) <= limit:
+        return podcasts, None
+    last, last_added_at = rows[limit - 1]
+    return podcasts, f"{last_added_at}_{last.id}"
+
+
+def provider_options(options, provider):
+    """
+    Adapts the Podcast settings to another AI provider, giving each host
+    a voice of the same gender
+    :param options: Dictionary with the Podcast settings
+    :param provider: the AI provider that will create the Podcast
+    :return: Dictionary with the settings for the provider
+    """
+    if options["ai_model"] == provider:
+        return options
+    print(f"{options['ai_model']} is unavailable, the Podcast is created "
+          f"with {provider}")
+    adapted = dict(options, ai_model=provider)
+    for host in ("host1_voice", "host2_voice"):
+        male = is_male_voice(options["ai_model"], options[host])
+        adapted[host] = FALLBACK_VOICES[provider][
+            "male" if male else "female"]
+    return adapted
+
+
+def generate_podcast_audio(topic, options, progress=None):
+    """
+    Generates the Podcast audio file with the AI model of the settings,
+    loading its provider module on first use
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :param progress: optional callback(stage, percent, **details)
+    :return: the Podcast audio file name
+    """
+    return podcast_creator(options["ai_model"])(topic, options, progress)
+
+
+async def generate_podcast_audio_async(topic, options, progress=None):
+    """
+    Like generate_podcast_audio(), with the async provider clients
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :param progress: optional callback(stage, percent, **details)
+    :return: the Podcast audio file name
+    """
+    create = podcast_creator(options["ai_model"], asynchronous=True)
+    return await create(topic, options, progress)
+
+
+def fallback_for(provider, error):
+    """
+    Picks the provider that creates a Podcast when its first provider went
+    down during the Podcast: its failures opened the circuit breaker, or
+    the breaker refused a call
+    :param provider: the provider that failed
+    :param error: the exception raised by the provider
+    :return: the other provider, or None if the error must be raised
+    """
+    fallback = FALLBACK_PROVIDER[provider]
+    if not (isinstance(error, ProviderUnavailable)
+            or breakers[provider].is_open()) or breakers[fallback].is_open():
+        return None
+    return fallback
+
+
+def store_podcast_audio(generation, podcast_url):
+    """
+    Moves a generated audio file to the content addressed store
+    :param generation: the generation metrics of the Podcast
+    :param podcast_url: the generated audio file name
+    :return: the stored file name and its content hash
+    """
+    path = os.path.join(AUDIO_FOLDER, podcast_url)
+    generation.audio_bytes = os.path.getsize(path)
+    return store_file(path)
+
+
+def save_podcast(topic, generation, podcast_url, content_hash,
+                 podcast_id=None):
+    """
+    Adds a generated Podcast to the database, or replaces the audio of the
+    Podcast that was generated again: voiced again, or of the same topic
+    and whose audio file was evicted
+    :param topic: Podcast topic
+    :param generation: the generation metrics of the Podcast
+    :param podcast_url: the stored audio file name
+    :param content_hash: the hash of the audio file
+    :param podcast_id: the id of the Podcast generated again, if any
+    :return: the new Podcast
+    """
+    values = dict(podcast_url=podcast_url, content_hash=content_hash,
+                  prompt_tokens=generation.prompt_tokens,
+                  completion_tokens=generation.completion_tokens,
+                  audio_bytes=generation.audio_bytes,
+                  generation_seconds=round(generation.seconds, 1),
+                  news_digest=generation.news_digest,
+                  needs_regeneration=False)
+    previous = db.session.get(Podcast, podcast_id) if podcast_id else None
+    if previous is None:
+        previous = Podcast.query.filter_by(
+            normalized_title=normalize_topic(topic),
+            needs_regeneration=True).first()
+    try:
+        if previous:   # generated again, e.g. after its file was evicted
+            for name, value in values.items():
+                setattr(previous, name, value)
+            new_podcast = previous
+        else:
+            new_podcast = Podcast(title=topic, **values)
+            db.session.add(new_podcast)
+        db.session.flush()   # the id of a new Podcast
+        save_transcript(new_podcast.id, generation.transcript)
+        # the Podcasts with the same content have their file back too
+        db.session.execute(update(Podcast).where(
+            Podcast.podcast_url == podcast_url).values(
+            needs_regeneration=False))
+        db.session.commit()
+    except IntegrityError:   # created meanwhile by a stale job
+        db.session.rollback()
+        new_podcast = Podcast.query.filter_by(title=topic).one()
+    enforce_audio_quota(keep=new_podcast.podcast_url)
+    return new_podcast
+
+
+def save_transcript(podcast_id, transcript):
+    """
+    Replaces the transcript of a Podcast, in the current transaction
+    :param podcast_id: the id of the Podcast
+    :param transcript: list of tuples of speaker, text and start in ms, in
+    dialogue order
+    """
+    db.session.execute(delete(TranscriptTurn).where(
+        TranscriptTurn.podcast_id == podcast_id))
+    if transcript:
+        db.session.execute(insert(TranscriptTurn), [
+            dict(podcast_id=podcast_id, position=position, speaker=speaker,
+                 text=text, start_ms=start_ms)
+            for position, (speaker, text, start_ms) in enumerate(transcript)])
+
+
+def search_transcripts(text, limit=SEARCH_RESULTS_LIMIT):
+    """
+    Finds the transcript turns of all the Podcasts that contain all the
+    words of the text, the best matches first
+    :param text: the words to look for
+    :param limit: the number of turns to return
+    :return: list of rows with the turn, its Podcast title and a snippet of
+    its text where \x02 and \x03 enclose the matching words
+    """
+    words = normalize_topic(text).split()
+    if not words:
+        return []
+    query = " ".join('"{}"'.format(word) for word in words)
+    return db.session.execute(db.text(
+        "SELECT transcript_turn.podcast_id, podcast.title, "
+        "transcript_turn.position, transcript_turn.speaker, "
+        "transcript_turn.start_ms, snippet(transcript_fts, 1, char(2), "
+        "char(3), '...', 16) AS snippet "
+        "FROM transcript_fts "
+        "JOIN transcript_turn ON transcript_turn.id = transcript_fts.rowid "
+        "JOIN podcast ON podcast.id = transcript_turn.podcast_id "
+        "WHERE transcript_fts MATCH :query ORDER BY rank LIMIT :limit"),
+        {"query": query, "limit": limit}).all()
+
+
+def create_podcast(topic, options, progress=None):
+    """
+    Generates the Podcast audio with the AI model of the settings, or with
+    the other one if that provider is unavailable, and adds the Podcast to
+    the database
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :param progress: optional callback(stage, percent, **details)
+    :return: the new Podcast
+    """
+    with track_generation(topic) as generation:
+        provider = generation.provider = choose_provider(options["ai_model"])
+        try:
+            podcast_url = generate_podcast_audio(
+                topic, provider_options(options, provider), progress)
+        except Exception as e:
+            provider = fallback_for(provider, e)
+            if not provider:
+                raise
+            generation.provider = provider
+            generation.restart()   # its transcript starts at 0 again
+            podcast_url = generate_podcast_audio(
+                topic, provider_options(options, provider), progress)
+        podcast_url, content_hash = store_podcast_audio(generation,
+                                                        podcast_url)
+    return save_podcast(topic, generation, podcast_url, content_hash,
+                        options.get("podcast_id"))
+
+
+async def create_podcast_async(topic, options, progress=None):
+    """
+    Like create_podcast(), for the asyncio generation engine. The file
+    store and the database are used in worker threads, so that the event
+    loop keeps serving the other Podcasts
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :param progress: optional callback(stage, percent, **details)
+    :return: the new Podcast
+    """
+    with track_generation(topic) as generation:
+        provider = generation.provider = choose_provider(options["ai_model"])
+        try:
+            podcast_url = await generate_podcast_audio_async(
+                topic, provider_options(options, provider), progress)
+        except Exception as e:
+            provider = fallback_for(provider, e)
+            if not provider:
+                raise
+            generation.provider = provider
+            generation.restart()   # its transcript starts at 0 again
+            podcast_url = await generate_podcast_audio_async(
+                topic, provider_options(options, provider), progress)
+        podcast_url, content_hash = await asyncio.to_thread(
+            store_podcast_audio, generation, podcast_url)
+    return await asyncio.to_thread(save_podcast, topic, generation,
+                                   podcast_url, content_hash,
+                                   options.get("podcast_id"))
+
+
+def enforce_audio_quota(keep=None):
+    """
+    Deletes the audio files of the least recently played Podcasts until
+    all the files fit in AUDIO_QUOTA_BYTES. Their Podcasts stay in the
+    database and the libraries, marked as needing regeneration
+    :param keep: a stored file that must not be deleted, e.g. a new one
+    :return: the number of deleted files
+    """
+    if not AUDIO_QUOTA_BYTES:
+        return 0
+    used = func.max(func.coalesce(Podcast.last_played_at,
+                                  Podcast.created_at))
+    rows = db.session.execute(
+        select(Podcast.podcast_url, func.max(Podcast.audio_bytes))
+        .where(Podcast.needs_regeneration.is_not(True))
+        .group_by(Podcast.podcast_url).order_by(used)).all()
+    total = sum(size or 0 for _, size in rows)
+    evicted = 0
+    for podcast_url, size in rows:
+        if total <= AUDIO_QUOTA_BYTES:
+            break
+        if podcast_url == keep or not is_stored_name(podcast_url):
+            continue
+        remove_file(podcast_url)
+        # every Podcast with the same content shares the file
+        db.session.execute(update(Podcast).where(
+            Podcast.podcast_url == podcast_url).values(
+            needs_regeneration=True))
+        total -= size or 0
+        evicted += 1
+    db.session.commit()
+    if evicted:
+        print(f"Evicted {evicted} Podcast audio files, "
+              f"{total / 2 ** 20:.0f} MB left")
+    return evicted
+
+
+def start_generation_job(job_id):
+    """
+    Marks a generation job as running in this process
+    :param job_id: the id of the job
+    :return: the topic and the settings of the job, or None if it already
+    ended
+    """
+    job = db.session.get(GenerationJob, job_id)
+    if not job or job.status in ('done', 'failed'):
+        return None
+    # read before the commit, reloading the job would keep a connection
+    # of the pool for the whole generation
+    started = job.topic, json.loads(job.options)
+    job.status = 'running'
+    job.worker_pid = os.getpid()
+    db.session.commit()
+    return started
+
+
+def record_job_progress(engine, job_id, values):
+    """
+    Writes the stage and progress of a generation job, and renews the lease
+    on its topic. It uses its own connection, so it may run in any thread
+    :param engine: the database engine
+    :param job_id: the id of the job
+    :param values: the job columns to update, e.g. stage and progress
+    """
+    with engine.begin() as conn:
+        conn.execute(update(GenerationJob.__table__).where(
+            GenerationJob.__table__.c.id == job_id).values(
+            updated_at=func.now(), **values))
+        conn.execute(update(GenerationLease.__table__).where(
+            GenerationLease.__table__.c.job_id == job_id).values(
+            expires_at=utc_now() + timedelta(
+                seconds=GENERATION_LEASE_SECONDS)))
+
+
+def finish_generation_job(job_id, new_podcast):
+    """
+    Adds the Podcast of a finished job to the library of the user that
+    started it and of the users that joined it
+    :param job_id: the id of the job
+    :param new_podcast: the Podcast created by the job
+    """
+    job = db.session.get(GenerationJob, job_id)
+    subscribers = db.session.execute(
+        select(job_subscribers.c.user_id).where(
+            job_subscribers.c.job_id == job_id)).scalars().all()
+    for user_id in {job.user_id, *subscribers}:
+        stmt = insert(podcasts_per_user).values(
+            user_id=user_id,
+            podcast_id=new_podcast.id).prefix_with('OR IGNORE')
+        db.session.execute(stmt)
+    job.status = job.stage = 'done'
+    job.progress = 100
+    job.podcast_id = new_podcast.id
+    db.session.commit()
+
+
+def fail_generation_job(job_id, error):
+    """
+    Records the error of a failed generation job
+    :param job_id: the id of the job
+    :param error: the exception that ended the job
+    """
+    db.session.rollback()
+    job = db.session.get(GenerationJob, job_id)
+    job.status = job.stage = 'failed'
+    job.error = str(error)
+    db.session.commit()
+
+
+def claim_generation_lease(topic_key, job_id, lease=None):
+    """
+    Takes the lease on a topic, when it is free or its holder stopped
+    renewing it. The session is flushed, not committed
+    :param topic_key: the normalized topic
+    :param job_id: the generation job, or pregenerate.py run, of the topic
+    :param lease: the current lease of the topic, if any
+    :return: True if the lease was taken, False if another process got it
+    first; the session must then be rolled back
+    """
+    expires_at = utc_now() + timedelta(seconds=GENERATION_LEASE_SECONDS)
+    try:
+        if lease:   # take over the lease of a dead or finished job
+            return db.session.execute(update(GenerationLease).where(
+                GenerationLease.topic_key == topic_key,
+                GenerationLease.job_id == lease.job_id).values(
+                job_id=job_id, expires_at=expires_at)).rowcount == 1
+        db.session.add(GenerationLease(topic_key=topic_key, job_id=job_id,
+                                       expires_at=expires_at))
+        db.session.flush()
+        return True
+    except IntegrityError:   # another process got the lease first
+        return False
+
+
+def release_generation_lease(job_id):
+    """
+    Frees the topic of an ended job, for the next job of the same topic
+    :param job_id: the id of the job
+    """
+    db.session.execute(delete(GenerationLease).where(
+        GenerationLease.job_id == job_id))
+    db.session.commit()
+
+
+def run_generation_job(job_id):
+    """
+    Creates the Podcast of a generation job, in a background worker.
+    The job row is updated with the stage and progress of the generation,
+    and the lease on its topic is renewed as long as the job makes progress
+    :param job_id: the id of the job to run
+    """
+    with app.app_context():
+        started = start_generation_job(job_id)
+        if not started:
+            return
+        engine = db.engine  # progress may be reported from other threads
+
+        def progress(stage, percent, **details):
+            try:
+                record_job_progress(engine, job_id, dict(
+                    stage=stage, progress=percent, **details))
+            except OperationalError as e:   # e.g. locked, the next one saves
+                print(f"Progress of job {job_id} not saved: {e}")
+
+        try:   # Create Podcast
+            new_podcast = create_podcast(*started, progress)
+            finish_generation_job(job_id, new_podcast)
+        except Exception as e:
+            fail_generation_job(job_id, e)
+        finally:
+            release_generation_lease(job_id)
+
+
+async def run_generation_job_async(job_id):
+    """
+    Like run_generation_job(), as a task of the asyncio generation engine.
+    The progress updates are written by one task, in a worker thread; the
+    updates reported during a write are merged into the next one
+    :param job_id: the id of the job to run
+    """
+    with app.app_context():
+        started = await asyncio.to_thread(start_generation_job, job_id)
+        if not started:
+            return
+        engine = db.engine
+        pending = {}
+        writer = None
+
+        async def write_progress():
+            nonlocal writer
+            try:
+                while pending:
+                    values = dict(pending)
+                    pending.clear()
+                    await asyncio.to_thread(record_job_progress, engine,
+                                            job_id, values)
+            except OperationalError as e:   # saved with the next update
+                print(f"Progress of job {job_id} not saved: {e}")
+                pending.update(values | pending)
+            finally:
+                writer = None
+
+        def progress(stage, percent, **details):
+            nonlocal writer
+            pending.update(stage=stage, progress=percent, **details)
+            if writer is None:
+                writer = asyncio.ensure_future(write_progress())
+
+        try:   # Create Podcast
+            new_podcast = await create_podcast_async(*started, progress)
+            if writer:
+                await writer
+            await asyncio.to_thread(finish_generation_job, job_id,
+                                    new_podcast)
+        except Exception as e:
+            if writer:
+                await asyncio.gather(writer, return_exceptions=True)
+            await asyncio.to_thread(fail_generation_job, job_id, e)
+        finally:
+            await asyncio.to_thread(release_generation_lease, job_id)
+
+
+def submit_generation_job(job_id):
+    """
+    Runs a generation job in the background, with the generation engine
+    of GENERATION_ENGINE. The job future is kept while the job runs, for
+    the requests that wait for it
+    :param job_id: the id of the job to run
+    :return: the future of the job
+    """
+    if GENERATION_ENGINE == "asyncio":
+        future = executor.submit(run_generation_job_async, job_id)
+    else:
+        future = executor.submit(run_generation_job, job_id)
+    running_jobs[job_id] = future
+    future.add_done_callback(lambda f: running_jobs.pop(job_id, None))
+    return future
+
+
+def enqueue_generation_job(user_id, topic, options):
+    """
+    Starts the generation of a Podcast, or joins the running generation of
+    the same topic. The topic lease makes sure that only one job per topic
+    runs at a time across all the worker processes
+    :param user_id: the user that asked for the Podcast
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :return: the job that creates the Podcast
+    """
+    topic_key = normalize_topic(topic)
+    for attempt in range(3):
+        lease = db.session.get(GenerationLease, topic_key)
+        if lease and lease.expires_at > utc_now():
+            job = db.session.get(GenerationJob, lease.job_id)
+            if job and job.status in ('queued', 'running'):
+                if job.user_id != user_id:
+                    db.session.execute(insert(job_subscribers).values(
+                        job_id=job.id,
+                        user_id=user_id).prefix_with('OR IGNORE'))
+                    db.session.commit()
+                return job
+            if job is None:   # held by pregenerate.py, there is no job
+                raise RuntimeError("This Podcast is being generated, "
+                                   "please try again in a minute.")
+        job = GenerationJob(id=uuid.uuid4().hex, user_id=user_id,
+                            topic=topic, options=json.dumps(options),
+                            worker_pid=os.getpid())
+        db.session.add(job)
+        db.session.flush()
+        if not claim_generation_lease(topic_key, job.id, lease):
+            db.session.rollback()
+            db.session.expire_all()
+            continue
+        db.session.commit()
+        try:
+            submit_generation_job(job.id)
+        except QueueFullError:
+            db.session.execute(delete(GenerationLease).where(
+                GenerationLease.job_id == job.id))
+            db.session.delete(job)
+            db.session.commit()
+            raise
+        return job
+    raise RuntimeError("The Podcast could not be queued, please try again.")
+
+
+def is_waiting_for(user_id, job):
+    """
+    Checks if a user started a generation job or joined it later
+    :param user_id: the id of the user
+    :param job: the generation job
+    :return: True if the Podcast of the job is for the user
+    """
+    if job.user_id == user_id:
+        return True
+    stmt = select(job_subscribers).where(job_subscribers.c.job_id == job.id,
+                                         job_subscribers.c.user_id == user_id)
+    return db.session.execute(stmt).first() is not None
+
+
+def resume_generation_jobs():
+    """
+    Re-enqueues the jobs left queued or half done by a worker process that
+    is no longer running, e.g. after a restart. Jobs are claimed with a
+    conditional update, so only one process resumes each of them
+    """
+    pid = os.getpid()
+    jobs = GenerationJob.query.filter(
+        GenerationJob.status.in_(('queued', 'running'))).all()
+    for job in jobs:
+        old_pid = job.worker_pid
+        if old_pid and old_pid != pid and pid_alive(old_pid):
+            continue
+        claimed = db.session.execute(
+            update(GenerationJob).where(
+                GenerationJob.id == job.id,
+                GenerationJob.worker_pid.is_(old_pid) if old_pid is None
+                else GenerationJob.worker_pid == old_pid).values(
+                worker_pid=pid, status='queued', stage='queued', progress=0))
+        db.session.commit()
+        if claimed.rowcount != 1:
+            continue
+        try:
+            submit_generation_job(job.id)
+        except QueueFullError:
+            break   # the rest waits for the next restart
+        print(f"Resumed generation job {job.id} for the topic: {job.topic}")
+
+
+@app.before_request
+def start_app():
+    """
+    Prepares the process before its first request, whatever server runs
+    the app: creates or migrates the database, resumes the generation jobs
+    left by a process that stopped and starts the audio sweeper. Runs once
+    per process
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        with app.app_context():
+            init_db()
+            resume_generation_jobs()
+        start_audio_sweeper()
+        _started_pid = os.getpid()
+
+
+def sweep_audio():
+    """
+    Cleans up the audio folder: moves the files of older versions of the
+    app, named after their topic, to the content addressed store, deletes
+    the stored files that no Podcast uses any more and the staging files
+    of generations that died, then enforces the disk quota
+    :return: the number of deleted files
+    """
+    legacy = db.session.execute(select(Podcast.podcast_url).where(
+        Podcast.podcast_url.not_like('%/%'),
+        Podcast.needs_regeneration.is_not(True)).distinct()).scalars().all()
+    for legacy_name in legacy:
+        path = safe_join(AUDIO_FOLDER, legacy_name)
+        if path is None or not os.path.isfile(path):
+            continue
+        # Every Podcast of the file moves to the stored name before the
+        # file does, none is left pointing at a deleted file
+        digest = file_digest(path)
+        extension = os.path.splitext(path)[1].lstrip(".")
+        db.session.execute(update(Podcast).where(
+            Podcast.podcast_url == legacy_name).values(
+            podcast_url=stored_name(digest, extension), content_hash=digest,
+            audio_bytes=os.path.getsize(path)))
+        db.session.commit()
+        store_file(path, digest)
+    used = set(db.session.execute(select(Podcast.podcast_url).where(
+        Podcast.needs_regeneration.is_not(True))).scalars())
+    deleted = 0
+    for name, _, age in stored_files():
+        if name not in used and age > ORPHAN_GRACE_SECONDS:
+            deleted += remove_file(name)
+    for path in stale_staging_files():
+        os.remove(path)
+        deleted += 1
+    if legacy or deleted:
+        print(f"Audio sweep: {len(legacy)} files moved to the store, "
+              f"{deleted} orphaned files deleted")
+    return deleted + enforce_audio_quota()
+
+
+def start_audio_sweeper():
+    """
+    Runs sweep_audio() now and every AUDIO_SWEEP_SECONDS, in a background
+    thread of this process
+    """
+    if not AUDIO_SWEEP_SECONDS:
+        return
+
+    def sweep_forever():
+        while True:
+            with app.app_context():
+                try:
+                    sweep_audio()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Audio sweep failed: {e}")
+            time.sleep(AUDIO_SWEEP_SECONDS)
+
+    threading.Thread(target=sweep_forever, name="audio-sweeper",
+                     daemon=True).start()
+
+
+def mark_played(podcast):
+    """
+    Records that a Podcast is played, at most once per PLAYED_RESOLUTION,
+    for the quota eviction
+    :param podcast: the Podcast
+    """
+    now = utc_now()
+    db.session.execute(update(Podcast).where(
+        Podcast.id == podcast.id,
+        (Podcast.last_played_at.is_(None)) |
+        (Podcast.last_played_at < now - PLAYED_RESOLUTION)).values(
+        last_played_at=now))
+    db.session.commit()
 
 
 @app.route('/')
@@ -107,90 +1051,278 @@ def welcome():
         return render_template('home.html', user_in_session=False)
     if not user:
         return render_template('home.html', user_in_session=False)
-    # Get previous user Podcasts, if any:
     user_id = user.id
-    stmt = select(podcasts_per_user).where(
-        podcasts_per_user.c.user_id == user_id)
-    podcast_ids_for_user = []
-    results = db.session.execute(stmt).fetchall()
-    if results:
-        podcast_ids_for_user = [row[1] for row in results]
-    user_podcasts_list = []
+    recent_podcasts = []
 
     if request.method == 'POST':
         topic = request.form['topic']
         #Check if Podcast is already in database:
-        podcast = Podcast.query.filter(func.lower(Podcast.title) ==
-                                       func.lower(topic)).first()
+        podcast = Podcast.query.filter_by(
+            normalized_title=normalize_topic(topic)).first()
+        if not podcast and not request.form.get('force'):
+            similar = find_similar_podcast(topic)
+            if similar:   # offer it before spending a generation
+                if request.accept_mimetypes.best == 'application/json':
+                    return jsonify(similar_title=similar.title)
+                return render_template('similar_podcast.html',
+                                       user_in_session=True, topic=topic,
+                                       similar=similar)
 
+        if podcast and podcast.needs_regeneration:   # its file was evicted
+            return regenerate_podcast(user_id, podcast)
         if podcast:   # if Podcast topic is already in Podcasts database
             podcast_id = podcast.id
             # Add Podcast to User Podcasts table, if not already
-            if not podcast.id in podcast_ids_for_user:
-                stmt = insert(podcasts_per_user).values(user_id=user_id,
-                                                        podcast_id=podcast_id)
-                db.session.execute(stmt)
-                db.session.commit()
-
-            audio_url = f"audio/{podcast.podcast_url}"
-            return render_template('podcast.html',
-                                   user_in_session=True, audio_file=audio_url)
+            stmt = insert(podcasts_per_user).values(
+                user_id=user_id, podcast_id=podcast_id).prefix_with(
+                'OR IGNORE')
+            db.session.execute(stmt)
+            db.session.commit()
+            mark_played(podcast)
+
+            return render_player(podcast)
         else:      # if Podcast topic is not in Podcasts database
             options = session.get('options', default_options)
-            try:   # Create Podcast
-                if options["ai_model"] == "OpenAI":
-                    podcast_url = ai_create_podcast(topic, options)
-                else:
-                    podcast_url = gemini_create_podcast(topic, options)
-                new_podcast = Podcast(title=topic, podcast_url=podcast_url)
-                db.session.add(new_podcast)
-                db.session.commit()
-                stmt = insert(podcasts_per_user).values(user_id=user_id,
-                                                    podcast_id=new_podcast.id)
-                db.session.execute(stmt)
-                db.session.commit()
-                audio_url = f"audio/{podcast_url}"
-                return render_template('podcast.html',
-                                    user_in_session=True, audio_file=audio_url)
+            try:   # Queue the Podcast creation
+                job = enqueue_generation_job(user_id, topic, options)
+                if request.accept_mimetypes.best == 'application/json':
+                    return jsonify(job_id=job.id,
+                                   status_url=url_for('job_status',
+                                                      job_id=job.id)), 202
+                return render_template('generating.html',
+                                       user_in_session=True, job_id=job.id,
+                                       topic=topic)
             except Exception as e:
                 db.session.rollback()
                 flash(str(e),'error')
 
-    if request.method == 'GET':
-        if podcast_ids_for_user:
-            [user_podcasts_list.append(Podcast.query.filter_by(id=i).first())
-             for i in podcast_ids_for_user]
+    if request.method == 'GET':   # the library link and the footer
+        recent_podcasts, _ = user_library(user_id, limit=RECENT_PODCASTS)
     return render_template('welcome.html', user_in_session=True,
-                                   user_podcasts_list=user_podcasts_list)
+                                   recent_podcasts=recent_podcasts)
+
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Route: job_status
+    Reports the stage and progress of a Podcast generation job
+    :param job_id: the id of the generation job
+    :return: JSON with the job status, and the player page URL when done
+    """
+    if 'username' not in session:
+        return jsonify(error="Please Log in First"), 401
+    user = User.query.filter_by(username=session['username']).first()
+    job = db.session.get(GenerationJob, job_id)
+    if not user or not job or not is_waiting_for(user.id, job):
+        return jsonify(error="Job not found"), 404
+    return jsonify(job_result(job))
+
 
+def job_result(job):
+    """
+    Describes a generation job for the job status requests
+    :param job: the generation job
+    :return: dictionary with the job status, and the player page URL when
+    done
+    """
+    result = {"id": job.id, "topic": job.topic, "status": job.status,
+              "stage": job.stage, "progress": job.progress,
+              "error": job.error}
+    if job.status == 'done':
+        podcast = db.session.get(Podcast, job.podcast_id)
+        result["player_url"] = url_for('podcast', podcast_id=podcast.id)
+    elif job.status == 'running' and job.live_file:
+        result["live_url"] = url_for('live_audio', job_id=job.id)
+    return result
+
+
+@app.route('/jobs/<job_id>/wait')
+async def wait_for_job(job_id):
+    """
+    Route: wait_for_job
+    Long polling version of job_status: answers when the generation job
+    ends, or after JOB_WAIT_SECONDS. A job running in this process is
+    awaited, the jobs of other processes are checked every second
+    :param job_id: the id of the generation job
+    :return: JSON with the job status, as job_status
+    """
+    if 'username' not in session:
+        return jsonify(error="Please Log in First"), 401
+    user = User.query.filter_by(username=session['username']).first()
+    job = db.session.get(GenerationJob, job_id)
+    if not user or not job or not is_waiting_for(user.id, job):
+        return jsonify(error="Job not found"), 404
+    deadline = time.monotonic() + JOB_WAIT_SECONDS
+    future = running_jobs.get(job_id)
+    if future:
+        try:   # shielded, the timeout must not cancel the job
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(
+                future)), JOB_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    else:
+        while (job.status in ('queued', 'running')
+               and time.monotonic() < deadline):
+            await asyncio.sleep(1)
+            db.session.refresh(job)
+    db.session.refresh(job)
+    return jsonify(job_result(job))
+
+
+@app.route('/jobs/<job_id>/live')
+def live_audio(job_id):
+    """
+    Route: live_audio
+    Streams the audio of a Podcast while it is being generated: what is
+    already synthesized at once, then every new dialogue turn as soon as it
+    is appended to the file, until the generation ends
+    :param job_id: the id of the generation job
+    :return: chunked audio stream, or a redirect to the finished Podcast
+    """
+    if 'username' not in session:
+        abort(401)
+    user = User.query.filter_by(username=session['username']).first()
+    job = db.session.get(GenerationJob, job_id)
+    if not user or not job or not is_waiting_for(user.id, job):
+        abort(404)
+    live_file = None
+    if job.status == 'running' and job.live_file:
+        try:
+            live_file = open(safe_join(AUDIO_FOLDER, job.live_file), 'rb')
+        except OSError:   # finished meanwhile and moved to its final name
+            db.session.refresh(job)
+    if live_file is None:
+        if job.status != 'done':
+            abort(404)
+        return redirect(podcast_audio_url(db.session.get(Podcast,
+                                                         job.podcast_id)))
+    engine = db.engine  # the stream outlives the request context
+
+    def stream():
+        # The open file is still read after the generation renames it
+        with live_file:
+            last_data = time.monotonic()
+            while True:
+                chunk = live_file.read(LIVE_CHUNK_SIZE)
+                if chunk:
+                    last_data = time.monotonic()
+                    yield chunk
+                    continue
+                with engine.connect() as conn:
+                    status = conn.execute(select(GenerationJob.status).where(
+                        GenerationJob.id == job_id)).scalar()
+                if status != 'running':
+                    yield live_file.read()   # the end of the Podcast
+                    return
+                if time.monotonic() - last_data > GENERATION_LEASE_SECONDS:
+                    return   # the generation is stuck
+                time.sleep(LIVE_POLL_SECONDS)
+
+    mimetype = mimetypes.guess_type(job.live_file.removesuffix('.part'))[0]
+    response = app.response_class(stream(), mimetype=mimetype or 'audio/mpeg')
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/stats/caches')
+def cache_stats():
+    """
+    Route: cache_stats
+    Reports the hit and miss counters of the caches, to tune their TTL
+    :return: JSON with the statistics of each cache
+    """
+    return jsonify(tavily=news_cache.stats(), tts=clip_cache.stats(),
+                   scripts=script_cache.stats())
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Route: metrics
+    Exposes the generation stage latencies, tokens, audio bytes and provider
+    calls of this process, for Prometheus to scrape
+    :return: the metrics in the Prometheus text format
+    """
+    response = app.response_class(
+        render_metrics(), mimetype='text/plain; version=0.0.4')
+    response.cache_control.no_store = True
+    return response
 
 
 @app.route('/previous_podcasts')
 def previous_podcasts():
     """
     Route: previous_podcasts
-    Displays a list of the previous user Podcasts
+    Displays the first page of the previous user Podcasts, the rest are
+    loaded while scrolling from the library_page route
     :return: Rendered HTML template for the page that displays the list
     """
     user_podcasts_list = []
+    recent_podcasts = []
+    next_cursor = None
     if session:
         user_in_session = True
         user = User.query.filter_by(username=session['username']).first()
-        user_id = user.id
-        stmt = select(podcasts_per_user).where(
-            podcasts_per_user.c.user_id == user_id)
-        podcast_ids_for_user = []
-        results = db.session.execute(stmt).fetchall()
-        if results:
-            podcast_ids_for_user = [row[1] for row in results]
-        if podcast_ids_for_user:
-            [user_podcasts_list.append(Podcast.query.filter_by(id=i).first())
-             for i in podcast_ids_for_user]
+        user_podcasts_list, next_cursor = user_library(user.id)
+        recent_podcasts, _ = user_library(user.id, limit=RECENT_PODCASTS)
     else:
         flash("Please Log in First")
         user_in_session = False
     return render_template('previous_podcasts.html',
-        user_in_session=user_in_session, user_podcasts_list=user_podcasts_list)
+        user_in_session=user_in_session, user_podcasts_list=user_podcasts_list,
+        recent_podcasts=recent_podcasts,
+        next_cursor=next_cursor)
+
+
+@app.route('/api/podcasts')
+def library_page():
+    """
+    Route: library_page
+    Returns one page of the previous user Podcasts, for infinite scroll
+    :return: JSON with the Podcasts and the cursor of the next page
+    """
+    if 'username' not in session:
+        return jsonify(error="Please Log in First"), 401
+    user = User.query.filter_by(username=session['username']).first()
+    if not user:
+        return jsonify(error="Please Log in First"), 401
+    try:
+        podcasts, next_cursor = user_library(user.id,
+                                             request.args.get('cursor'))
+    except ValueError:
+        return jsonify(error="Invalid cursor"), 400
+    return jsonify(podcasts=[
+        {"title": podcast.title,
+         "url": url_for('podcast', podcast_id=podcast.id)}
+        for podcast in podcasts], next_cursor=next_cursor)
+
+
+@app.route('/api/search')
+def search():
+    """
+    Route: search
+    Searches the transcripts of all the Podcasts. Each result links to
+    the player at the start of the matching turn
+    :return: JSON with the matching turns, the matching words of their
+    snippet in <mark> elements
+    """
+    text = request.args.get('q', '')
+    try:
+        rows = search_transcripts(text)
+    except OperationalError:   # no FTS5 index
+        return jsonify(error="Transcript search is not available"), 503
+    return jsonify(results=[
+        {"podcast_id": row.podcast_id,
+         "title": row.title,
+         "speaker": row.speaker,
+         "start_ms": row.start_ms,
+         "snippet": str(escape(row.snippet)).replace(
+             "\x02", "<mark>").replace("\x03", "</mark>"),
+         "url": url_for('podcast', podcast_id=row.podcast_id,
+                        t=f"{row.start_ms / 1000:g}")}
+        for row in rows])
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -204,8 +1336,10 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        hashed_password = generate_password_hash(password, method='scrypt',
-                                                 salt_length=16)
+        try:
+            hashed_password = hasher.hash(password)
+        except HASHER_BUSY_ERRORS:
+            return overloaded('register.html')
         try:
             new_user = User(username=username, password=hashed_password)
             db.session.add(new_user)
@@ -221,6 +1355,35 @@ def register():
                            user_in_session=False)
 
 
+def overloaded(template):
+    """
+    Refuses a login or a registration while too many passwords are being
+    hashed, so that the burst does not stall the other requests, or when a
+    hashing process died
+    :param template: the page to render again
+    :return: the page, with status 503 and a Retry-After header
+    """
+    flash(f"Too many logins right now. Please try again in "
+          f"{LOGIN_RETRY_AFTER} seconds.", 'error')
+    return render_template(template, user_in_session=False), 503, {
+        'Retry-After': str(LOGIN_RETRY_AFTER)}
+
+
+def rehash_password(user, password):
+    """
+    Replaces the password hash of a user, made with older scrypt
+    parameters, after a successful login. Skipped under load, the next
+    login tries again
+    :param user: the user that logged in
+    :param password: the password of the user
+    """
+    try:
+        user.password = hasher.hash(password)
+    except HASHER_BUSY_ERRORS:
+        return
+    db.session.commit()
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -233,7 +1396,13 @@ def login():
         password = request.form['password']
 
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        try:
+            valid = user and hasher.check(user.password, password)
+        except HASHER_BUSY_ERRORS:
+            return overloaded('login.html')
+        if valid:
+            if needs_rehash(user.password):
+                rehash_password(user, password)
             session['username'] = username
             session['options'] = default_options.copy()
             flash('Login successful!', 'success')
@@ -249,11 +1418,165 @@ def login():
 def podcast():
     """
     route: podcast
-    Plays the Podcast
+    Plays the Podcast, or generates it again if its audio file was evicted.
+    With t, the player starts at that second, e.g. of a transcript turn
+    :return: Rendered HTML template for audio player page
+    """
+    podcast_id = request.args.get('podcast_id', type=int)
+    if podcast_id:
+        podcast = db.session.get(Podcast, podcast_id)
+    else:   # links of older versions of the app
+        podcast = Podcast.query.filter_by(
+            podcast_url=request.args.get('audio_file')).first()
+    if not podcast:
+        abort(404)
+    if podcast.needs_regeneration:
+        user = User.query.filter_by(
+            username=session.get('username')).first()
+        if not user:
+            return redirect(url_for('login'))
+        return regenerate_podcast(user.id, podcast)
+    mark_played(podcast)
+    return render_player(podcast, request.args.get('t', 0, type=float))
+
+
+def render_player(podcast, start=0):
+    """
+    Renders the audio player of a Podcast, with its transcript
+    :param podcast: the Podcast
+    :param start: the second the player starts at; the browser requests
+    the audio from there with a Range request
     :return: Rendered HTML template for audio player page
     """
+    transcript = TranscriptTurn.query.filter_by(
+        podcast_id=podcast.id).order_by(TranscriptTurn.position).all()
+    user = User.query.filter_by(username=session.get('username')).first()
+    can_revoice = bool(user) and podcast_owners(podcast.id) == [user.id]
     return render_template('podcast.html', user_in_session = True,
-                           audio_file=f"audio/{request.args.get('audio_file')}")
+                           podcast_id=podcast.id, title=podcast.title,
+                           audio_file=podcast.podcast_url,
+                           audio_url=podcast_audio_url(podcast),
+                           start=start, transcript=transcript,
+                           can_revoice=can_revoice)
+
+
+def podcast_owners(podcast_id):
+    """
+    :param podcast_id: the id of the Podcast
+    :return: the ids of the users with the Podcast in their library
+    """
+    return db.session.execute(select(podcasts_per_user.c.user_id).where(
+        podcasts_per_user.c.podcast_id == podcast_id)).scalars().all()
+
+
+def regenerate_podcast(user_id, podcast):
+    """
+    Generates again a Podcast whose audio file was evicted, or that the
+    user voices again, with the settings of the user. The script of the
+    Podcast is reused from the script cache, when its hosts have the same
+    names and moods, so only its audio is made again
+    :param user_id: the user that plays the Podcast
+    :param podcast: the Podcast
+    :return: the generation progress page
+    """
+    options = dict(session.get('options', default_options),
+                   podcast_id=podcast.id, news_digest=podcast.news_digest)
+    try:
+        job = enqueue_generation_job(user_id, podcast.title, options)
+    except Exception as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+        return redirect(url_for('welcome'))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_id=job.id, status_url=url_for(
+            'job_status', job_id=job.id)), 202
+    return render_template('generating.html', user_in_session=True,
+                           job_id=job.id, topic=podcast.title)
+
+
+@app.route('/podcast/<int:podcast_id>/revoice', methods=['POST'])
+def revoice_podcast(podcast_id):
+    """
+    Route: revoice_podcast
+    Generates the Podcast again with the voices and the AI provider of the
+    user settings. The new audio replaces the one of the Podcast, so only
+    a Podcast that no other user has in their library can be voiced again
+    :param podcast_id: the id of the Podcast
+    :return: the generation progress page
+    """
+    user = User.query.filter_by(username=session.get('username')).first()
+    if not user:
+        return redirect(url_for('login'))
+    podcast = db.session.get(Podcast, podcast_id)
+    owners = podcast_owners(podcast_id) if podcast else []
+    if user.id not in owners:
+        abort(404)
+    if len(owners) > 1:
+        flash("Other listeners have this Podcast in their library, "
+              "it cannot be voiced again.", 'error')
+        return redirect(url_for('podcast', podcast_id=podcast_id))
+    return regenerate_podcast(user.id, podcast)
+
+
+def podcast_audio_url(podcast):
+    """
+    URL of the Podcast audio file, versioned with its content hash, so
+    that it can be cached forever
+    :param podcast: the Podcast
+    :return: the URL of the audio route
+    """
+    if not podcast.content_hash:   # stored by an older version of the app
+        path = os.path.join(AUDIO_FOLDER, podcast.podcast_url)
+        if not os.path.isfile(path):
+            return url_for('audio', filename=podcast.podcast_url)
+        podcast.content_hash = file_digest(path)
+        db.session.commit()
+    return url_for('audio', filename=podcast.podcast_url,
+                   v=podcast.content_hash[:16])
+
+
+@app.route('/audio/<path:filename>')
+def audio(filename):
+    """
+    Route: audio
+    Serves a Podcast audio file, with Range requests for seeking and the
+    content hash as ETag. Versioned URLs (?v=<hash>) are cached as
+    immutable. With AUDIO_ACCEL_REDIRECT set, the reverse proxy sends the
+    file instead of the Flask worker
+    :param filename: the Podcast audio file name
+    :return: the audio file, or only its headers for the reverse proxy
+    """
+    path = safe_join(AUDIO_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    # Generations in progress are only streamed by the live route
+    if (os.path.commonpath([path, STAGING_FOLDER]) == STAGING_FOLDER
+            or path.endswith('.part')):
+        abort(404)
+    podcast = Podcast.query.filter_by(podcast_url=filename).first()
+    content_hash = podcast.content_hash if podcast else None
+    if AUDIO_ACCEL_REDIRECT:
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = app.response_class(mimetype=mimetype)
+        if content_hash:
+            response.set_etag(content_hash)
+        response.make_conditional(request)
+        if response.status_code != 304:
+            response.headers['X-Accel-Redirect'] = (AUDIO_ACCEL_REDIRECT
+                                                    + quote(filename))
+    else:
+        # Range and If-None-Match requests are answered by send_file
+        response = send_file(path, conditional=True,
+                             etag=content_hash or True)
+    version = request.args.get('v')
+    if content_hash and version == content_hash[:16]:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = AUDIO_MAX_AGE
+        response.cache_control.immutable = True
+    else:   # the file may change, the ETag lets browsers revalidate it
+        response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/options', methods=['GET', 'POST'])
@@ -322,6 +1645,5 @@ def logout():
 
 
 if __name__ == '__main__':
-    with app.app_context():
-        init_db()
+    start_app()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
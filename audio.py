@@ -0,0 +1,352 @@
+import io
+import os
+import struct
+import subprocess
+import tempfile
+from functools import lru_cache
+from pydub import AudioSegment
+
+INTRO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "static", "audio", "mind-intro.mp3")
+# Format of the MP3 audio produced by the OpenAI TTS. The Podcast is built
+# in this format, anything else is converted to it before it is appended
+TARGET_SAMPLE_RATE = 24000
+TARGET_CHANNELS = 1
+TARGET_BITRATE = "128k"
+# Compressed formats of the PCM encoder: file extension and ffmpeg options
+PCM_ENCODINGS = {
+    "mp3": ("mp3", ["-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"]),
+    "opus": ("ogg", ["-c:a", "libopus", "-b:a", "32k", "-f", "ogg"]),
+}
+
+# MPEG audio Layer III tables, indexed by the version bits of the header
+_MPEG1, _MPEG2, _MPEG25 = 3, 2, 0
+_BITRATES = {
+    _MPEG1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320],
+    _MPEG2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_BITRATES[_MPEG25] = _BITRATES[_MPEG2]
+_SAMPLE_RATES = {
+    _MPEG1: [44100, 48000, 32000],
+    _MPEG2: [22050, 24000, 16000],
+    _MPEG25: [11025, 12000, 8000],
+}
+
+
+class Mp3Frame:
+    """
+    Position and format of one MPEG audio Layer III frame
+    """
+    __slots__ = ("start", "end", "version", "sample_rate", "channels")
+
+    def __init__(self, start, end, version, sample_rate, channels):
+        self.start = start
+        self.end = end
+        self.version = version
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @property
+    def samples(self):
+        return 1152 if self.version == _MPEG1 else 576
+
+    @property
+    def side_info_size(self):
+        if self.version == _MPEG1:
+            return 17 if self.channels == 1 else 32
+        return 9 if self.channels == 1 else 17
+
+
+def _parse_header(data, pos):
+    """
+    Reads the MP3 frame header found at data[pos]
+    :param data: the MP3 bytes
+    :param pos: offset of the header
+    :return: an Mp3Frame, or None if there is no valid header at pos
+    """
+    if (pos + 4 > len(data) or data[pos] != 0xFF
+            or data[pos + 1] & 0xE0 != 0xE0):
+        return None
+    version = (data[pos + 1] >> 3) & 0x03
+    layer = (data[pos + 1] >> 1) & 0x03
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 0x03
+    if (version == 1 or layer != 1 or bitrate_index in (0, 15)
+            or rate_index == 3):
+        return None
+    padding = (data[pos + 2] >> 1) & 0x01
+    channels = 1 if data[pos + 3] >> 6 == 3 else 2
+    bitrate = _BITRATES[version][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    coefficient = 144 if version == _MPEG1 else 72
+    length = coefficient * bitrate // sample_rate + padding
+    return Mp3Frame(pos, pos + length, version, sample_rate, channels)
+
+
+def _is_info_frame(data, frame):
+    """
+    Checks if the frame is a Xing/Info/VBRI header and not audio
+    """
+    tag_at = frame.start + 4 + frame.side_info_size
+    return (data[tag_at:tag_at + 4] in (b"Xing", b"Info")
+            or data[frame.start + 36:frame.start + 40] == b"VBRI")
+
+
+def mp3_frames(data):
+    """
+    Finds the audio frames of an MP3 file, skipping ID3 tags, Xing/Info
+    headers and any garbage between frames
+    :param data: the MP3 file contents
+    :return: generator of Mp3Frame
+    """
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = 0
+        for byte in data[6:10]:   # syncsafe integer
+            size = (size << 7) | (byte & 0x7F)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+    end = len(data) - 128 if data[-128:-125] == b"TAG" else len(data)
+    first = True
+    while pos + 4 <= end:
+        frame = _parse_header(data, pos)
+        if frame is None:   # lost sync, look for the next frame header
+            pos = data.find(b"\xff", pos + 1)
+            if pos < 0:
+                break
+            continue
+        if frame.end > end:   # truncated last frame
+            break
+        if not (first and _is_info_frame(data, frame)):
+            yield frame
+        first = False
+        pos = frame.end
+
+
+def _frame_header(sample_rate, channels, kbps):
+    """
+    Builds the 4 byte header of an MP3 frame with the given format
+    """
+    for version, rates in _SAMPLE_RATES.items():
+        if sample_rate in rates:
+            break
+    else:
+        raise ValueError(f"Unsupported MP3 sample rate: {sample_rate}")
+    return bytes([
+        0xFF,
+        0xE0 | version << 3 | 1 << 1 | 1,   # Layer III, no CRC
+        _BITRATES[version].index(kbps) << 4 | rates.index(sample_rate) << 2,
+        0xC0 if channels == 1 else 0x00,
+    ])
+
+
+def convert_mp3(data):
+    """
+    Converts MP3 audio to the format of the Podcast
+    :param data: the MP3 file contents
+    :return: the converted MP3 file contents
+    """
+    segment = AudioSegment.from_file(io.BytesIO(data), format="mp3")
+    segment = segment.set_frame_rate(TARGET_SAMPLE_RATE).set_channels(
+        TARGET_CHANNELS)
+    buffer = io.BytesIO()
+    segment.export(buffer, format="mp3", bitrate=TARGET_BITRATE)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=None)
+def intro_mp3():
+    """
+    The music intro/outro, converted to the Podcast format only once per
+    process
+    :return: tuple of the MP3 bytes of the intro, without tags, and the
+    number of its frames
+    """
+    with open(INTRO_PATH, "rb") as f:
+        data = convert_mp3(f.read())
+    frames = list(mp3_frames(data))
+    return b"".join(data[frame.start:frame.end] for frame in frames), len(
+        frames)
+
+
+class PodcastAssembler:
+    """
+    Writes the Podcast MP3 file straight to disk, appending each audio
+    segment as MP3 frames, without decoding it. The cost of each segment is
+    proportional to its own size and only one segment is in memory at a
+    time. The file is written next to its destination and moved there when
+    complete, with a Xing header that tells the players its duration.
+    Every segment is flushed as soon as it is added, so the incomplete file
+    at part_path can be streamed while it grows.
+    """
+    XING_KBPS = 64
+
+    def __init__(self, path):
+        self.path = path
+        # Unique name, so that concurrent generations never share a file
+        fd, self.part_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or None, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self._frames = 0
+        self._samples = 0   # per channel, for the position of the segments
+        # Placeholder of the Xing header, completed by close()
+        header = _frame_header(TARGET_SAMPLE_RATE, TARGET_CHANNELS,
+                               self.XING_KBPS)
+        frame = _parse_header(header, 0)
+        self._xing_at = 4 + frame.side_info_size
+        self._frame_samples = frame.samples   # of the converted intro too
+        self._file.write(header + bytes(frame.end - 4))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_intro(self):
+        """
+        Appends the music intro/outro
+        """
+        data, frames = intro_mp3()
+        self._file.write(data)
+        self._file.flush()
+        self._frames += frames
+        self._samples += frames * self._frame_samples
+
+    def add(self, data):
+        """
+        Appends an MP3 audio segment, converting it first if its sample
+        rate or channels differ from the Podcast format
+        :param data: the MP3 file contents
+        :return: where the segment starts in the Podcast, in milliseconds
+        """
+        start = self.position_ms
+        frames = list(mp3_frames(data))
+        if any(frame.sample_rate != TARGET_SAMPLE_RATE
+               or frame.channels != TARGET_CHANNELS for frame in frames):
+            data = convert_mp3(data)
+            frames = list(mp3_frames(data))
+        view = memoryview(data)
+        for frame in frames:
+            self._file.write(view[frame.start:frame.end])
+        self._file.flush()
+        self._frames += len(frames)
+        self._samples += sum(frame.samples for frame in frames)
+        return start
+
+    @property
+    def position_ms(self):
+        """
+        The length of the Podcast so far, in milliseconds
+        """
+        return round(self._samples * 1000 / TARGET_SAMPLE_RATE)
+
+    def close(self):
+        """
+        Completes the Xing header and moves the file to its destination
+        """
+        size = self._file.tell()
+        self._file.seek(self._xing_at)
+        # flags: the frames and bytes fields are present
+        self._file.write(struct.pack(">4sIII", b"Xing", 0x03, self._frames,
+                                     size))
+        self._file.close()
+        os.chmod(self.part_path, 0o644)   # mkstemp makes it private
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        """
+        Discards the incomplete file
+        """
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+@lru_cache(maxsize=None)
+def intro_pcm(sample_rate=TARGET_SAMPLE_RATE, channels=TARGET_CHANNELS):
+    """
+    The music intro/outro, decoded to 16 bit PCM only once per process
+    :param sample_rate: sample rate of the PCM
+    :param channels: number of audio channels of the PCM
+    :return: the raw PCM bytes of the intro
+    """
+    return AudioSegment.from_mp3(INTRO_PATH).set_frame_rate(
+        sample_rate).set_channels(channels).set_sample_width(2).raw_data
+
+
+class PcmEncoder:
+    """
+    Encodes raw 16 bit PCM audio to a compressed file while it is being
+    written: the PCM is piped in chunks to an ffmpeg process, which writes
+    the encoded audio straight to disk. Like PodcastAssembler, the file is
+    moved to its destination only when complete.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, encoding="mp3", sample_rate=TARGET_SAMPLE_RATE,
+                 channels=TARGET_CHANNELS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        fd, self.part_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or None,
+            suffix=f".{PCM_ENCODINGS[encoding][0]}.part")
+        os.close(fd)
+        options = PCM_ENCODINGS[encoding][1]
+        self._process = subprocess.Popen(
+            [AudioSegment.converter, "-y", "-loglevel", "error",
+             "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels),
+             "-i", "pipe:0", *options,
+             # write every packet at once, the file may be streamed live
+             "-flush_packets", "1", self.part_path],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, pcm):
+        """
+        Encodes more PCM audio
+        :param pcm: raw 16 bit PCM bytes
+        """
+        view = memoryview(pcm)
+        for start in range(0, len(view), self.CHUNK_SIZE):
+            self._process.stdin.write(view[start:start + self.CHUNK_SIZE])
+
+    def add_intro(self):
+        """
+        Encodes the music intro/outro
+        """
+        self.write(intro_pcm(self.sample_rate, self.channels))
+
+    def close(self):
+        """
+        Finishes the encoding and moves the file to its destination
+        """
+        self._process.stdin.close()
+        errors = self._process.stderr.read()
+        if self._process.wait() != 0:
+            os.remove(self.part_path)
+            raise RuntimeError(f"Audio encoding failed: "
+                               f"{errors.decode(errors='replace')}")
+        os.chmod(self.part_path, 0o644)   # mkstemp makes it private
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        """
+        Stops the encoder and discards the incomplete file
+        """
+        self._process.kill()
+        self._process.wait()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
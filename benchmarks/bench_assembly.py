@@ -0,0 +1,127 @@
+"""
+Benchmark of the Podcast audio assembly: the pydub `+=` concatenation that
+ai_create_podcast used to do, against the streaming PodcastAssembler.
+Every run happens in a fresh process, so that peak RSS is comparable.
+
+Needs ffmpeg, like pydub. Run with:
+    python benchmarks/bench_assembly.py [segment counts...]
+"""
+import io
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pydub import AudioSegment
+from pydub.generators import WhiteNoise
+from audio import (INTRO_PATH, PodcastAssembler, TARGET_CHANNELS,
+                   TARGET_SAMPLE_RATE)
+
+SEGMENT_SECONDS = 8   # a typical dialogue turn
+DEFAULT_COUNTS = [10, 50, 200]
+# Longest run of one method, beyond it the benchmark fails
+RUN_TIMEOUT = 600
+
+
+def make_segment():
+    """
+    An MP3 segment in the format of the OpenAI TTS output
+    """
+    buffer = io.BytesIO()
+    WhiteNoise().to_audio_segment(duration=SEGMENT_SECONDS * 1000,
+                                  volume=-30).set_frame_rate(
+        TARGET_SAMPLE_RATE).set_channels(TARGET_CHANNELS).export(
+        buffer, format="mp3")
+    return buffer.getvalue()
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process
+    """
+    scale = 1 if sys.platform == "darwin" else 1024   # bytes or KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return peak / 2 ** 20
+
+
+def pydub_concatenation(paths, output):
+    combined = AudioSegment.from_mp3(INTRO_PATH)
+    for path in paths:
+        combined += AudioSegment.from_mp3(path)
+    combined += AudioSegment.from_mp3(INTRO_PATH)
+    combined.export(output, format="mp3")
+
+
+def streaming_assembly(paths, output):
+    with PodcastAssembler(output) as assembler:
+        assembler.add_intro()
+        for path in paths:
+            with open(path, "rb") as f:
+                assembler.add(f.read())
+        assembler.add_intro()
+
+
+def run(method, paths, output, results):
+    started = time.perf_counter()
+    method(paths, output)
+    elapsed = time.perf_counter() - started
+    results.put((elapsed, peak_rss_mb(), os.path.getsize(output)))
+
+
+def collect(process, results):
+    """
+    Waits for the result of a run, failing if its process dies without
+    one or takes longer than RUN_TIMEOUT
+    :return: seconds, peak RSS MB and output bytes of the run
+    """
+    deadline = time.monotonic() + RUN_TIMEOUT
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"The run stopped without a result, "
+                                   f"exit code {process.exitcode}")
+    process.join()
+    if process.exitcode:
+        raise RuntimeError(f"The run failed, exit code {process.exitcode}")
+    return result
+
+
+def main():
+    counts = [int(n) for n in sys.argv[1:]] or DEFAULT_COUNTS
+    segment = make_segment()
+    context = multiprocessing.get_context("spawn")
+    print(f"{'segments':>8} {'method':>10} {'seconds':>9} "
+          f"{'peak RSS MB':>11} {'output MB':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for count in counts:
+            paths = []
+            for i in range(count):
+                path = os.path.join(folder, f"{i}.mp3")
+                with open(path, "wb") as f:
+                    f.write(segment)
+                paths.append(path)
+            for name, method in (("pydub", pydub_concatenation),
+                                 ("assembler", streaming_assembly)):
+                results = context.Queue()
+                output = os.path.join(folder, f"{name}-{count}.mp3")
+                process = context.Process(target=run, args=(
+                    method, paths, output, results))
+                process.start()
+                elapsed, rss, size = collect(process, results)
+                print(f"{count:>8} {name:>10} {elapsed:>9.2f} {rss:>11.1f} "
+                      f"{size / 2 ** 20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
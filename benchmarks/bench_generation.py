@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark of the Podcast generation. Runs the real Flask app
+on a local port, with the AI providers replaced by fake_providers.py in a
+separate process, and creates Podcasts through /welcome from concurrent
+clients, each one polling its job until the Podcast is done.
+
+Reports the p50/p95/p99 latency of whole generations and of the first
+live audio, the throughput, the peak memory of the app process and the
+time of each generation stage. Every run is appended, with the commit it
+ran on, to benchmarks/results/bench_generation.jsonl and compared with the
+last run of the same settings.
+
+Needs ffmpeg, like pydub. Run from the repository root:
+    python benchmarks/bench_generation.py [--podcasts 20] [--concurrency 4]
+        [--provider OpenAI] [--engine asyncio] [--tts-latency 0.3]
+        [--no-save] ...
+"""
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+RESULTS_PATH = os.path.join(BENCH_DIR, "results", "bench_generation.jsonl")
+POLL_SECONDS = 0.2
+JOB_TIMEOUT = 600
+PROVIDER_OPTIONS = {
+    "OpenAI": {"host1_voice": "ash", "host2_voice": "shimmer"},
+    "Gemini": {"host1_voice": "Puck", "host2_voice": "Kore"},
+}
+
+sys.path.insert(0, BENCH_DIR)
+import fake_providers
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Podcast generation against fake AI "
+                    "providers")
+    parser.add_argument("--podcasts", type=int, default=20,
+                        help="Podcasts to create")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="clients creating Podcasts at the same time")
+    parser.add_argument("--workers", type=int,
+                        help="GENERATION_WORKERS of the app, by default "
+                             "the concurrency")
+    parser.add_argument("--provider", choices=sorted(PROVIDER_OPTIONS),
+                        default="OpenAI")
+    parser.add_argument("--engine", choices=("threads", "asyncio"),
+                        default="threads",
+                        help="GENERATION_ENGINE of the app")
+    parser.add_argument("--no-save", action="store_true",
+                        help="do not add the results to " + RESULTS_PATH)
+    fake_providers.add_arguments(parser)
+    return parser.parse_args()
+
+
+def percentile(values, percent):
+    """
+    :return: the percentile of the values, by linear interpolation
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * percent / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process, the app
+    """
+    scale = 1 if sys.platform == "darwin" else 1024   # bytes or KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return peak / 2 ** 20
+
+
+def git_commit():
+    """
+    :return: the commit of the repository, with a + if it has changes
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("+" if dirty else "")
+
+
+def start_fake_providers(config):
+    """
+    Starts the fake providers in a child process, so that they are not
+    counted in the memory of the app
+    :return: the base URL of the fake providers
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=fake_providers.serve,
+                                      args=(config, ports), daemon=True)
+    process.start()
+    atexit.register(process.terminate)
+    return f"http://127.0.0.1:{ports.get(timeout=30)}"
+
+
+def prepare_app(base_url, workers, podcasts, engine):
+    """
+    Imports the app in a temporary working directory, pointed at the fake
+    providers, and serves it on a local port
+    :return: the URL of the app
+    """
+    workdir = tempfile.mkdtemp(prefix="mypodcast-bench-")
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, "data"))
+    os.makedirs(os.path.join(workdir, "static", "audio"))
+    shutil.copy(os.path.join(ROOT, "static", "audio", "mind-intro.mp3"),
+                os.path.join(workdir, "static", "audio"))
+    os.chdir(workdir)   # the app keeps its database and audio in ./
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{base_url}/v1", "GEMINI_BASE_URL": base_url,
+        "TAVILY_BASE_URL": base_url, "GENERATION_WORKERS": str(workers),
+        "GENERATION_QUEUE_SIZE": str(podcasts),
+        "GENERATION_ENGINE": engine})
+    for key in ("SECRET_KEY", "OPENAI_API_KEY", "GEMINI_API_KEY",
+                "TAVILI_KEY"):
+        os.environ.setdefault(key, "benchmark")
+    sys.path.insert(0, ROOT)
+
+    import app as podcast_app
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass   # thousands of job polls
+
+    with podcast_app.app.app_context():
+        podcast_app.init_db()
+    server = make_server("127.0.0.1", 0, podcast_app.app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def login(app_url, number, provider):
+    """
+    Registers and logs in a benchmark user, with the settings of the
+    provider
+    :return: the requests session of the user
+    """
+    import requests
+    client = requests.Session()
+    credentials = {"username": f"bench{number}", "password": "benchmark"}
+    client.post(f"{app_url}/register", data=credentials)
+    client.post(f"{app_url}/login", data=credentials)
+    options = {"ai_model": provider, "host1_name": "George",
+               "host2_name": "Doris", "host1_mood": "analytical but witty",
+               "host2_mood": "lighthearted and curious"}
+    options.update(PROVIDER_OPTIONS[provider])
+    client.post(f"{app_url}/options", data=options)
+    return client
+
+
+def create_podcast(app_url, client, topic):
+    """
+    Creates one Podcast through /welcome and waits until its job is done
+    :return: Dictionary with the seconds to the first live audio and to
+    the finished Podcast, or the error
+    """
+    started = time.perf_counter()
+    response = client.post(f"{app_url}/welcome",
+                           data={"topic": topic, "force": "1"},
+                           headers={"Accept": "application/json"})
+    if response.status_code != 202:
+        return {"error": f"/welcome answered {response.status_code}"}
+    status_url = app_url + response.json()["status_url"]
+    first_audio = None
+    while time.perf_counter() - started < JOB_TIMEOUT:
+        job = client.get(status_url).json()
+        if first_audio is None and (job.get("live_url")
+                                    or job["status"] == "done"):
+            first_audio = time.perf_counter() - started
+        if job["status"] == "done":
+            return {"first_audio": first_audio,
+                    "latency": time.perf_counter() - started}
+        if job["status"] == "failed":
+            return {"error": job["error"]}
+        time.sleep(POLL_SECONDS)
+    return {"error": "timed out"}
+
+
+def summary(values):
+    """
+    :return: Dictionary with the p50, p95 and p99 of the values, rounded
+    """
+    return {f"p{p}": round(percentile(values, p), 3) if values else None
+            for p in (50, 95, 99)}
+
+
+def previous_run(config):
+    """
+    :return: the last saved run with the same settings, or None
+    """
+    if not os.path.exists(RESULTS_PATH):
+        return None
+    last = None
+    with open(RESULTS_PATH, encoding="utf-8") as f:
+        for line in f:
+            run = json.loads(line)
+            if run["config"] == config:
+                last = run
+    return last
+
+
+def main():
+    args = parse_args()
+    config = {key: value for key, value in vars(args).items()
+              if key != "no_save"}
+    config["workers"] = args.workers or args.concurrency
+    fake_config = {key: config[key] for key in fake_providers.DEFAULT_CONFIG
+                   if key in config}
+    base_url = start_fake_providers(fake_config)
+    app_url = prepare_app(base_url, config["workers"], args.podcasts,
+                          args.engine)
+    from metrics import stage_seconds
+
+    clients = queue.Queue()   # a client is used by one thread at a time
+    for number in range(args.concurrency):
+        clients.put(login(app_url, number, args.provider))
+
+    def run(topic):
+        client = clients.get()
+        try:
+            return create_podcast(app_url, client, topic)
+        finally:
+            clients.put(client)
+
+    topics = [f"Benchmark topic {number} {time.time_ns()}"
+              for number in range(args.podcasts)]
+    print(f"Creating {args.podcasts} {args.provider} Podcasts, "
+          f"{args.concurrency} at a time, on commit {git_commit()}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        runs = list(pool.map(run, topics))
+    elapsed = time.perf_counter() - started
+
+    done = [run for run in runs if "error" not in run]
+    errors = [run["error"] for run in runs if "error" in run]
+    stages = {f"{stage}/{provider}": round(total / count, 3)
+              for (stage, provider), (total, count)
+              in sorted(stage_seconds.totals().items())}
+    results = {
+        "latency": summary([run["latency"] for run in done]),
+        "first_audio": summary([run["first_audio"] for run in done]),
+        "podcasts_per_minute": round(len(done) / elapsed * 60, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "failed": len(errors),
+        "stage_mean_seconds": stages,
+    }
+
+    print(f"\n{'':>12} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for name in ("latency", "first_audio"):
+        row = results[name]
+        print(f"{name:>12} " + " ".join(
+            f"{row[p]:>8.2f}" if row[p] is not None else f"{'-':>8}"
+            for p in ("p50", "p95", "p99")))
+    print(f"\nThroughput: {results['podcasts_per_minute']} Podcasts per "
+          f"minute, {len(done)} done, {len(errors)} failed in "
+          f"{elapsed:.1f}s")
+    print(f"Peak memory of the app: {results['peak_rss_mb']} MB")
+    print("Mean time per stage call: " + ", ".join(
+        f"{name} {seconds:.2f}s" for name, seconds in stages.items()))
+    for error in sorted(set(errors)):
+        print(f"Failed: {error}")
+
+    previous = previous_run(config)
+    if previous:
+        before, after = previous["results"], results
+        print(f"\nCompared with commit {previous['commit']} "
+              f"({previous['date']}):")
+        for name in ("latency", "first_audio"):
+            for p in ("p50", "p95"):
+                if before[name][p] and after[name][p]:
+                    change = after[name][p] / before[name][p] - 1
+                    print(f"  {name} {p}: {before[name][p]:.2f}s -> "
+                          f"{after[name][p]:.2f}s ({change:+.0%})")
+        print(f"  throughput: {before['podcasts_per_minute']} -> "
+              f"{after['podcasts_per_minute']} Podcasts per minute")
+        print(f"  peak memory: {before['peak_rss_mb']} -> "
+              f"{after['peak_rss_mb']} MB")
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "commit": git_commit(),
+                "date": datetime.now(timezone.utc).isoformat(
+                    timespec="seconds"),
+                "config": config, "results": results}) + "\n")
+        print(f"\nResults saved to {RESULTS_PATH}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
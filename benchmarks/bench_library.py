@@ -0,0 +1,101 @@
+"""
+Benchmark of the user library pages. Seeds a temporary database with
+users owning growing numbers of Podcasts (up to 10k each) and measures
+the render time of /welcome, /previous_podcasts and the infinite scroll
+endpoint, which must stay flat as libraries grow.
+
+Run from the repository root:
+    python benchmarks/bench_library.py [library sizes...]
+"""
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [100, 1000, 10000]
+REPEAT = 20
+
+workdir = tempfile.mkdtemp(prefix="mypodcast-bench-")
+atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+os.makedirs(os.path.join(workdir, "data"))
+os.chdir(workdir)   # the app keeps its database in ./data
+sys.path.insert(0, ROOT)
+for key in ("SECRET_KEY", "OPENAI_API_KEY", "GEMINI_API_KEY", "TAVILI_KEY"):
+    os.environ.setdefault(key, "benchmark")
+
+from sqlalchemy import insert
+import app as podcast_app
+from app import app, db, Podcast, podcasts_per_user, User
+
+
+def seed(sizes):
+    """
+    Creates one user per library size, owning that many Podcasts
+    :return: list of (size, username)
+    """
+    users = []
+    start = datetime(2025, 1, 1)
+    next_id = 1
+    for size in sizes:
+        username = f"user{size}"
+        user = User(username=username, password="-")
+        db.session.add(user)
+        db.session.flush()
+        rows = [{"id": next_id + i, "title": f"Topic {next_id + i}",
+                 "podcast_url": f"Topic {next_id + i}.mp3",
+                 "created_at": start + timedelta(minutes=next_id + i),
+                 "updated_at": start} for i in range(size)]
+        db.session.execute(insert(Podcast), rows)
+        db.session.execute(insert(podcasts_per_user), [
+            {"user_id": user.id, "podcast_id": row["id"],
+             "created_at": row["created_at"]} for row in rows])
+        next_id += size
+        users.append((size, username))
+    db.session.commit()
+    return users
+
+
+def timed(client, url):
+    """
+    :return: median milliseconds of REPEAT requests, and the last response
+    """
+    times = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        response = client.get(url)
+        times.append((time.perf_counter() - started) * 1000)
+    assert response.status_code == 200, response.status_code
+    return statistics.median(times), response
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or DEFAULT_SIZES
+    with app.app_context():
+        podcast_app.init_db()
+        users = seed(sizes)
+    print(f"{'podcasts':>8} {'/welcome ms':>12} {'/previous ms':>13} "
+          f"{'scroll page ms':>15}")
+    results = []
+    for size, username in users:
+        client = app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['username'] = username
+        welcome, _ = timed(client, "/welcome")
+        previous, _ = timed(client, "/previous_podcasts")
+        first_page = client.get("/api/podcasts").get_json()
+        cursor = first_page["next_cursor"] or ""
+        scroll, _ = timed(client, f"/api/podcasts?cursor={cursor}")
+        results.append(previous)
+        print(f"{size:>8} {welcome:>12.2f} {previous:>13.2f} {scroll:>15.2f}")
+    growth = results[-1] / results[0]
+    print(f"/previous_podcasts slowdown from {sizes[0]} to {sizes[-1]} "
+          f"Podcasts: x{growth:.2f} ({'flat' if growth < 2 else 'NOT flat'})")
+
+
+if __name__ == "__main__":
+    main()
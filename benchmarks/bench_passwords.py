@@ -0,0 +1,152 @@
+"""
+Benchmark of the password hashing of /login. Measures the scrypt checks
+per second of one core, then logs in from concurrent clients through the
+app, with the hashing in the request threads and in the process pool of
+passwords.py, while another client measures the latency of a light page
+(/about) served meanwhile.
+
+Run from the repository root:
+    python benchmarks/bench_passwords.py [--logins 64] [--concurrency 16]
+        [--workers 4] [--queue 8]
+"""
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the password hashing of /login")
+    parser.add_argument("--logins", type=int, default=64,
+                        help="logins per configuration")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="clients logging in at the same time")
+    parser.add_argument("--workers", type=int,
+                        default=os.cpu_count() or 1,
+                        help="processes of the password pool")
+    parser.add_argument("--queue", type=int, default=8,
+                        help="queue of the load shedding configuration")
+    return parser.parse_args()
+
+
+def prepare_app():
+    """
+    Imports the app in a temporary working directory, with one user
+    :return: the app module
+    """
+    workdir = tempfile.mkdtemp(prefix="mypodcast-bench-")
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, "data"))
+    os.chdir(workdir)   # the app keeps its database in ./data
+    for key in ("SECRET_KEY", "OPENAI_API_KEY", "GEMINI_API_KEY",
+                "TAVILI_KEY"):
+        os.environ.setdefault(key, "benchmark")
+    import app as podcast_app
+    with podcast_app.app.app_context():
+        podcast_app.init_db()
+    client = podcast_app.app.test_client()
+    client.post("/register", data={"username": "bench",
+                                   "password": "benchmark"})
+    return podcast_app
+
+
+def checks_per_second(password_hash, seconds=2.0):
+    """
+    :return: the scrypt checks per second of this thread, one core
+    """
+    from werkzeug.security import check_password_hash
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        check_password_hash(password_hash, "benchmark")
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def login_burst(podcast_app, hasher, logins, concurrency):
+    """
+    Logs in from concurrent clients with the hasher, while another client
+    loads /about
+    :return: Dictionary with the logins per second, the refused logins and
+    the latency of /about
+    """
+    podcast_app.hasher = hasher
+    hasher.check(podcast_app.User.query.first().password, "warm up")
+    done = threading.Event()
+    page_seconds = []
+
+    def load_page():
+        client = podcast_app.app.test_client()
+        while not done.is_set():
+            started = time.perf_counter()
+            client.get("/about")
+            page_seconds.append(time.perf_counter() - started)
+            time.sleep(0.01)
+
+    def login(number):
+        response = podcast_app.app.test_client().post(
+            "/login", data={"username": "bench", "password": "benchmark"})
+        return response.status_code
+
+    pages = threading.Thread(target=load_page)
+    pages.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        statuses = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    pages.join()
+    accepted = statuses.count(302)
+    page_seconds.sort()
+    return {
+        "logins_per_second": accepted / elapsed,
+        "refused": statuses.count(503),
+        "page_p50": statistics.median(page_seconds),
+        "page_p95": page_seconds[int(0.95 * (len(page_seconds) - 1))],
+    }
+
+
+def main():
+    args = parse_args()
+    podcast_app = prepare_app()
+    from passwords import PasswordHasher
+    cores = os.cpu_count() or 1
+    with podcast_app.app.app_context():
+        password_hash = podcast_app.User.query.first().password
+        single = checks_per_second(password_hash)
+        print(f"{password_hash.split('$')[0]}: {single:.1f} checks per "
+              f"second on one core, {cores} cores")
+        configurations = [
+            ("request threads", PasswordHasher(0, args.logins), cores),
+            (f"pool of {args.workers}",
+             PasswordHasher(args.workers, args.logins),
+             min(args.workers, cores)),
+            (f"pool of {args.workers}, queue {args.queue}",
+             PasswordHasher(args.workers, args.queue),
+             min(args.workers, cores)),
+        ]
+        print(f"\n{args.logins} logins, {args.concurrency} at a time")
+        print(f"{'':>24} {'logins/s':>9} {'per core':>9} {'refused':>8} "
+              f"{'/about p50':>11} {'p95':>8}")
+        for name, hasher, used_cores in configurations:
+            result = login_burst(podcast_app, hasher, args.logins,
+                                 args.concurrency)
+            print(f"{name:>24} {result['logins_per_second']:>9.1f} "
+                  f"{result['logins_per_second'] / used_cores:>9.1f} "
+                  f"{result['refused']:>8} "
+                  f"{result['page_p50'] * 1000:>9.1f}ms "
+                  f"{result['page_p95'] * 1000:>6.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
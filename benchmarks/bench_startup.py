@@ -0,0 +1,94 @@
+"""
+Benchmark of the worker cold start: the time and peak memory of importing
+the app in a fresh process, with the provider modules loaded lazily (the
+default) and preloaded (PRELOAD_PROVIDERS=1), and the slowest modules of
+the import, from python -X importtime. With lazy providers, importing the
+app must not load pydub, which only the audio assembly needs.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 5
+SLOWEST = 10
+MEASURE = """
+import resource, sys, time
+started = time.perf_counter()
+import app
+seconds = time.perf_counter() - started
+scale = 1 if sys.platform == "darwin" else 1024
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+      "pydub" in sys.modules)
+"""
+
+
+def run(code, env, args=()):
+    """
+    Runs the code in a fresh interpreter, in a temporary working directory
+    :return: the completed process
+    """
+    with tempfile.TemporaryDirectory(prefix="mypodcast-bench-") as workdir:
+        os.makedirs(os.path.join(workdir, "data"))
+        return subprocess.run(
+            [sys.executable, *args, "-c", code], cwd=workdir,
+            env=dict(os.environ, PYTHONPATH=ROOT, **env),
+            capture_output=True, text=True, check=True)
+
+
+def measure(env, runs):
+    """
+    :return: median seconds and median peak MB of importing the app, and
+    whether the import loaded pydub
+    """
+    times = []
+    peaks = []
+    pydub_loaded = False
+    for _ in range(runs):
+        seconds, peak, pydub = run(MEASURE, env).stdout.split()[-3:]
+        times.append(float(seconds))
+        peaks.append(int(peak) / 2 ** 20)
+        pydub_loaded = pydub_loaded or pydub == "True"
+    return statistics.median(times), statistics.median(peaks), pydub_loaded
+
+
+def slowest_imports(env):
+    """
+    :return: list of (cumulative seconds, module) of the slowest top-level
+    imports of the app
+    """
+    lines = run("import app", env, ["-X", "importtime"]).stderr.splitlines()
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and name.startswith("   ") and \
+                not name.startswith("    "):   # imported by app itself
+            modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)[:SLOWEST]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    env = {key: "benchmark" for key in
+           ("SECRET_KEY", "OPENAI_API_KEY", "GEMINI_API_KEY", "TAVILI_KEY")}
+    print(f"{'providers':>10} {'import s':>9} {'peak MB':>8}")
+    for name, preload in (("lazy", "0"), ("preloaded", "1")):
+        seconds, peak, pydub_loaded = measure(
+            dict(env, PRELOAD_PROVIDERS=preload), runs)
+        print(f"{name:>10} {seconds:>9.2f} {peak:>8.1f}")
+        if preload == "0":
+            assert not pydub_loaded, "importing the app loaded pydub"
+    print("\nSlowest imports of app.py, lazy providers:")
+    for seconds, module in slowest_imports(dict(env, PRELOAD_PROVIDERS="0")):
+        print(f"{seconds:>9.3f}s {module}")
+
+
+if __name__ == "__main__":
+    main()
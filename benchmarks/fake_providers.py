@@ -0,0 +1,304 @@
+"""
+Local stand-ins for the OpenAI chat and TTS, Gemini generate_content and
+Tavily search APIs, with configurable latency and payload sizes. The app
+talks to them through OPENAI_BASE_URL, GEMINI_BASE_URL and
+TAVILY_BASE_URL, so the whole generation path runs without metered calls.
+
+Used by bench_generation.py, or on its own to try the app by hand:
+    python benchmarks/fake_providers.py [--port 8900] [--tts-latency 0.5]
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 \\
+    GEMINI_BASE_URL=http://127.0.0.1:8900 \\
+    TAVILY_BASE_URL=http://127.0.0.1:8900 python app.py
+"""
+import argparse
+import base64
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pydub.generators import Sine
+from audio import mp3_frames, TARGET_CHANNELS, TARGET_SAMPLE_RATE
+
+# Default behaviour of the fake providers, every key is a command line option
+DEFAULT_CONFIG = {
+    "hosts": ["George", "Doris"],   # speakers of the scripts
+    "turns": 12,                # dialogue turns of a script
+    "words_per_turn": 27,       # about 320 words per script
+    "chat_latency": 0.5,        # seconds before the first script token
+    "chat_tokens_per_second": 100.0,
+    "tts_latency": 0.3,         # seconds before the audio of a TTS call
+    "tts_realtime_factor": 0.1,  # synthesis seconds per second of audio
+    "speech_words_per_second": 2.5,
+    "tts_empty_rate": 0.0,      # share of Gemini TTS answers without audio
+    "search_latency": 0.8,
+    "news_words": 80,           # words of the Tavily answer
+}
+TOKENS_PER_EVENT = 8   # script tokens sent per streamed event
+WORDS = ("market", "rover", "signal", "ocean", "city", "future", "energy",
+         "science", "music", "history", "planet", "policy", "health")
+_counter = itertools.count()
+
+
+def script_words(count):
+    """
+    Text that differs on every call, so that no cache can answer for the
+    fake providers
+    """
+    start = next(_counter) * 7
+    return " ".join(WORDS[(start + i) % len(WORDS)] for i in range(count)) \
+        + f" {start}."
+
+
+@lru_cache(maxsize=None)
+def mp3_second_frames():
+    """
+    :return: the MP3 frames of one second of audio, in the format of the
+    OpenAI TTS output
+    """
+    buffer = io.BytesIO()
+    Sine(440).to_audio_segment(duration=1000, volume=-30).set_frame_rate(
+        TARGET_SAMPLE_RATE).set_channels(TARGET_CHANNELS).export(
+        buffer, format="mp3", bitrate="64k")
+    data = buffer.getvalue()
+    return [data[frame.start:frame.end] for frame in mp3_frames(data)]
+
+
+@lru_cache(maxsize=None)
+def pcm_second():
+    """
+    :return: one second of the same audio, as raw 24 kHz 16 bit PCM
+    """
+    return Sine(440).to_audio_segment(duration=1000, volume=-30) \
+        .set_frame_rate(TARGET_SAMPLE_RATE).set_channels(TARGET_CHANNELS) \
+        .set_sample_width(2).raw_data
+
+
+def pcm_audio(seconds):
+    """
+    :return: raw PCM audio of this many seconds
+    """
+    data = pcm_second()
+    size = int(seconds * TARGET_SAMPLE_RATE) * 2
+    return (data * math.ceil(size / len(data)))[:size]
+
+
+def mp3_audio(seconds):
+    """
+    :return: MP3 audio of about this many seconds
+    """
+    frames = mp3_second_frames()
+    count = math.ceil(seconds * TARGET_SAMPLE_RATE / 576)
+    return b"".join(itertools.islice(itertools.cycle(frames), count))
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = DEFAULT_CONFIG
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self.openai_chat()
+        elif path.endswith("/audio/speech"):
+            self.openai_speech(body)
+        elif path.endswith(":streamGenerateContent"):
+            self.gemini_stream()
+        elif path.endswith(":generateContent"):
+            self.gemini_speech(body)
+        elif path.endswith("/search"):
+            self.tavily_search()
+        else:
+            self.send_json(404, {"error": {"message": f"no route {path}"}})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, payload):
+        data = f"data: {payload}\n\n".encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_events(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+    def stream_text(self, text, event):
+        """
+        Streams the text at the configured tokens per second, about 4
+        characters per token
+        :param event: function(piece) that builds the event of a piece
+        """
+        time.sleep(self.config["chat_latency"])
+        step = TOKENS_PER_EVENT * 4
+        delay = TOKENS_PER_EVENT / self.config["chat_tokens_per_second"]
+        for start in range(0, len(text), step):
+            self.send_event(event(text[start:start + step]))
+            time.sleep(delay)
+
+    def script_turns(self):
+        hosts = self.config["hosts"]
+        return [{"speaker": hosts[i % len(hosts)],
+                 "text": script_words(self.config["words_per_turn"])}
+                for i in range(self.config["turns"])]
+
+    def openai_chat(self):
+        script = json.dumps({"turns": self.script_turns()})
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                 "created": int(time.time()), "model": "gpt-4o-mini"}
+
+        def event(piece):
+            return json.dumps(dict(chunk, choices=[{
+                "index": 0, "delta": {"content": piece},
+                "finish_reason": None}]))
+
+        self.start_events()
+        self.stream_text(script, event)
+        self.send_event(json.dumps(dict(chunk, choices=[{
+            "index": 0, "delta": {}, "finish_reason": "stop"}])))
+        completion_tokens = len(script) // 4
+        self.send_event(json.dumps(dict(chunk, choices=[], usage={
+            "prompt_tokens": 400, "completion_tokens": completion_tokens,
+            "total_tokens": 400 + completion_tokens})))
+        self.send_event("[DONE]")
+        self.end_events()
+
+    def speech_seconds(self, text):
+        """
+        :return: seconds of audio of the text, and seconds to synthesize it
+        """
+        seconds = len(text.split()) / self.config["speech_words_per_second"]
+        return seconds, (self.config["tts_latency"]
+                         + seconds * self.config["tts_realtime_factor"])
+
+    def openai_speech(self, body):
+        seconds, delay = self.speech_seconds(body.get("input", ""))
+        time.sleep(delay)
+        pcm = body.get("response_format") == "pcm"
+        data = pcm_audio(seconds) if pcm else mp3_audio(seconds)
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/pcm" if pcm else "audio/mpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def gemini_stream(self):
+        script = "".join(f"{turn['speaker']}: {turn['text']}\n"
+                         for turn in self.script_turns())
+
+        def event(piece):
+            return json.dumps({"candidates": [{"content": {
+                "role": "model", "parts": [{"text": piece}]}}]})
+
+        self.start_events()
+        self.stream_text(script, event)
+        self.send_event(json.dumps({
+            "candidates": [{"content": {"role": "model", "parts": [
+                {"text": ""}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 400,
+                              "candidatesTokenCount": len(script) // 4,
+                              "totalTokenCount": 400 + len(script) // 4}}))
+        self.end_events()
+
+    def gemini_speech(self, body):
+        text = " ".join(part.get("text", "")
+                        for content in body.get("contents", [])
+                        for part in content.get("parts", []))
+        seconds, delay = self.speech_seconds(text)
+        time.sleep(delay)
+        if random.random() < self.config["tts_empty_rate"]:
+            self.send_json(200, {"candidates": [{"finishReason": "OTHER"}]})
+            return
+        pcm = pcm_audio(seconds)
+        self.send_json(200, {
+            "candidates": [{"content": {"role": "model", "parts": [
+                {"inlineData": {
+                    "mimeType": "audio/L16;codec=pcm;rate=24000",
+                    "data": base64.b64encode(pcm).decode()}}]}}],
+            "usageMetadata": {"promptTokenCount": len(text) // 4,
+                              "candidatesTokenCount": int(seconds * 25),
+                              "totalTokenCount": len(text) // 4
+                              + int(seconds * 25)}})
+
+    def tavily_search(self):
+        time.sleep(self.config["search_latency"])
+        self.send_json(200, {"answer": script_words(
+            self.config["news_words"]), "results": []})
+
+
+def start(config=None, port=0):
+    """
+    Starts the fake providers in a background thread
+    :param config: Dictionary that overrides DEFAULT_CONFIG
+    :param port: the port to listen on, 0 for any free port
+    :return: the server, server.server_port is its port
+    """
+    handler = type("Handler", (FakeProviderHandler,), {
+        "config": dict(DEFAULT_CONFIG, **(config or {}))})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(config, ports):
+    """
+    Runs the fake providers in a child process, see bench_generation.py
+    :param config: Dictionary that overrides DEFAULT_CONFIG
+    :param ports: multiprocessing queue that receives the port
+    """
+    server = start(config)
+    ports.put(server.server_port)
+    threading.Event().wait()
+
+
+def add_arguments(parser):
+    """
+    Adds an option for each key of DEFAULT_CONFIG
+    """
+    for key, value in DEFAULT_CONFIG.items():
+        if isinstance(value, list):
+            continue
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value),
+                            default=value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fake OpenAI, Gemini and Tavily APIs")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    port = args.pop("port")
+    start(args, port)
+    print(f"Fake providers listening on http://127.0.0.1:{port}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
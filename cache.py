@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+# SQLite file shared by the caches of all the worker processes
+CACHE_DB = os.getenv("CACHE_DB", os.path.join(os.getcwd(), "data",
+                                              "cache.db"))
+# Synthesized TTS clips, and the total size they may take on disk
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(os.getcwd(), "data",
+                                                        "tts_cache"))
+TTS_CACHE_BYTES = int(os.getenv("TTS_CACHE_BYTES", str(512 * 2 ** 20)))
+
+
+def normalize_topic(topic):
+    """
+    Reduces a Podcast topic to a canonical form, so that trivial variants
+    (case, punctuation, extra whitespace, word order) compare equal
+    :param topic: Podcast topic
+    :return: the normalized topic
+    """
+    return " ".join(sorted(re.findall(r"\w+", topic.casefold())))
+
+
+class SQLiteStore:
+    """
+    Base of the caches that keep their data or their index in SQLite: one
+    connection per thread and persisted hit/miss counters
+    """
+    def __init__(self, name, path=CACHE_DB):
+        self.name = name
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache_stats (
+                name TEXT PRIMARY KEY, hits INTEGER NOT NULL,
+                misses INTEGER NOT NULL)""")
+            conn.execute("INSERT OR IGNORE INTO cache_stats VALUES (?, 0, 0)",
+                         (name,))
+
+    def _connect(self):
+        """
+        :return: the SQLite connection of the current thread
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, conn, column):
+        conn.execute(f"UPDATE cache_stats SET {column} = {column} + 1 "
+                     f"WHERE name = ?", (self.name,))
+
+    def _counters(self, conn):
+        hits, misses = conn.execute(
+            "SELECT hits, misses FROM cache_stats WHERE name = ?",
+            (self.name,)).fetchone()
+        lookups = hits + misses
+        return {"hits": hits, "misses": misses,
+                "hit_rate": hits / lookups if lookups else 0.0}
+
+
+class SQLiteCache(SQLiteStore):
+    """
+    Key-value cache stored in SQLite, so that it survives restarts and is
+    shared by all the worker processes. Entries expire after ttl seconds
+    and the least recently used ones are evicted beyond max_entries.
+    Values must be JSON serializable.
+    """
+    def __init__(self, name, ttl, max_entries, path=CACHE_DB):
+        super().__init__(name, path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._table = f"cache_{name}"
+        with self._connect() as conn:
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {self._table} (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                stored_at REAL NOT NULL, used_at REAL NOT NULL)""")
+            conn.execute(f"""CREATE INDEX IF NOT EXISTS
+                ix_{self._table}_used_at ON {self._table} (used_at)""")
+
+    def get(self, key):
+        """
+        :param key: the cache key
+        :return: the cached value, or None if missing or expired
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT value, stored_at FROM {self._table} "
+                               f"WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                conn.execute(f"UPDATE {self._table} SET used_at = ? "
+                             f"WHERE key = ?", (now, key))
+                self._count(conn, "hits")
+                return json.loads(row[0])
+            if row:
+                conn.execute(f"DELETE FROM {self._table} WHERE key = ?",
+                             (key,))
+            self._count(conn, "misses")
+        return None
+
+    def set(self, key, value):
+        """
+        Stores a value, then evicts the expired and least recently used
+        entries
+        :param key: the cache key
+        :param value: the value to store
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self._table} "
+                         f"VALUES (?, ?, ?, ?)",
+                         (key, json.dumps(value), now, now))
+            conn.execute(f"DELETE FROM {self._table} WHERE stored_at < ?",
+                         (now - self.ttl,))
+            conn.execute(f"""DELETE FROM {self._table} WHERE key IN (
+                SELECT key FROM {self._table} ORDER BY used_at DESC
+                LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def stats(self):
+        """
+        :return: Dictionary with the hits, misses, hit rate and number of
+        entries of the cache
+        """
+        with self._connect() as conn:
+            stats = self._counters(conn)
+            stats["entries"] = conn.execute(
+                f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+        stats.update(ttl=self.ttl, max_entries=self.max_entries)
+        return stats
+
+
+class ClipCache(SQLiteStore):
+    """
+    On-disk cache of synthesized audio clips, addressed by a hash of
+    everything that determines the audio. The clips are files, written
+    atomically, and their sizes and last use are indexed in SQLite, so
+    several processes can share the cache. The least recently used clips
+    are evicted when the total size goes over max_bytes.
+    """
+    def __init__(self, folder, max_bytes, path=CACHE_DB):
+        super().__init__("tts", path)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS tts_clips (
+                key TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                used_at REAL NOT NULL)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS ix_tts_clips_used_at
+                ON tts_clips (used_at)""")
+
+    @staticmethod
+    def key(provider, model, voice, instructions, text):
+        """
+        :return: the cache key of a clip, a SHA-256 hex digest
+        """
+        material = json.dumps([provider, model, voice, instructions, text])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        """
+        :param key: the clip key
+        :return: the audio bytes, or None if the clip is not cached
+        """
+        try:
+            with open(self._file(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+        with self._connect() as conn:
+            if data is None:
+                conn.execute("DELETE FROM tts_clips WHERE key = ?", (key,))
+                self._count(conn, "misses")
+            else:
+                conn.execute("UPDATE tts_clips SET used_at = ? WHERE key = ?",
+                             (time.time(), key))
+                self._count(conn, "hits")
+        return data
+
+    def put(self, key, data):
+        """
+        Stores a clip, then evicts the least recently used clips while the
+        cache is over its size budget
+        :param key: the clip key
+        :param data: the audio bytes
+        """
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(part, "wb") as f:
+            f.write(data)
+        os.replace(part, path)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO tts_clips VALUES (?, ?, ?)",
+                         (key, len(data), time.time()))
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tts_clips").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for old_key, size in conn.execute(
+                    "SELECT key, size FROM tts_clips ORDER BY used_at"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM tts_clips WHERE key = ?",
+                             (old_key,))
+                try:
+                    os.remove(self._file(old_key))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        """
+        :return: Dictionary with the hits, misses, hit rate, number of
+        clips and total size of the cache
+        """
+        with self._connect() as conn:
+            stats = self._counters(conn)
+            stats["entries"], stats["bytes"] = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tts_clips"
+            ).fetchone()
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+clip_cache = ClipCache(TTS_CACHE_DIR, TTS_CACHE_BYTES)
@@ -0,0 +1,438 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import wraps
+from dotenv import load_dotenv
+from ratelimit import rate_limits
+from metrics import provider_calls_total
+
+load_dotenv()
+# Base URLs of the provider APIs, e.g. local stub servers; unset for the
+# real APIs
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") or None
+TAVILY_BASE_URL = os.getenv("TAVILY_BASE_URL") or None
+# Keep-alive connections kept open to each provider
+PROVIDER_CONNECTIONS = int(os.getenv("PROVIDER_CONNECTIONS", "20"))
+# Seconds a whole provider call may take, retries included
+SCRIPT_DEADLINE = float(os.getenv("SCRIPT_DEADLINE", "120"))
+TTS_DEADLINE = float(os.getenv("TTS_DEADLINE", "90"))
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "20"))
+# How many times a failed call is repeated before giving up
+PROVIDER_RETRIES = int(os.getenv("PROVIDER_RETRIES", "2"))
+TTS_RETRIES = int(os.getenv("TTS_RETRIES", "2"))
+# Consecutive failures that open the circuit breaker of a provider, and
+# seconds before a trial call is let through again
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+# Seconds after which a slow TTS call is sent a second time, and the
+# first answer used; 0 for no hedged requests
+TTS_HEDGE_SECONDS = float(os.getenv("TTS_HEDGE_SECONDS", "0"))
+# The AI provider that creates the Podcast when the chosen one is down
+FALLBACK_PROVIDER = {"OpenAI": "Gemini", "Gemini": "OpenAI"}
+
+# Transport errors worth a retry, per module. The provider SDKs are only
+# imported by the client functions below, on first use
+RETRYABLE_ERRORS = {
+    "httpx": ("TransportError",),
+    "requests": ("ConnectionError", "Timeout"),
+    "openai": ("APIConnectionError",),
+    "tavily.errors": ("TimeoutError",),
+}
+
+_hedge_pool = ThreadPoolExecutor(max_workers=16,
+                                 thread_name_prefix="hedged-call")
+# The async clients of each event loop, their connections belong to it
+_loop_clients = weakref.WeakKeyDictionary()
+
+
+class ProviderUnavailable(Exception):
+    """
+    Raised when a provider is not called because its circuit breaker is
+    open, or because the deadline of the call has passed
+    """
+
+
+class IncompleteResponse(Exception):
+    """
+    Raised by a request when the provider answered without the expected
+    content, e.g. a TTS response without audio. Worth a retry
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after a number of consecutive failed calls, so
+    that requests fail fast, or fall back to another provider, instead of
+    waiting for timeouts. After reset_seconds a single trial call is let
+    through: its success closes the breaker, its failure opens it again.
+    """
+    def __init__(self, name, failures=BREAKER_FAILURES,
+                 reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"   # closed -> open -> half-open -> closed
+        self._failed = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if a call may be made now
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if (self.state == "open" and time.monotonic() - self._opened_at
+                    >= self.reset_seconds):
+                self.state = "half-open"   # this call is the trial
+                return True
+            return False
+
+    def is_open(self):
+        """
+        :return: True if calls are refused right now
+        """
+        with self._lock:
+            return self.state == "half-open" or (
+                self.state == "open" and time.monotonic() - self._opened_at
+                < self.reset_seconds)
+
+    def record(self, success):
+        """
+        Records the outcome of a call
+        :param success: False if the provider failed
+        """
+        with self._lock:
+            if success:
+                self.state = "closed"
+                self._failed = 0
+                return
+            self._failed += 1
+            if self.state == "half-open" or self._failed >= self.failures:
+                if self.state != "open":
+                    print(f"{self.name} circuit breaker open")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+breakers = {provider: CircuitBreaker(provider) for provider in rate_limits}
+
+
+def is_retryable(error):
+    """
+    Tells the provider failures, worth a retry, from the errors of the
+    request itself, e.g. a bad request or a wrong API key
+    :param error: the exception raised by the provider call
+    :return: True if the call may succeed if repeated
+    """
+    status = getattr(error, "status_code", None)
+    genai_errors = sys.modules.get("google.genai.errors")
+    if (status is None and genai_errors
+            and isinstance(error, genai_errors.APIError)):
+        status = error.code
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 429) or status >= 500
+    # an error can only come from a module that was imported
+    retryable = [TimeoutError, ConnectionError, IncompleteResponse]
+    for module_name, names in RETRYABLE_ERRORS.items():
+        module = sys.modules.get(module_name)
+        if module:
+            retryable.extend(getattr(module, name) for name in names)
+    return isinstance(error, tuple(retryable))
+
+
+def _attempt(provider, request, end, tokens, hedge_after):
+    """
+    Makes one attempt of a call, sending a second, hedged, request if the
+    first one is slower than hedge_after seconds
+    :return: the result of the first request that succeeds
+    """
+    rate_limits[provider].acquire(tokens)
+    timeout = end - time.monotonic()
+    if timeout <= 0:
+        raise ProviderUnavailable(f"{provider} call deadline exceeded")
+    if not hedge_after or hedge_after >= timeout:
+        return request(timeout)
+    pending = {_hedge_pool.submit(request, timeout)}
+    done, _ = wait(pending, timeout=hedge_after)
+    if not done:
+        rate_limits[provider].acquire(tokens)
+        pending.add(_hedge_pool.submit(request, end - time.monotonic()))
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0, end - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            raise ProviderUnavailable(f"{provider} call deadline exceeded")
+        for future in done:
+            if future.exception() is None:
+                return future.result()   # the slower one is left to finish
+            error = future.exception()
+    raise error
+
+
+def call(provider, request, deadline, retries=PROVIDER_RETRIES, tokens=0,
+         hedge_after=0):
+    """
+    Calls a provider API through its circuit breaker and rate limits.
+    Failed attempts are repeated with jittered exponential backoff, as long
+    as the deadline of the call allows
+    :param provider: the provider, a key of breakers
+    :param request: function(timeout) that makes one attempt, timeout being
+    the seconds left until the deadline
+    :param deadline: seconds that the whole call may take
+    :param retries: how many times to repeat a failed attempt
+    :param tokens: the estimated tokens of one attempt, for the rate limits
+    :param hedge_after: seconds after which a slow attempt is sent again,
+    0 for none. Only for requests that can safely be made twice
+    :return: the result of request()
+    """
+    breaker = breakers[provider]
+    end = time.monotonic() + deadline
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            provider_calls_total.inc(provider=provider, outcome="rejected")
+            raise ProviderUnavailable(f"{provider} is unavailable right now")
+        try:
+            result = _attempt(provider, request, end, tokens, hedge_after)
+        except Exception as e:
+            retryable = is_retryable(e) or isinstance(e, ProviderUnavailable)
+            breaker.record(not retryable)
+            remaining = end - time.monotonic()
+            if not retryable or attempt == retries or remaining <= 0:
+                provider_calls_total.inc(provider=provider, outcome="failed")
+                raise
+            provider_calls_total.inc(provider=provider, outcome="retried")
+            delay = min(2 ** attempt * random.uniform(0.5, 1.0), remaining)
+            print(f"{provider} attempt {attempt + 1} failed ({e}), "
+                  f"retrying in {delay:.1f}s")
+            time.sleep(delay)
+        else:
+            breaker.record(True)
+            provider_calls_total.inc(provider=provider, outcome="ok")
+            return result
+
+
+async def _attempt_async(provider, request, end, tokens, hedge_after):
+    """
+    Like _attempt(), for an async request
+    :return: the result of the first request that succeeds
+    """
+    await rate_limits[provider].acquire_async(tokens)
+    timeout = end - time.monotonic()
+    if timeout <= 0:
+        raise ProviderUnavailable(f"{provider} call deadline exceeded")
+    pending = {asyncio.ensure_future(request(timeout))}
+    if hedge_after and hedge_after < timeout:
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if not done:
+            await rate_limits[provider].acquire_async(tokens)
+            pending.add(asyncio.ensure_future(
+                request(end - time.monotonic())))
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0, end - time.monotonic()),
+                return_when=FIRST_COMPLETED)
+            if not done:
+                raise ProviderUnavailable(
+                    f"{provider} call deadline exceeded")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:   # unlike threads, the slower request can be cancelled
+        for future in pending:
+            future.cancel()
+
+
+async def call_async(provider, request, deadline, retries=PROVIDER_RETRIES,
+                     tokens=0, hedge_after=0):
+    """
+    Like call(), for the async generation engine: waiting for the rate
+    limits, the backoff and the hedged requests never blocks the event loop
+    :param provider: the provider, a key of breakers
+    :param request: async function(timeout) that makes one attempt
+    :param deadline: seconds that the whole call may take
+    :param retries: how many times to repeat a failed attempt
+    :param tokens: the estimated tokens of one attempt, for the rate limits
+    :param hedge_after: seconds after which a slow attempt is sent again,
+    0 for none
+    :return: the result of request()
+    """
+    breaker = breakers[provider]
+    end = time.monotonic() + deadline
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            provider_calls_total.inc(provider=provider, outcome="rejected")
+            raise ProviderUnavailable(f"{provider} is unavailable right now")
+        try:
+            result = await _attempt_async(provider, request, end, tokens,
+                                          hedge_after)
+        except Exception as e:
+            retryable = is_retryable(e) or isinstance(e, ProviderUnavailable)
+            breaker.record(not retryable)
+            remaining = end - time.monotonic()
+            if not retryable or attempt == retries or remaining <= 0:
+                provider_calls_total.inc(provider=provider, outcome="failed")
+                raise
+            provider_calls_total.inc(provider=provider, outcome="retried")
+            delay = min(2 ** attempt * random.uniform(0.5, 1.0), remaining)
+            print(f"{provider} attempt {attempt + 1} failed ({e}), "
+                  f"retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record(True)
+            provider_calls_total.inc(provider=provider, outcome="ok")
+            return result
+
+
+def choose_provider(preferred):
+    """
+    Picks the AI provider that creates a Podcast
+    :param preferred: the provider of the Podcast settings
+    :return: the preferred provider, or the fallback one if the circuit
+    breaker of the preferred provider is open and its own is not
+    """
+    fallback = FALLBACK_PROVIDER[preferred]
+    if breakers[preferred].is_open() and not breakers[fallback].is_open():
+        return fallback
+    return preferred
+
+
+def _process_client(create):
+    """
+    Caches the client that create() returns for the whole process. Unlike
+    lru_cache, it never creates two when the first Podcasts start at the
+    same time: the client of the losing thread would be garbage collected
+    while in use, and close its connections
+    """
+    client = None
+    lock = threading.Lock()
+
+    @wraps(create)
+    def get():
+        nonlocal client
+        if client is None:
+            with lock:
+                if client is None:
+                    client = create()
+        return client
+    return get
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(max_connections=PROVIDER_CONNECTIONS,
+                        max_keepalive_connections=PROVIDER_CONNECTIONS)
+
+
+@_process_client
+def openai_client():
+    """
+    :return: the OpenAI client of the process, with pooled keep-alive
+    connections. Retries are made by call(), not by the client
+    """
+    import httpx
+    import openai
+    return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                         base_url=OPENAI_BASE_URL, max_retries=0,
+                         http_client=httpx.Client(limits=_limits()))
+
+
+@_process_client
+def gemini_client():
+    """
+    :return: the Gemini client of the process, with pooled keep-alive
+    connections
+    """
+    from google import genai
+    from google.genai import types
+    return genai.Client(api_key=os.getenv("GEMINI_API_KEY"),
+                        http_options=types.HttpOptions(
+                            base_url=GEMINI_BASE_URL,
+                            client_args={"limits": _limits()}))
+
+
+@_process_client
+def tavily_client():
+    """
+    :return: the Tavily client of the process, with pooled keep-alive
+    connections
+    """
+    import requests
+    from tavily import TavilyClient
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=PROVIDER_CONNECTIONS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return TavilyClient(os.getenv("TAVILI_KEY"), api_base_url=TAVILY_BASE_URL,
+                        session=session)
+
+
+def _loop_client(name, create):
+    """
+    Caches an async client per event loop: the connections of an async
+    client can only be used by the loop that opened them
+    :param name: the client name
+    :param create: function that creates the client
+    :return: the client of the running loop
+    """
+    clients = _loop_clients.setdefault(asyncio.get_running_loop(), {})
+    if name not in clients:
+        clients[name] = create()
+    return clients[name]
+
+
+def openai_async_client():
+    """
+    :return: the async OpenAI client of the running event loop
+    """
+    def create():
+        import httpx
+        import openai
+        return openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_BASE_URL,
+            max_retries=0, http_client=httpx.AsyncClient(limits=_limits()))
+    return _loop_client("OpenAI", create)
+
+
+def gemini_async_client():
+    """
+    :return: the async Gemini client of the running event loop, the aio
+    side of a genai.Client
+    """
+    def create():
+        from google import genai
+        from google.genai import types
+        return genai.Client(api_key=os.getenv("GEMINI_API_KEY"),
+                            http_options=types.HttpOptions(
+                                base_url=GEMINI_BASE_URL,
+                                async_client_args={"limits": _limits()}))
+    # the genai.Client is kept, it closes its connections when collected
+    return _loop_client("Gemini", create).aio
+
+
+def tavily_async_client():
+    """
+    :return: the async Tavily client of the running event loop
+    """
+    def create():
+        import httpx
+        from tavily import AsyncTavilyClient
+        return AsyncTavilyClient(os.getenv("TAVILI_KEY"),
+                                 api_base_url=TAVILY_BASE_URL,
+                                 client=httpx.AsyncClient(limits=_limits()))
+    return _loop_client("Tavily", create)
@@ -1,48 +1,50 @@
+import asyncio
+import itertools
 import os
-from google import genai
+import re
+import time
 from google.genai import types
 from dotenv import load_dotenv
-import wave
-from open_ai import clean_path
-from tavili import tavili_answer
-
-def wave_file(filename, pcm, channels=1, rate=24000, sample_width=2):
-   """
-   Set up the wave file to save the output
-   :param filename: the path to save the audio file
-   :param pcm: audio data
-   :param channels: number of audio channels
-   :param rate: audio sample rate
-   :param sample_width: bytes per sample
-   :return:
-   """
-   with wave.open(filename, "wb") as wf:
-      wf.setnchannels(channels)
-      wf.setsampwidth(sample_width)
-      wf.setframerate(rate)
-      wf.writeframes(pcm)
+from jobs import report
+from workers import synthesize_in_order, synthesize_in_order_async
+from ratelimit import estimate_tokens, rate_limits, SCRIPT_TOKENS
+from cache import clip_cache
+from audio import PCM_ENCODINGS, PcmEncoder
+from mastering import PodcastMixer
+from gateway import (call, call_async, gemini_async_client, gemini_client,
+                     IncompleteResponse, SCRIPT_DEADLINE, TTS_DEADLINE,
+                     TTS_HEDGE_SECONDS, TTS_RETRIES)
+from metrics import observe, record_tokens, record_turn, span
+from providers import is_male_voice
+from scripts import script_cache, script_source, script_source_async
+from storage import AUDIO_FOLDER, staging_path
 
 load_dotenv()
-API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=API_KEY)
+TTS_MODEL = "gemini-2.5-flash-preview-tts"
+# Compressed format of the Gemini Podcasts: "mp3" or "opus"
+GEMINI_AUDIO_FORMAT = os.getenv("GEMINI_AUDIO_FORMAT", "mp3")
+# The transcript is converted to audio in chunks of whole speaker turns of
+# about this many words, while the rest of it is still being written
+GEMINI_TTS_CHUNK_WORDS = int(os.getenv("GEMINI_TTS_CHUNK_WORDS", "120"))
+# Length of the scripts, about 150 words per minute of audio: 320 for a
+# short Podcast, 1500 to 3000 for 10 to 20 minutes
+GEMINI_SCRIPT_WORDS = int(os.getenv("GEMINI_SCRIPT_WORDS", "320"))
 
 
-def gemini_create_podcast(topic, options_dic):
+def script_prompt(topic, options_dic, news):
    """
-   Creates the Podcast using Gemini AI
+   Writes the prompt of the Podcast script
    :param topic: Podcast topic
    :param options_dic: Dictionary with the Podcast settings
-   :return: the Podcast audio file
+   :param news: the latest news about the topic
+   :return: the prompt text
    """
    host_gender = []
    for i in range(2):  # get gender from names
-      if options_dic[f'host{i+1}_voice'] in ["Kore", "Leda", "Aoede",
-         "Callirrhoe", "Autonoe", "Despina", "ErinomeErinome",
-         "Laomedeia", "Achernar", "Gacrux", "Pulcherrima",
-         "Vindemiatrix", "Sulafat"]:
-         host_gender.append("female")
-      else:
+      if is_male_voice("Gemini", options_dic[f'host{i+1}_voice']):
          host_gender.append("male")
+      else:
+         host_gender.append("female")
    hosts_check = ''
    if options_dic['host1_name'] in topic:
       hosts_check = (f"- {options_dic['host1_name']} in {topic} and "
@@ -50,14 +52,12 @@ def gemini_create_podcast(topic, options_dic):
    if options_dic['host2_name'] in topic:
       hosts_check = (f"- {options_dic['host2_name']} in {topic} and "
                      f"Host B are not the same person.")
-   response_client = (client.models.generate_content(
-      model="gemini-2.0-flash",
-      contents=f"""
+   prompt = f"""
                 You are a creative and professional podcast scriptwriter.
                 
-                Task: Write a ~320-word podcast script for two hosts on 
-                the topic: "{topic}" based on the latest news below for 
-                the given topic. 
+                Task: Write a ~{GEMINI_SCRIPT_WORDS}-word podcast script 
+                for two hosts on the topic: "{topic}" based on the 
+                latest news below for the given topic. 
                 The script should be engaging, conversational, 
                 and informative. 
                 Hosts should alternate turns, speak naturally, 
@@ -69,7 +69,7 @@ def gemini_create_podcast(topic, options_dic):
                 
                 Example:
                 Topic: {topic}
-                Latest news: {tavili_answer(topic)}
+                Latest news: {news}
                 
                 Podcast Script:
                 Host A ({host_gender[0]}, {options_dic['host1_mood']}, 
@@ -77,7 +77,7 @@ def gemini_create_podcast(topic, options_dic):
                 on Tavili answer]
                 Host B ({host_gender[1]}, {options_dic['host2_mood']}, 
                 named {options_dic['host2_name']}): [Response line]
-                ... [Continue alternating for ~320 words]
+                ... [Continue alternating for ~{GEMINI_SCRIPT_WORDS} words]
                 
                 ---
                 
@@ -90,55 +90,575 @@ def gemini_create_podcast(topic, options_dic):
                 and named {options_dic['host2_name']}.
                 {hosts_check}
                 """
-))
-   transcript = response_client.text
+   return prompt
+
+
+def estimate_script_tokens(prompt):
+   """
+   :return: the tokens of the script request, for the rate limits
+   """
+   # SCRIPT_TOKENS is the answer of a script of about 320 words
+   return estimate_tokens(prompt) + SCRIPT_TOKENS * GEMINI_SCRIPT_WORDS // 320
+
+
+def script_config(timeout):
+   """
+   :return: the config of the script request, with its timeout in seconds
+   """
+   return types.GenerateContentConfig(http_options=types.HttpOptions(
+      timeout=int(timeout * 1000)))
+
+
+def write_script(topic, options_dic, news):
+   """
+   Writes the Podcast transcript with Gemini
+   :param topic: Podcast topic
+   :param options_dic: Dictionary with the Podcast settings
+   :param news: the latest news about the topic
+   :return: generator of the transcript text, as it is streamed
+   """
+   prompt = script_prompt(topic, options_dic, news)
+
+   def open_stream(timeout):
+      responses = gemini_client().models.generate_content_stream(
+         model="gemini-2.0-flash", contents=prompt,
+         config=script_config(timeout))
+      # The request is only sent for the first response; a stream that
+      # breaks later fails the Podcast
+      first = next(responses, None)
+      return itertools.chain([first] if first else [], responses)
+
+   script_tokens = estimate_script_tokens(prompt)
+   script_started = time.perf_counter()
+   usage_metadata = None
+   pieces = []
+   for response_client in call("Gemini", open_stream, SCRIPT_DEADLINE,
+                               tokens=script_tokens):
+      if response_client.usage_metadata:
+         usage_metadata = response_client.usage_metadata
+      if response_client.text:
+         pieces.append(response_client.text)
+         yield response_client.text
+   observe("script", "Gemini", time.perf_counter() - script_started)
+   script_usage(usage_metadata, script_tokens, pieces)
+
+
+def gemini_create_podcast(topic, options_dic, progress=None):
+   """
+   Creates the Podcast using Gemini AI. The script is reused from the
+   script cache when the Podcast is only voiced again
+   :param topic: Podcast topic
+   :param options_dic: Dictionary with the Podcast settings
+   :param progress: optional callback(stage, percent) for job status
+   :return: the Podcast audio file, in the staging folder, relative to
+   AUDIO_FOLDER
+   """
+   report(progress, "script", 5)
+   cached, news, cache_key = script_source("Gemini", topic, options_dic)
+   speakers = [options_dic['host1_name'], options_dic['host2_name']]
+   chunks = []   # the transcript chunks written so far
+   script_done = False
+
+   def transcript_turns():
+      if cached is not None:   # only the voices differ, the script is the same
+         yield from (f"{speaker}: {text}" for speaker, text in cached)
+         return
+      turns = []
+      for turn in speaker_turns(write_script(topic, options_dic, news),
+                                speakers):
+         turns.append(turn)
+         yield turn
+      script_cache.set(cache_key, script_turns(turns, speakers))
+
+   def transcript_chunks():
+      nonlocal script_done
+      for chunk in turn_chunks(transcript_turns(), GEMINI_TTS_CHUNK_WORDS):
+         chunks.append(chunk)
+         yield chunk
+      script_done = True
+
+   def synthesize(chunk):
+      key = chunk_key(chunk, options_dic)
+      data = clip_cache.get(key)
+      if data is None:
+         data = synthesize_transcript(chunk, options_dic)
+         clip_cache.put(key, data)
+      return data
+
+   # The chunks are converted to audio while the script is still being
+   # written, and the 24 kHz 16 bit PCM is post-processed and encoded in
+   # transcript order, with music intro and outro
+   file_name = staging_path(PCM_ENCODINGS[GEMINI_AUDIO_FORMAT][0])
+   with PcmEncoder(file_name, GEMINI_AUDIO_FORMAT) as encoder:
+      mixer = PodcastMixer(encoder)
+      mixer.add_intro()
+      done = 0
+      percent = 20
+      for data in synthesize_in_order("Gemini", synthesize,
+                                      transcript_chunks()):
+         with span("assemble", "Gemini"):
+            start_ms = mixer.add(data)
+         record_chunk_turns(chunks[done], speakers, start_ms,
+                            mixer.position_ms)
+         done += 1
+         total = len(chunks) if script_done else max(
+            len(chunks), round(GEMINI_SCRIPT_WORDS / GEMINI_TTS_CHUNK_WORDS))
+         percent = max(percent, 20 + 70 * done / total)
+         if done == 1:   # enough audio to start playing the Podcast
+            report(progress, "audio", percent,
+                   live_file=os.path.relpath(encoder.part_path, AUDIO_FOLDER))
+         else:
+            report(progress, "audio", percent)
+      report(progress, "export", 90)
+      export_started = time.perf_counter()
+      mixer.add_intro()
+      mixer.flush()
+   observe("export", "Gemini", time.perf_counter() - export_started)
+
+   return os.path.relpath(file_name, AUDIO_FOLDER)
+
+
+def script_usage(usage_metadata, script_tokens, pieces):
+   """
+   Records the token usage of the complete script
+   :param usage_metadata: the usage of the last script response, or None
+   :param script_tokens: the tokens estimated for the rate limits
+   :param pieces: the transcript pieces
+   """
+   rate_limits["Gemini"].settle(
+      script_tokens,
+      usage_metadata.total_token_count if usage_metadata else None)
    # Access and print the usage_metadata
-   if response_client.usage_metadata:
+   if usage_metadata:
+      record_tokens("Gemini", usage_metadata.prompt_token_count,
+                    usage_metadata.candidates_token_count)
       print(f"\nClient Prompt tokens: "
-            f"{response_client.usage_metadata.prompt_token_count}")
+            f"{usage_metadata.prompt_token_count}")
       print(f"Client Candidate tokens: "
-            f"{response_client.usage_metadata.candidates_token_count}")
+            f"{usage_metadata.candidates_token_count}")
       print(f"Client Total tokens: "
-            f"{response_client.usage_metadata.total_token_count}")
-      print(transcript)
+            f"{usage_metadata.total_token_count}")
+      print("".join(pieces))
    else:
       print("\nUsage metadata not available in the client response.")
 
-   response = client.models.generate_content(
-      model="gemini-2.5-flash-preview-tts",
-      contents=transcript,
-      config=types.GenerateContentConfig(
-         response_modalities=["AUDIO"],
-         speech_config=types.SpeechConfig(
-            multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
-               speaker_voice_configs=[
-                  types.SpeakerVoiceConfig(
-                     speaker=options_dic['host1_name'],
-                     voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                           voice_name=options_dic['host1_voice'],
-                        )
+
+def chunk_key(chunk, options_dic):
+   """
+   :return: the TTS clip cache key of a transcript chunk
+   """
+   voices = (f"{options_dic['host1_name']}={options_dic['host1_voice']},"
+             f"{options_dic['host2_name']}={options_dic['host2_voice']}")
+   return clip_cache.key("Gemini", TTS_MODEL, voices, "", chunk)
+
+
+def speaker_label(speakers):
+   """
+   :param speakers: the host names
+   :return: the regular expression of the label that starts a turn, e.g.
+   "George:" or "**George:**", with the host name as its first group
+   """
+   names = "|".join(re.escape(speaker) for speaker in speakers)
+   return re.compile(rf"^\W*({names})\b[^:\n]{{0,40}}:")
+
+
+class TurnSplitter:
+   """
+   Splits the transcript into speaker turns while it is streamed: a turn
+   starts at a line that begins with a host name, e.g. "George:" or
+   "**George:**", and is complete when the next one starts. Lines before
+   the first turn are kept, as a turn of their own
+   """
+
+   def __init__(self, speakers):
+      self._turn_start = speaker_label(speakers)
+      self._buffer = ""
+      self._turn = []
+
+   def _add_line(self, line):
+      if self._turn_start.match(line) and any(
+            part.strip() for part in self._turn):
+         complete = "".join(self._turn).strip()
+         self._turn = [line]
+         return complete
+      self._turn.append(line)
+      return None
+
+   def feed(self, piece):
+      """
+      :param piece: the next piece of the streamed transcript
+      :return: list of the turns that the piece completes
+      """
+      self._buffer += piece
+      *lines, self._buffer = self._buffer.split("\n")
+      turns = (self._add_line(line + "\n") for line in lines)
+      return [turn for turn in turns if turn]
+
+   def close(self):
+      """
+      :return: list of the last turns, once the transcript is complete
+      """
+      turns = [self._add_line(self._buffer), "".join(self._turn).strip()]
+      self._buffer = ""
+      self._turn = []
+      return [turn for turn in turns if turn]
+
+
+def speaker_turns(pieces, speakers):
+   """
+   Splits the transcript into speaker turns while it is streamed, see
+   TurnSplitter
+   :param pieces: iterable of the transcript text, as it is streamed
+   :param speakers: the host names
+   :return: generator of the turns text
+   """
+   splitter = TurnSplitter(speakers)
+   for piece in pieces:
+      yield from splitter.feed(piece)
+   yield from splitter.close()
+
+
+class TurnChunker:
+   """
+   Groups consecutive speaker turns into chunks of about max_words words,
+   never splitting a turn
+   """
+
+   def __init__(self, max_words):
+      self.max_words = max_words
+      self._chunk = []
+      self._words = 0
+
+   def add(self, turn):
+      """
+      :param turn: the next turn text
+      :return: list of the chunks that are complete, at most one
+      """
+      complete = []
+      turn_words = len(turn.split())
+      if self._chunk and self._words + turn_words > self.max_words:
+         complete.append("\n".join(self._chunk))
+         self._chunk = []
+         self._words = 0
+      self._chunk.append(turn)
+      self._words += turn_words
+      return complete
+
+   def close(self):
+      """
+      :return: list of the last chunk, if any
+      """
+      complete = ["\n".join(self._chunk)] if self._chunk else []
+      self._chunk = []
+      self._words = 0
+      return complete
+
+
+def turn_chunks(turns, max_words):
+   """
+   Groups consecutive speaker turns into chunks of about max_words words,
+   never splitting a turn
+   :param turns: iterable of the turns text
+   :param max_words: the size of a chunk in words
+   :return: generator of the chunks text
+   """
+   chunker = TurnChunker(max_words)
+   for turn in turns:
+      yield from chunker.add(turn)
+   yield from chunker.close()
+
+
+def record_chunk_turns(chunk, speakers, start_ms, end_ms):
+   """
+   Adds the speaker turns of an assembled chunk to the transcript of the
+   Podcast. The audio of a chunk is synthesized in one piece, so its time
+   is shared between its turns in proportion to their length
+   :param chunk: the transcript chunk
+   :param speakers: the host names
+   :param start_ms: where the chunk starts in the Podcast audio
+   :param end_ms: where the chunk ends in the Podcast audio
+   """
+   turns = list(speaker_turns([chunk], speakers))
+   length = sum(len(turn) for turn in turns) or 1
+   offset = 0
+   for turn in turns:
+      record_turn(*split_turn(turn, speakers),
+                  start_ms + round((end_ms - start_ms) * offset / length))
+      offset += len(turn)
+
+
+def split_turn(turn, speakers):
+   """
+   :param turn: a speaker turn of the transcript
+   :param speakers: the host names
+   :return: tuple of the host name and the text of the turn; the name is
+   empty for the lines before the first turn
+   """
+   match = speaker_label(speakers).match(turn)
+   if not match:
+      return "", turn.strip()
+   return match.group(1), turn[match.end():].strip(" *\n")
+
+
+def script_turns(turns, speakers):
+   """
+   :param turns: the speaker turns of a transcript
+   :param speakers: the host names
+   :return: the turns of the hosts as (speaker, text) pairs, for the script
+   cache
+   """
+   return [(speaker, text) for speaker, text in (
+      split_turn(turn, speakers) for turn in turns) if speaker]
+
+
+def speech_config(options_dic):
+   """
+   :param options_dic: Dictionary with the Podcast settings
+   :return: the config of the TTS requests, with one voice per host
+   """
+   return types.GenerateContentConfig(
+      response_modalities=["AUDIO"],
+      speech_config=types.SpeechConfig(
+         multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
+            speaker_voice_configs=[
+               types.SpeakerVoiceConfig(
+                  speaker=options_dic['host1_name'],
+                  voice_config=types.VoiceConfig(
+                     prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                        voice_name=options_dic['host1_voice'],
                      )
-                  ),
-                  types.SpeakerVoiceConfig(
-                     speaker=options_dic['host2_name'],
-                     voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                           voice_name=options_dic['host2_voice'],
-                        )
+                  )
+               ),
+               types.SpeakerVoiceConfig(
+                  speaker=options_dic['host2_name'],
+                  voice_config=types.VoiceConfig(
+                     prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                        voice_name=options_dic['host2_voice'],
                      )
-                  ),
-               ]
-            )
+                  )
+               ),
+            ]
          )
       )
    )
 
-   data = response.candidates[0].content.parts[0].inline_data.data
 
-   file_name = os.path.join(os.getcwd(), "static/audio",
-                               f"{clean_path(topic)}.wav")
-   wave_file(file_name, data) # Saves the file to current directory
+def with_timeout(config, timeout):
+   """
+   :return: a copy of the request config, with a timeout in seconds
+   """
+   return config.model_copy(update={"http_options": types.HttpOptions(
+      timeout=int(timeout * 1000))})
+
+
+def synthesize_transcript(transcript, options_dic):
+   """
+   Converts the Podcast transcript, or a part of it, to audio, with one
+   voice per host
+   :param transcript: the Podcast transcript
+   :param options_dic: Dictionary with the Podcast settings
+   :return: the raw 24 kHz 16 bit mono PCM audio
+   """
+   config = speech_config(options_dic)
+
+   def speak(timeout):
+      response = gemini_client().models.generate_content(
+         model=TTS_MODEL,
+         contents=transcript,
+         config=with_timeout(config, timeout))
+      speech_data(response)   # a chunk without audio is sent again
+      return response
+
+   tokens = estimate_tokens(transcript)
+   with span("tts", "Gemini"):
+      response = call("Gemini", speak, TTS_DEADLINE, retries=TTS_RETRIES,
+                      tokens=tokens, hedge_after=TTS_HEDGE_SECONDS)
+   return speech_audio(response, tokens)
+
+
+def speech_audio(response, tokens):
+   """
+   Records the token usage of a TTS response
+   :param response: the generate_content response
+   :param tokens: the tokens estimated for the rate limits
+   :return: the raw PCM audio of the response
+   """
+   usage_metadata = response.usage_metadata
+   rate_limits["Gemini"].settle(
+      tokens, usage_metadata.total_token_count if usage_metadata else None)
+   if usage_metadata:
+      record_tokens("Gemini", usage_metadata.prompt_token_count,
+                    usage_metadata.candidates_token_count)
+   return speech_data(response)
+
+
+def speech_data(response):
+   """
+   :param response: the generate_content response of a TTS request
+   :return: the raw PCM audio of the response
+   """
+   candidate = response.candidates[0] if response.candidates else None
+   parts = candidate.content.parts if candidate and candidate.content \
+      else None
+   data = parts[0].inline_data.data if parts and parts[0].inline_data \
+      else None
+   if not data:
+      reason = candidate.finish_reason if candidate else None
+      raise IncompleteResponse(f"Gemini TTS answered without audio "
+                               f"({reason})")
+   return data
+
+
+async def next_response(responses):
+   """
+   The next item of an async stream, like anext(responses, None) that
+   Python 3.9 does not have
+   :param responses: async iterator of the streamed responses
+   :return: the next response, None at the end of the stream
+   """
+   try:
+      return await responses.__anext__()
+   except StopAsyncIteration:
+      return None
+
+
+async def write_script_async(topic, options_dic, news):
+   """
+   Like write_script(), with the async Gemini client
+   :param topic: Podcast topic
+   :param options_dic: Dictionary with the Podcast settings
+   :param news: the latest news about the topic
+   :return: async generator of the transcript text, as it is streamed
+   """
+   prompt = script_prompt(topic, options_dic, news)
+
+   async def open_stream(timeout):
+      responses = await gemini_async_client().models \
+         .generate_content_stream(model="gemini-2.0-flash", contents=prompt,
+                                  config=script_config(timeout))
+      # The request is only sent for the first response
+      first = await next_response(responses)
+      return first, responses
+
+   script_tokens = estimate_script_tokens(prompt)
+   script_started = time.perf_counter()
+   first, responses = await call_async("Gemini", open_stream,
+                                       SCRIPT_DEADLINE, tokens=script_tokens)
+   usage_metadata = None
+   pieces = []
+   response_client = first
+   while response_client is not None:
+      if response_client.usage_metadata:
+         usage_metadata = response_client.usage_metadata
+      if response_client.text:
+         pieces.append(response_client.text)
+         yield response_client.text
+      response_client = await next_response(responses)
+   observe("script", "Gemini", time.perf_counter() - script_started)
+   script_usage(usage_metadata, script_tokens, pieces)
+
+
+async def gemini_create_podcast_async(topic, options_dic, progress=None):
+   """
+   Like gemini_create_podcast(), for the async generation engine: the
+   script and the TTS calls are awaited in the event loop, and only the
+   audio processing runs in worker threads
+   :param topic: Podcast topic
+   :param options_dic: Dictionary with the Podcast settings
+   :param progress: optional callback(stage, percent) for job status
+   :return: the Podcast audio file, in the staging folder, relative to
+   AUDIO_FOLDER
+   """
+   report(progress, "script", 5)
+   cached, news, cache_key = await script_source_async("Gemini", topic,
+                                                       options_dic)
+   speakers = [options_dic['host1_name'], options_dic['host2_name']]
+   chunks = []   # the transcript chunks written so far
+   script_done = False
+
+   async def transcript_turns():
+      if cached is not None:
+         for speaker, text in cached:
+            yield f"{speaker}: {text}"
+         return
+      turns = []
+      splitter = TurnSplitter(speakers)
+      async for piece in write_script_async(topic, options_dic, news):
+         for turn in splitter.feed(piece):
+            turns.append(turn)
+            yield turn
+      for turn in splitter.close():
+         turns.append(turn)
+         yield turn
+      await asyncio.to_thread(script_cache.set, cache_key,
+                              script_turns(turns, speakers))
+
+   async def transcript_chunks():
+      nonlocal script_done
+      chunker = TurnChunker(GEMINI_TTS_CHUNK_WORDS)
+      async for turn in transcript_turns():
+         for chunk in chunker.add(turn):
+            chunks.append(chunk)
+            yield chunk
+      for chunk in chunker.close():
+         chunks.append(chunk)
+         yield chunk
+      script_done = True
+
+   config = speech_config(options_dic)
+
+   async def synthesize(chunk):
+      key = chunk_key(chunk, options_dic)
+      data = await asyncio.to_thread(clip_cache.get, key)
+      if data is None:
+         tokens = estimate_tokens(chunk)
+
+         async def speak(timeout):
+            response = await gemini_async_client().models.generate_content(
+               model=TTS_MODEL, contents=chunk,
+               config=with_timeout(config, timeout))
+            speech_data(response)   # a chunk without audio is sent again
+            return response
+
+         with span("tts", "Gemini"):
+            response = await call_async(
+               "Gemini", speak, TTS_DEADLINE, retries=TTS_RETRIES,
+               tokens=tokens, hedge_after=TTS_HEDGE_SECONDS)
+         data = speech_audio(response, tokens)
+         await asyncio.to_thread(clip_cache.put, key, data)
+      return data
+
+   file_name = staging_path(PCM_ENCODINGS[GEMINI_AUDIO_FORMAT][0])
+   encoder = await asyncio.to_thread(PcmEncoder, file_name,
+                                     GEMINI_AUDIO_FORMAT)
+   try:
+      mixer = PodcastMixer(encoder)
+      await asyncio.to_thread(mixer.add_intro)
+      done = 0
+      percent = 20
+      async for data in synthesize_in_order_async("Gemini", synthesize,
+                                                  transcript_chunks()):
+         with span("assemble", "Gemini"):
+            start_ms = await asyncio.to_thread(mixer.add, data)
+         record_chunk_turns(chunks[done], speakers, start_ms,
+                            mixer.position_ms)
+         done += 1
+         total = len(chunks) if script_done else max(
+            len(chunks), round(GEMINI_SCRIPT_WORDS / GEMINI_TTS_CHUNK_WORDS))
+         percent = max(percent, 20 + 70 * done / total)
+         if done == 1:   # enough audio to start playing the Podcast
+            report(progress, "audio", percent,
+                   live_file=os.path.relpath(encoder.part_path, AUDIO_FOLDER))
+         else:
+            report(progress, "audio", percent)
+      report(progress, "export", 90)
+      export_started = time.perf_counter()
+      await asyncio.to_thread(mixer.add_intro)
+      await asyncio.to_thread(mixer.flush)
+   except BaseException:   # also when the generation is cancelled
+      encoder.abort()
+      raise
+   await asyncio.to_thread(encoder.close)
+   observe("export", "Gemini", time.perf_counter() - export_started)
 
-   # Export the combined file
-   return f"{clean_path(topic)}.wav"
\ No newline at end of file
+   return os.path.relpath(file_name, AUDIO_FOLDER)
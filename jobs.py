@@ -0,0 +1,129 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+# Number of Podcasts created at the same time, and how many more can wait
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", "16"))
+# "threads" creates each Podcast in a thread of its own, "asyncio" creates
+# them all as tasks of one event loop, with the async provider clients, so
+# that one worker process can keep dozens of them in flight
+GENERATION_ENGINE = os.getenv("GENERATION_ENGINE", "threads")
+QUEUE_FULL_MESSAGE = ("Too many Podcasts are being created right now. "
+                      "Please try again in a few minutes.")
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the generation queue cannot accept another job
+    """
+
+
+class JobExecutor:
+    """
+    Thread pool that runs the Podcast generation jobs in the background.
+    The number of running plus waiting jobs is bounded, so a burst of
+    requests is refused instead of piling up unlimited work.
+    """
+    def __init__(self, max_workers, max_queued):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix="podcast-job")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+    def submit(self, fn, *args):
+        """
+        Schedules fn(*args) on the pool
+        :param fn: the job function
+        :param args: the job function arguments
+        :return: the Future of the job
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(QUEUE_FULL_MESSAGE)
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+
+class AsyncJobEngine:
+    """
+    Event loop, in a background thread, that runs the Podcast generation
+    jobs as asyncio tasks. A job waits for the AI providers most of the
+    time, so the loop keeps many of them in flight without a thread each.
+    Like JobExecutor, the number of running plus waiting jobs is bounded.
+    """
+    def __init__(self, max_jobs, max_queued):
+        self._loop = asyncio.new_event_loop()
+        self._max_jobs = max_jobs
+        self._running = None   # made on the loop, see _run()
+        self._slots = threading.BoundedSemaphore(max_jobs + max_queued)
+        threading.Thread(target=self._loop.run_forever, name="podcast-jobs",
+                         daemon=True).start()
+
+    def submit(self, fn, *args):
+        """
+        Schedules the coroutine fn(*args) on the event loop
+        :param fn: the job coroutine function
+        :param args: the job function arguments
+        :return: the concurrent.futures.Future of the job
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(QUEUE_FULL_MESSAGE)
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._run(fn, *args),
+                                                      self._loop)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    async def _run(self, fn, *args):
+        # Before Python 3.10 an asyncio.Semaphore binds to the event loop
+        # of the thread that makes it, so it is made here, on self._loop
+        if self._running is None:
+            self._running = asyncio.Semaphore(self._max_jobs)
+        async with self._running:
+            return await fn(*args)
+
+
+if GENERATION_ENGINE == "asyncio":
+    executor = AsyncJobEngine(GENERATION_WORKERS, GENERATION_QUEUE_SIZE)
+else:
+    executor = JobExecutor(GENERATION_WORKERS, GENERATION_QUEUE_SIZE)
+
+
+def report(progress, stage, percent, **details):
+    """
+    Reports the progress of a Podcast generation, if anybody listens
+    :param progress: callback(stage, percent, **details) or None
+    :param stage: name of the current generation stage
+    :param percent: overall progress, from 0 to 100
+    :param details: more about the job, e.g. live_file, the name of the
+    audio file that can be streamed while it is generated
+    """
+    if progress:
+        progress(stage, int(percent), **details)
+
+
+def pid_alive(pid):
+    """
+    Checks if a worker process is still running on this host
+    :param pid: the process id
+    :return: True if the process exists
+    """
+    if os.name == 'nt':  # os.kill would terminate the process on Windows
+        return False
+    try:
+        os.kill(pid, 0)
+    except PermissionError:  # exists, but belongs to another user
+        return True
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,357 @@
+"""
+Post-processing of the Podcast audio on NumPy sample arrays, on its way
+from the TTS to the encoder: every speech segment is normalized to the
+same loudness, whatever the voice or provider, consecutive segments and
+the music intro/outro are joined with short crossfades instead of hard
+cuts, and an optional music bed is mixed under the speech, ducked while
+the hosts speak. All the processing is done with whole-array operations,
+the cost of a segment is one batched FFT and a few passes over it.
+"""
+import os
+from functools import lru_cache
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from dotenv import load_dotenv
+from pydub import AudioSegment
+from audio import intro_pcm, TARGET_CHANNELS, TARGET_SAMPLE_RATE
+
+load_dotenv()
+# Post-process the Podcast audio. With 0, the OpenAI clips are appended as
+# they are, without decoding them, and the Gemini audio is only encoded
+AUDIO_MASTERING = os.getenv("AUDIO_MASTERING", "1") == "1"
+# Loudness of every speech segment and of the intro, in LUFS (ITU-R
+# BS.1770), -16 is the usual target of spoken Podcasts
+LOUDNESS_TARGET = float(os.getenv("LOUDNESS_TARGET", "-16"))
+# Highest sample level after normalization, in dBFS
+PEAK_LEVEL = -1.0
+# Largest gain applied to a segment, so that a nearly silent clip is not
+# turned into loud noise
+MAX_GAIN_DB = 20.0
+# Crossfade between two speech segments, and between speech and music
+TURN_CROSSFADE_SECONDS = 0.04
+MUSIC_CROSSFADE_SECONDS = 1.0
+# Music looped under the speech, any format ffmpeg reads, none when empty
+BACKGROUND_MUSIC = os.getenv("BACKGROUND_MUSIC", "")
+# Level of the background music relative to the speech, and how much lower
+# it goes while the hosts speak, in dB
+MUSIC_LEVEL_DB = float(os.getenv("MUSIC_LEVEL_DB", "-18"))
+MUSIC_DUCK_DB = float(os.getenv("MUSIC_DUCK_DB", "12"))
+# Speech detection of the ducking and of the pause trimming: 10 ms frames
+# louder than the threshold are speech, and the music stays ducked for the
+# hold around them
+DUCK_FRAME_SECONDS = 0.01
+DUCK_THRESHOLD_DB = -45.0
+DUCK_HOLD_SECONDS = 0.3
+DUCK_RAMP_SECONDS = 0.15
+# Silence kept at each end of a speech segment. The TTS clips, e.g. the
+# Gemini transcript chunks, start and end with pauses of any length; they
+# are trimmed so that all the seams between segments sound alike
+SEGMENT_PAUSE_SECONDS = 0.15
+
+# BS.1770 loudness: 400 ms blocks overlapping by 75%, gated at -70 LUFS
+# and at 10 LU below the loudness of the blocks above that
+_BLOCK_SECONDS = 0.4
+_BLOCK_STEP_SECONDS = 0.1
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+
+
+def to_samples(pcm):
+    """
+    :param pcm: raw 16 bit mono PCM bytes
+    :return: float32 samples in [-1, 1)
+    """
+    return np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32768
+
+
+def to_pcm(samples):
+    """
+    :param samples: float samples, clipped to [-1, 1)
+    :return: raw 16 bit PCM bytes
+    """
+    return (np.clip(samples, -1, 32767 / 32768) * 32768).astype(
+        "<i2").tobytes()
+
+
+def _biquad_response(b, a, frequencies, sample_rate):
+    """
+    :return: the complex frequency response of a biquad filter
+    """
+    z = np.exp(-2j * np.pi * frequencies / sample_rate)
+    return ((b[0] + b[1] * z + b[2] * z ** 2)
+            / (a[0] + a[1] * z + a[2] * z ** 2))
+
+
+@lru_cache(maxsize=None)
+def _k_weights(size, sample_rate):
+    """
+    The BS.1770 K-weighting, a high shelf and a high pass filter, as the
+    weights of the squared rfft bins of a frame of this size: the weighted
+    sum of the squared bins is the energy of the filtered frame (Parseval)
+    """
+    frequencies = np.fft.rfftfreq(size, 1 / sample_rate)
+    # high shelf: +4 dB above 1.5 kHz, the acoustic effect of the head
+    w0 = 2 * np.pi * 1500 / sample_rate
+    alpha = np.sin(w0) / (2 / np.sqrt(2))
+    gain = 10 ** (4.0 / 40)
+    shelf = _biquad_response(
+        [gain * ((gain + 1) + (gain - 1) * np.cos(w0)
+                 + 2 * np.sqrt(gain) * alpha),
+         -2 * gain * ((gain - 1) + (gain + 1) * np.cos(w0)),
+         gain * ((gain + 1) + (gain - 1) * np.cos(w0)
+                 - 2 * np.sqrt(gain) * alpha)],
+        [(gain + 1) - (gain - 1) * np.cos(w0) + 2 * np.sqrt(gain) * alpha,
+         2 * ((gain - 1) - (gain + 1) * np.cos(w0)),
+         (gain + 1) - (gain - 1) * np.cos(w0) - 2 * np.sqrt(gain) * alpha],
+        frequencies, sample_rate)
+    # high pass at 38 Hz
+    w0 = 2 * np.pi * 38 / sample_rate
+    alpha = np.sin(w0) / (2 * 0.5)
+    high_pass = _biquad_response(
+        [(1 + np.cos(w0)) / 2, -(1 + np.cos(w0)), (1 + np.cos(w0)) / 2],
+        [1 + alpha, -2 * np.cos(w0), 1 - alpha], frequencies, sample_rate)
+    weights = np.abs(shelf * high_pass) ** 2 * 2 / size
+    weights[0] /= 2   # the DC and Nyquist bins are not mirrored
+    if size % 2 == 0:
+        weights[-1] /= 2
+    return weights.astype(np.float32)
+
+
+def loudness(samples, sample_rate=TARGET_SAMPLE_RATE):
+    """
+    Measures the integrated loudness of mono audio, as in ITU-R BS.1770.
+    The K-weighted energy of every 100 ms step comes from one batched FFT,
+    and the 400 ms blocks add up four consecutive steps
+    :param samples: float samples
+    :param sample_rate: sample rate of the samples
+    :return: the loudness in LUFS, or None for silence
+    """
+    step = int(_BLOCK_STEP_SECONDS * sample_rate)
+    steps = -(-len(samples) // step)
+    if not steps:
+        return None
+    frames = np.zeros(steps * step, dtype=np.float32)
+    frames[:len(samples)] = samples
+    spectrum = np.fft.rfft(frames.reshape(steps, step), axis=1)
+    energies = (spectrum.real ** 2 + spectrum.imag ** 2) @ _k_weights(
+        step, sample_rate)
+    per_block = min(steps, round(_BLOCK_SECONDS / _BLOCK_STEP_SECONDS))
+    powers = sliding_window_view(energies.astype(np.float64),
+                                 per_block).sum(axis=1) / (per_block * step)
+    with np.errstate(divide="ignore"):
+        levels = -0.691 + 10 * np.log10(powers)
+    powers = powers[levels > _ABSOLUTE_GATE]
+    if not len(powers):
+        return None
+    relative_gate = -0.691 + 10 * np.log10(powers.mean()) + _RELATIVE_GATE
+    with np.errstate(divide="ignore"):
+        powers = powers[-0.691 + 10 * np.log10(powers) > relative_gate]
+    return -0.691 + 10 * np.log10(powers.mean())
+
+
+def normalize(samples, sample_rate=TARGET_SAMPLE_RATE):
+    """
+    Brings audio to LOUDNESS_TARGET, never raising a peak above PEAK_LEVEL
+    :param samples: float samples
+    :param sample_rate: sample rate of the samples
+    :return: the normalized samples
+    """
+    measured = loudness(samples, sample_rate)
+    if measured is None:
+        return samples
+    gain = min(LOUDNESS_TARGET - measured, MAX_GAIN_DB)
+    peak = np.abs(samples).max()
+    gain = min(gain, PEAK_LEVEL - 20 * np.log10(peak))
+    return samples * np.float32(10 ** (gain / 20))
+
+
+def _frame_levels(samples, hop):
+    """
+    :param samples: float samples
+    :param hop: the samples of a frame
+    :return: the level of each frame, in dBFS, the last one padded with
+    silence
+    """
+    frames = -(-len(samples) // hop)
+    padded = np.zeros(frames * hop, dtype=np.float32)
+    padded[:len(samples)] = samples
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10(np.mean(padded.reshape(frames, hop) ** 2,
+                                     axis=1))
+
+
+def trim_pauses(samples, sample_rate=TARGET_SAMPLE_RATE):
+    """
+    Shortens the silence at both ends of a speech segment to
+    SEGMENT_PAUSE_SECONDS, leaving shorter pauses as they are
+    :param samples: float samples, normalized
+    :param sample_rate: sample rate of the samples
+    :return: the trimmed samples
+    """
+    hop = int(DUCK_FRAME_SECONDS * sample_rate)
+    speech = np.flatnonzero(_frame_levels(samples, hop) > DUCK_THRESHOLD_DB)
+    if not len(speech):
+        return samples
+    pause = int(SEGMENT_PAUSE_SECONDS * sample_rate)
+    start = max(0, speech[0] * hop - pause)
+    end = min(len(samples), (speech[-1] + 1) * hop + pause)
+    return samples[start:end]
+
+
+def _equal_power_fades(length):
+    """
+    :return: the fade out and fade in curves of a crossfade, which keep the
+    loudness constant across it
+    """
+    angles = np.linspace(0, np.pi / 2, length, dtype=np.float32)
+    return np.cos(angles), np.sin(angles)
+
+
+@lru_cache(maxsize=None)
+def _music_bed(sample_rate):
+    """
+    The background music, decoded and normalized only once per process
+    :return: its float samples, or None when there is no music
+    """
+    if not BACKGROUND_MUSIC:
+        return None
+    music = AudioSegment.from_file(BACKGROUND_MUSIC).set_frame_rate(
+        sample_rate).set_channels(TARGET_CHANNELS).set_sample_width(2)
+    samples = normalize(to_samples(music.raw_data), sample_rate)
+    return samples * np.float32(10 ** (MUSIC_LEVEL_DB / 20))
+
+
+@lru_cache(maxsize=None)
+def _intro(sample_rate):
+    """
+    The music intro/outro, at the loudness of the speech
+    """
+    samples = to_samples(intro_pcm(sample_rate, TARGET_CHANNELS))
+    if AUDIO_MASTERING:
+        samples = normalize(samples, sample_rate)
+    samples.flags.writeable = False   # shared by all the Podcasts
+    return samples
+
+
+class PodcastMixer:
+    """
+    Joins the intro, speech segments and outro of a Podcast, post-processed
+    as set by AUDIO_MASTERING, and writes them as 16 bit PCM to an encoder,
+    e.g. a PcmEncoder. The end of the audio is held back until the next
+    segment arrives, for the crossfade, so the encoder is at most
+    MUSIC_CROSSFADE_SECONDS behind.
+    """
+
+    def __init__(self, encoder, sample_rate=TARGET_SAMPLE_RATE):
+        self.encoder = encoder
+        self.sample_rate = sample_rate
+        self._held = np.zeros(0, dtype=np.float32)
+        self._held_music = False   # the held audio is the intro
+        self._bed_position = 0
+        self._duck_gain = None   # the music gain at the end of the last
+        # speech segment, where the ducking of the next one starts
+        self._position = 0   # samples of the Podcast so far, held included
+
+    def add_intro(self):
+        """
+        Appends the music intro/outro
+        """
+        self._append(_intro(self.sample_rate), music=True)
+
+    def add(self, pcm):
+        """
+        Appends a speech segment, normalized, with even pauses at its ends
+        and over the background music
+        :param pcm: raw 16 bit mono PCM bytes, e.g. one TTS clip
+        :return: where the segment starts in the Podcast, in milliseconds
+        """
+        samples = to_samples(pcm)
+        if AUDIO_MASTERING:
+            samples = trim_pauses(normalize(samples, self.sample_rate),
+                                  self.sample_rate)
+            bed = _music_bed(self.sample_rate)
+            if bed is not None:
+                samples = samples + self._ducked_music(bed, samples)
+        return self._milliseconds(self._append(samples, music=False))
+
+    @property
+    def position_ms(self):
+        """
+        The length of the Podcast so far, in milliseconds: where the next
+        segment starts, before its crossfade
+        """
+        return self._milliseconds(self._position)
+
+    def _milliseconds(self, samples):
+        return round(samples * 1000 / self.sample_rate)
+
+    def flush(self):
+        """
+        Writes the audio held back for the crossfade, after the last
+        segment
+        """
+        self.encoder.write(to_pcm(self._held))
+        self._held = self._held[:0]
+
+    def _append(self, samples, music):
+        """
+        Crossfades the samples with the held audio, writes all but the end
+        of the result and holds it back for the next crossfade
+        :return: the position of the first sample in the Podcast
+        """
+        if not AUDIO_MASTERING:
+            self.encoder.write(to_pcm(samples))
+            self._position += len(samples)
+            return self._position - len(samples)
+        seconds = MUSIC_CROSSFADE_SECONDS if music or self._held_music \
+            else TURN_CROSSFADE_SECONDS
+        overlap = min(int(seconds * self.sample_rate), len(self._held),
+                      len(samples))
+        if overlap:
+            fade_out, fade_in = _equal_power_fades(overlap)
+            joined = (self._held[len(self._held) - overlap:] * fade_out
+                      + samples[:overlap] * fade_in)
+            audio = np.concatenate((self._held[:len(self._held) - overlap],
+                                    joined, samples[overlap:]))
+        else:
+            audio = np.concatenate((self._held, samples))
+        hold = min(len(audio), int(MUSIC_CROSSFADE_SECONDS
+                                   * self.sample_rate))
+        self.encoder.write(to_pcm(audio[:len(audio) - hold]))
+        self._held = audio[len(audio) - hold:]
+        self._held_music = music
+        start = self._position - overlap
+        self._position = start + len(samples)
+        return start
+
+    def _ducked_music(self, bed, speech):
+        """
+        The background music under a speech segment, continuing where the
+        last segment left it, lowered by MUSIC_DUCK_DB around the speech
+        :param bed: the background music samples
+        :param speech: the normalized speech samples
+        :return: the music samples, as many as the speech ones
+        """
+        music = bed[(self._bed_position + np.arange(len(speech)))
+                    % len(bed)]
+        self._bed_position = (self._bed_position + len(speech)) % len(bed)
+        hop = int(DUCK_FRAME_SECONDS * self.sample_rate)
+        levels = _frame_levels(speech, hop)
+        frames = len(levels)
+        # speech frames, widened by the hold on both sides
+        hold = int(DUCK_HOLD_SECONDS / DUCK_FRAME_SECONDS)
+        active = np.pad(levels > DUCK_THRESHOLD_DB, hold)
+        active = sliding_window_view(active, 2 * hold + 1).any(axis=1)
+        gains = np.where(active, np.float32(10 ** (-MUSIC_DUCK_DB / 20)),
+                         np.float32(1))
+        # ramps between the levels, starting from the gain of the end of
+        # the last segment
+        ramp = max(1, int(DUCK_RAMP_SECONDS / DUCK_FRAME_SECONDS))
+        start = gains[0] if self._duck_gain is None else self._duck_gain
+        gains = np.concatenate((np.full(ramp, start), gains))
+        gains = np.convolve(gains, np.full(ramp, 1 / ramp),
+                            mode="valid")[1:]
+        self._duck_gain = gains[-1]
+        envelope = np.interp(np.arange(len(speech)),
+                             (np.arange(frames) + 0.5) * hop, gains)
+        return music * envelope.astype(np.float32)
@@ -0,0 +1,307 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+# A Podcast generation slower than this many seconds is logged with the
+# time of each stage, 0 for no slow generation log
+SLOW_GENERATION_SECONDS = float(os.getenv("SLOW_GENERATION_SECONDS", "0"))
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120,
+                   300)
+# Generation stages, in the order of the slow generation log
+STAGES = ("search", "script", "tts", "assemble", "export")
+
+
+def _labels(names, values):
+    """
+    Formats the labels of a sample in the Prometheus text format
+    """
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Prometheus counter with labels, shared by all the threads of the process
+    """
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Adds to the counter of the labels
+        :param amount: how much to add
+        :param labels: the value of each label
+        """
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        """
+        :return: the lines of the counter in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} "
+                             f"{value}")
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram with labels, shared by all the threads of the
+    process
+    """
+    def __init__(self, name, help_text, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Records one measurement
+        :param value: the measurement, e.g. seconds
+        :param labels: the value of each label
+        """
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            values = self._values.setdefault(
+                key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def totals(self):
+        """
+        :return: Dictionary of the label values to the sum and count of
+        their measurements
+        """
+        with self._lock:
+            return {key: (values[-2], values[-1])
+                    for key, values in self._values.items()}
+
+    def render(self):
+        """
+        :return: the lines of the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{self.name}_bucket"
+                                 f"{_labels(names, key + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket"
+                             f"{_labels(names, key + ('+Inf',))} "
+                             f"{values[-1]}")
+                labels = _labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {values[-2]:.6f}")
+                lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "podcast_stage_seconds", "Time spent in each Podcast generation stage",
+    ("stage", "provider"))
+generation_seconds = Histogram(
+    "podcast_generation_seconds", "Time to create a whole Podcast",
+    ("provider", "status"))
+tokens_total = Counter(
+    "podcast_tokens_total", "Tokens used by the AI providers",
+    ("provider", "kind"))
+audio_bytes_total = Counter(
+    "podcast_audio_bytes_total", "Bytes of the Podcast audio files created",
+    ("provider",))
+provider_calls_total = Counter(
+    "provider_calls_total", "Attempts of provider API calls, by outcome",
+    ("provider", "outcome"))
+scripts_total = Counter(
+    "podcast_scripts_total",
+    "Podcast scripts, written by the AI provider or reused from the cache",
+    ("provider", "source"))
+METRICS = (stage_seconds, generation_seconds, tokens_total,
+           audio_bytes_total, provider_calls_total, scripts_total)
+
+
+class Generation:
+    """
+    What one Podcast generation cost: the time of each stage, summed over
+    its calls, the tokens and the audio bytes. The TTS calls of a Podcast
+    run concurrently, so their total time may exceed the generation time.
+    The turns of its transcript are collected as they are assembled, with
+    their start in the audio, and the digest of the news its script is
+    based on is kept for a later re-voice
+    """
+    def __init__(self, topic):
+        self.topic = topic
+        self.provider = None
+        self.seconds = 0.0
+        self.stages = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.audio_bytes = 0
+        self.transcript = []   # tuples of speaker, text and start in ms
+        self.news_digest = None
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_tokens(self, prompt, completion):
+        with self._lock:
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+
+    def add_turn(self, speaker, text, start_ms):
+        with self._lock:
+            self.transcript.append((speaker, text, start_ms))
+
+    def restart(self):
+        # the turns and news of a failed attempt, before a fallback one
+        with self._lock:
+            self.transcript.clear()
+            self.news_digest = None
+
+
+# The generation that the current thread works for. The worker threads of a
+# generation run in a copy of its context, see workers.synthesize_in_order
+_current = contextvars.ContextVar("generation", default=None)
+
+
+@contextmanager
+def track_generation(topic):
+    """
+    Measures a Podcast generation: the stages, tokens and bytes recorded
+    while it runs are added to the Generation it yields. The provider and
+    audio_bytes of the Generation are set by the caller
+    :param topic: Podcast topic
+    :return: context manager yielding the Generation
+    """
+    generation = Generation(topic)
+    token = _current.set(generation)
+    started = time.perf_counter()
+    status = "failed"
+    try:
+        yield generation
+        status = "done"
+    finally:
+        _current.reset(token)
+        generation.seconds = time.perf_counter() - started
+        generation_seconds.observe(generation.seconds,
+                                   provider=generation.provider or "none",
+                                   status=status)
+        if generation.audio_bytes:
+            audio_bytes_total.inc(generation.audio_bytes,
+                                  provider=generation.provider)
+        if SLOW_GENERATION_SECONDS and (
+                generation.seconds > SLOW_GENERATION_SECONDS):
+            stages = ", ".join(
+                f"{stage} {generation.stages[stage]:.1f}s"
+                for stage in STAGES if stage in generation.stages)
+            print(f"Slow Podcast generation ({status}), "
+                  f"{generation.seconds:.1f}s: {generation.topic} "
+                  f"({generation.provider}) {stages}")
+
+
+def observe(stage, provider, seconds):
+    """
+    Records the time of a generation stage
+    :param stage: one of STAGES
+    :param provider: the provider the stage works with
+    :param seconds: the time spent
+    """
+    stage_seconds.observe(seconds, stage=stage, provider=provider)
+    generation = _current.get()
+    if generation:
+        generation.add_stage(stage, seconds)
+
+
+@contextmanager
+def span(stage, provider):
+    """
+    Records the time of the code in the with block as a generation stage
+    :param stage: one of STAGES
+    :param provider: the provider the stage works with
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, provider, time.perf_counter() - started)
+
+
+def record_tokens(provider, prompt, completion):
+    """
+    Records the tokens that the provider reports for a request
+    :param provider: the AI provider
+    :param prompt: the prompt, or input, tokens
+    :param completion: the completion, or output, tokens
+    """
+    prompt = prompt or 0
+    completion = completion or 0
+    tokens_total.inc(prompt, provider=provider, kind="prompt")
+    tokens_total.inc(completion, provider=provider, kind="completion")
+    generation = _current.get()
+    if generation:
+        generation.add_tokens(prompt, completion)
+
+
+def record_script(provider, news_digest, cached):
+    """
+    Records where the script of the current generation comes from
+    :param provider: the AI provider that voices the script
+    :param news_digest: the digest of the news the script is based on
+    :param cached: True if the script comes from the script cache, which
+    saves a script request
+    """
+    scripts_total.inc(provider=provider,
+                      source="cache" if cached else "written")
+    generation = _current.get()
+    if generation:
+        generation.news_digest = news_digest
+
+
+def record_turn(speaker, text, start_ms):
+    """
+    Adds a dialogue turn to the transcript of the current generation. The
+    turns are recorded in the order of the audio
+    :param speaker: the host name
+    :param text: what the host says
+    :param start_ms: where the turn starts in the Podcast audio, in ms
+    """
+    generation = _current.get()
+    if generation:
+        generation.add_turn(speaker, text, start_ms)
+
+
+def render():
+    """
+    :return: all the metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
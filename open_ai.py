@@ -1,16 +1,31 @@
-import openai
-from pydub import AudioSegment
+import asyncio
 import os
-import re
+import time
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from typing import List
-from tavili import tavili_answer
+from jobs import report
+from workers import synthesize_in_order, synthesize_in_order_async
+from audio import PcmEncoder, PodcastAssembler
+from mastering import AUDIO_MASTERING, PodcastMixer
+from cache import clip_cache
+from ratelimit import estimate_tokens, rate_limits, SCRIPT_TOKENS
+from gateway import (call, call_async, openai_async_client, openai_client,
+                     SCRIPT_DEADLINE, TTS_DEADLINE, TTS_HEDGE_SECONDS,
+                     TTS_RETRIES)
+from metrics import observe, record_tokens, record_turn, span
+from providers import is_male_voice
+from scripts import script_cache, script_source, script_source_async
+from storage import AUDIO_FOLDER, staging_path
 
 load_dotenv()
-# Set up your OpenAI API key
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+TTS_MODEL = "gpt-4o-mini-tts"
+# The clips are post-processed as raw 24 kHz 16 bit PCM, which needs no
+# decoding, or else appended to the Podcast as the MP3 frames they are
+TTS_FORMAT = "pcm" if AUDIO_MASTERING else "mp3"
+# Dialogue turns of a typical script, to estimate the progress until the
+# whole script is known
+EXPECTED_TURNS = 12
 
 # Define OpenAI structured output classes:
 class DialogueTurn(BaseModel):
@@ -21,16 +36,17 @@ class Dialogue(BaseModel):
     turns: List[DialogueTurn]
 
 
-def generate_dialogue(topic, options_dic):
+def dialogue_prompt(topic, options_dic, news):
     """
-    Generate the Podcast text, using OpenAI
+    Writes the prompt of the Podcast script
     :param topic: Podcast topic
     :param options_dic: Dictionary with the Podcast settings
-    :return: the Podcast text parsed
+    :param news: the latest news about the topic
+    :return: the prompt text
     """
     host_gender = []
     for i in range(2): # get gender from names
-        if options_dic[f'host{i+1}_voice'] in ["ash","echo","onyx","verse"]:
+        if is_male_voice("OpenAI", options_dic[f'host{i+1}_voice']):
             host_gender.append("male")
         else:
             host_gender.append("female")
@@ -62,7 +78,7 @@ def generate_dialogue(topic, options_dic):
     ... (alternate for ~320 words)
     End with a motivational or surprising takeaway.
 
-    Latest news: {tavili_answer(topic)}
+    Latest news: {news}
     Topic: "{topic}"
 
     Instructions:
@@ -73,8 +89,14 @@ def generate_dialogue(topic, options_dic):
     - Output only the script, with no extra text.
     {hosts_check}
     """
+    return prompt
 
-    completion = client.beta.chat.completions.parse(
+
+def script_request(prompt, timeout):
+    """
+    :return: the arguments of the streamed chat completion of the script
+    """
+    return dict(
         model="gpt-4o-mini",
         messages=[
             {
@@ -85,7 +107,69 @@ def generate_dialogue(topic, options_dic):
                 "role": "user",
                 "content": prompt}],
         response_format=Dialogue,
+        stream_options={"include_usage": True},
+        timeout=timeout,
     )
+
+
+def completed_turns(event, sent):
+    """
+    :param event: an event of the script stream
+    :param sent: the number of turns already yielded
+    :return: list of the DialogueTurn that the event completes
+    """
+    if event.type != "content.delta" or not event.parsed:
+        return []
+    # event.parsed is the JSON received so far, parsed leniently:
+    # a turn is complete once the next one has started
+    turns = event.parsed.get("turns") or []
+    return [DialogueTurn(**turn) for turn in turns[sent:len(turns) - 1]]
+
+
+def generate_dialogue(topic, options_dic, news):
+    """
+    Generate the Podcast text, using OpenAI. The script is streamed and
+    each dialogue turn is yielded as soon as the model has finished writing
+    it, so that it can be converted to audio while the next turns are
+    still being written
+    :param topic: Podcast topic
+    :param options_dic: Dictionary with the Podcast settings
+    :param news: the latest news about the topic
+    :return: generator of the parsed DialogueTurn of the Podcast text
+    """
+    prompt = dialogue_prompt(topic, options_dic, news)
+
+    def open_stream(timeout):
+        # The request is sent, and retried, until the stream starts; a
+        # stream that breaks later fails the Podcast
+        return openai_client().beta.chat.completions.stream(
+            **script_request(prompt, timeout)).__enter__()
+
+    script_tokens = estimate_tokens(prompt) + SCRIPT_TOKENS
+    sent = 0
+    with span("script", "OpenAI"), call("OpenAI", open_stream,
+                                         SCRIPT_DEADLINE,
+                                         tokens=script_tokens) as stream:
+        for event in stream:
+            for turn in completed_turns(event, sent):
+                yield turn
+                sent += 1
+        completion = stream.get_final_completion()
+    yield from remaining_turns(completion, script_tokens, sent)
+
+
+def remaining_turns(completion, script_tokens, sent):
+    """
+    Records the token usage of the complete script
+    :param completion: the final completion of the script stream
+    :param script_tokens: the tokens estimated for the rate limits
+    :param sent: the number of turns already yielded
+    :return: list of the last DialogueTurn, not yielded yet
+    """
+    rate_limits["OpenAI"].settle(script_tokens,
+                                 completion.usage.total_tokens)
+    record_tokens("OpenAI", completion.usage.prompt_tokens,
+                  completion.usage.completion_tokens)
     dialogue = completion.choices[0].message
     # Token usage breakdown
     print("\n--- Token Usage ---")
@@ -96,53 +180,73 @@ def generate_dialogue(topic, options_dic):
     if (dialogue.refusal):
         raise Exception(dialogue.refusal)
     else:
-        return dialogue.parsed
+        return dialogue.parsed.turns[sent:]
 
 
-def text_to_audio(text, voice, mood, filename):
+def script_turns(dialogue):
     """
-    Converts given text to audio
-    :param text: text to convert
-    :param voice: voice chosen by user
-    :param mood: mood chosen by user
-    :param filename: the name of the audio file to be created
-    :return: an audio file with the given text converted to audio
+    :param dialogue: list of the DialogueTurn of a script
+    :return: the turns as (speaker, text) pairs, for the script cache
     """
-    with client.audio.speech.with_streaming_response.create(
-        model="gpt-4o-mini-tts",
-        voice=voice,
-        input=text,
-        instructions=f"Speak in a {mood} tone."
-    )as response:
-        response.stream_to_file(filename)
+    return [(turn.speaker, turn.text) for turn in dialogue]
 
 
-def clean_path(path):
+def cached_dialogue(turns):
     """
-    Gets rid of illegal path characters
-    :param path: the string to clean
-    :return: the path with no illegal characters
+    :param turns: the (speaker, text) pairs of a cached script
+    :return: list of the DialogueTurn of the script
     """
-    if os.name == 'nt':  # Windows
-        return re.sub(r'[<>:"/\\|?*]', '', path)
-    else:  # POSIX
-        return re.sub(r'[\/\0]', '', path)
+    return [DialogueTurn(speaker=speaker, text=text)
+            for speaker, text in turns]
 
 
-def ai_create_podcast(topic, options_dic):
+def clip_key(text, voice, mood):
     """
-    Creates the Podcast: Text is generated via the generate_dialogue
-    function, and then it is converted to audio via the text_to_audio
-    function. Finally, all audio segments of the podcast dialogue are
-    concatenated in one final audio file, with music intro and outro
-    :param topic: Podcast topic
-   :param options_dic: Dictionary with the Podcast settings
-   :return: the Podcast audio file
+    :return: the TTS instructions of the mood, and the TTS clip cache key
+    """
+    instructions = f"Speak in a {mood} tone."
+    model = TTS_MODEL if TTS_FORMAT == "mp3" else f"{TTS_MODEL}/{TTS_FORMAT}"
+    return instructions, clip_cache.key("OpenAI", model, voice,
+                                        instructions, text)
+
+
+def text_to_audio(text, voice, mood):
+    """
+    Converts given text to audio. Clips already synthesized with the same
+    text, voice and mood come from the TTS clip cache
+    :param text: text to convert
+    :param voice: voice chosen by user
+    :param mood: mood chosen by user
+    :return: the audio of the text in TTS_FORMAT, streamed into memory
+    """
+    instructions, key = clip_key(text, voice, mood)
+    audio = clip_cache.get(key)
+    if audio is None:
+        def speak(timeout):
+            with openai_client().audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=voice,
+                input=text,
+                instructions=instructions,
+                response_format=TTS_FORMAT,
+                timeout=timeout
+            )as response:
+                return b"".join(response.iter_bytes())
+
+        with span("tts", "OpenAI"):
+            audio = call("OpenAI", speak, TTS_DEADLINE, retries=TTS_RETRIES,
+                         tokens=estimate_tokens(instructions + text),
+                         hedge_after=TTS_HEDGE_SECONDS)
+        clip_cache.put(key, audio)
+    return audio
+
+
+def host_voice(options_dic, speaker):
+    """
+    :param options_dic: Dictionary with the Podcast settings
+    :param speaker: the name of a host
+    :return: the voice and the mood of the host
     """
-    print(f"Generating podcast for the topic: {topic}")
-    dialogue = generate_dialogue(topic, options_dic)
-    print("Podcast Text:", dialogue.turns)
-    print("Podcast generated. Converting to audio...")
     speaker_to_voice = {
         options_dic['host1_name']: options_dic['host1_voice'],
         options_dic['host2_name']: options_dic['host2_voice']
@@ -151,28 +255,216 @@ def ai_create_podcast(topic, options_dic):
         options_dic['host1_name']: options_dic['host1_mood'],
         options_dic['host2_name']: options_dic['host2_mood']
     }
-    audio_segments = []
-    audio_segment = 0
-    for turn in dialogue.turns:
-        audio_segment += 1
-        text = turn.text
-        voice=speaker_to_voice[turn.speaker]
-        mood = speaker_to_mood[turn.speaker]
-        filename = f"{audio_segment}.mp3"
-        text_to_audio(text, voice, mood, filename)
-        audio_segments.append(filename)
-
-    print("Generated audio files:", audio_segments)
-
-    combined = AudioSegment.from_mp3("static/audio/mind-intro.mp3")
-    for filename in audio_segments:
-        combined += AudioSegment.from_mp3(filename)
-        os.remove(filename)
-    combined += AudioSegment.from_mp3("static/audio/mind-intro.mp3")
-    # Export the combined file
-    podcast_path = os.path.join(os.getcwd(), "static/audio",
-                                f"{clean_path(topic)}.mp3")
-    combined.export(podcast_path, format='mp3')
-
-    print("Final podcast exported as podcast_final.mp3")
-    return f"{clean_path(topic)}.mp3"
\ No newline at end of file
+    return speaker_to_voice[speaker], speaker_to_mood[speaker]
+
+
+def ai_create_podcast(topic, options_dic, progress=None):
+    """
+    Creates the Podcast: Text is generated via the generate_dialogue
+    function, or reused from the script cache, and then it is converted to
+    audio via the text_to_audio function. Finally, all audio segments of
+    the podcast dialogue are leveled, crossfaded and concatenated in one
+    final audio file, with music intro and outro
+    :param topic: Podcast topic
+   :param options_dic: Dictionary with the Podcast settings
+   :param progress: optional callback(stage, percent) for job status
+   :return: the Podcast audio file, in the staging folder, relative to
+   AUDIO_FOLDER
+    """
+    print(f"Generating podcast for the topic: {topic}")
+    report(progress, "script", 5)
+    turns = []   # the turns of the script written so far
+    script_done = False
+
+    def script():
+        nonlocal script_done
+        cached, news, key = script_source("OpenAI", topic, options_dic)
+        if cached is None:
+            dialogue = generate_dialogue(topic, options_dic, news)
+        else:   # only the voices differ, the script is the same
+            dialogue = cached_dialogue(cached)
+        for turn in dialogue:
+            print(f"{turn.speaker}: {turn.text}")
+            turns.append(turn)
+            yield turn
+        if cached is None:
+            script_cache.set(key, script_turns(turns))
+        script_done = True
+        print("Podcast generated.")
+
+    def synthesize(turn):
+        return text_to_audio(turn.text, *host_voice(options_dic, turn.speaker))
+
+    # The turns are synthesized concurrently, while the script is still
+    # being written, and appended in dialogue order to the file, straight
+    # from memory, as soon as each one is ready
+    podcast_path = staging_path("mp3")
+    with (PcmEncoder(podcast_path) if AUDIO_MASTERING
+          else PodcastAssembler(podcast_path)) as output:
+        assembler = PodcastMixer(output) if AUDIO_MASTERING else output
+        assembler.add_intro()
+        done = 0
+        percent = 20
+        for segment in synthesize_in_order("OpenAI", synthesize, script()):
+            with span("assemble", "OpenAI"):
+                start_ms = assembler.add(segment)
+            turn = turns[done]
+            record_turn(turn.speaker, turn.text, start_ms)
+            done += 1
+            total = len(turns) if script_done else max(len(turns),
+                                                      EXPECTED_TURNS)
+            percent = max(percent, 20 + 70 * done / total)
+            if done == 1:   # enough audio to start playing the Podcast
+                report(progress, "audio", percent,
+                       live_file=os.path.relpath(output.part_path,
+                                                 AUDIO_FOLDER))
+            else:
+                report(progress, "audio", percent)
+        report(progress, "export", 90)
+        export_started = time.perf_counter()
+        assembler.add_intro()
+        if AUDIO_MASTERING:
+            assembler.flush()
+    observe("export", "OpenAI", time.perf_counter() - export_started)
+
+    print(f"Final podcast exported as {podcast_path}")
+    return os.path.relpath(podcast_path, AUDIO_FOLDER)
+
+
+async def generate_dialogue_async(topic, options_dic, news):
+    """
+    Like generate_dialogue(), with the async OpenAI client
+    :param topic: Podcast topic
+    :param options_dic: Dictionary with the Podcast settings
+    :param news: the latest news about the topic
+    :return: async generator of the parsed DialogueTurn of the Podcast text
+    """
+    prompt = dialogue_prompt(topic, options_dic, news)
+
+    async def open_stream(timeout):
+        return await openai_async_client().beta.chat.completions.stream(
+            **script_request(prompt, timeout)).__aenter__()
+
+    script_tokens = estimate_tokens(prompt) + SCRIPT_TOKENS
+    sent = 0
+    with span("script", "OpenAI"):
+        async with await call_async("OpenAI", open_stream, SCRIPT_DEADLINE,
+                                    tokens=script_tokens) as stream:
+            async for event in stream:
+                for turn in completed_turns(event, sent):
+                    yield turn
+                    sent += 1
+            completion = await stream.get_final_completion()
+    for turn in remaining_turns(completion, script_tokens, sent):
+        yield turn
+
+
+async def text_to_audio_async(text, voice, mood):
+    """
+    Like text_to_audio(), with the async OpenAI client. The TTS clip cache
+    is read and written in a worker thread
+    :param text: text to convert
+    :param voice: voice chosen by user
+    :param mood: mood chosen by user
+    :return: the audio of the text in TTS_FORMAT
+    """
+    instructions, key = clip_key(text, voice, mood)
+    audio = await asyncio.to_thread(clip_cache.get, key)
+    if audio is None:
+        async def speak(timeout):
+            async with openai_async_client().audio.speech \
+                    .with_streaming_response.create(
+                        model=TTS_MODEL,
+                        voice=voice,
+                        input=text,
+                        instructions=instructions,
+                        response_format=TTS_FORMAT,
+                        timeout=timeout) as response:
+                return await response.read()
+
+        with span("tts", "OpenAI"):
+            audio = await call_async(
+                "OpenAI", speak, TTS_DEADLINE, retries=TTS_RETRIES,
+                tokens=estimate_tokens(instructions + text),
+                hedge_after=TTS_HEDGE_SECONDS)
+        await asyncio.to_thread(clip_cache.put, key, audio)
+    return audio
+
+
+async def ai_create_podcast_async(topic, options_dic, progress=None):
+    """
+    Like ai_create_podcast(), for the async generation engine: the script
+    and the TTS calls are awaited in the event loop, and only the audio
+    processing and the file writes run in worker threads
+    :param topic: Podcast topic
+    :param options_dic: Dictionary with the Podcast settings
+    :param progress: optional callback(stage, percent) for job status
+    :return: the Podcast audio file, in the staging folder, relative to
+    AUDIO_FOLDER
+    """
+    print(f"Generating podcast for the topic: {topic}")
+    report(progress, "script", 5)
+    turns = []   # the turns of the script written so far
+    script_done = False
+
+    async def script():
+        nonlocal script_done
+        cached, news, key = await script_source_async("OpenAI", topic,
+                                                      options_dic)
+        if cached is None:
+            dialogue = generate_dialogue_async(topic, options_dic, news)
+            async for turn in dialogue:
+                print(f"{turn.speaker}: {turn.text}")
+                turns.append(turn)
+                yield turn
+            await asyncio.to_thread(script_cache.set, key,
+                                    script_turns(turns))
+        else:
+            for turn in cached_dialogue(cached):
+                print(f"{turn.speaker}: {turn.text}")
+                turns.append(turn)
+                yield turn
+        script_done = True
+        print("Podcast generated.")
+
+    async def synthesize(turn):
+        return await text_to_audio_async(
+            turn.text, *host_voice(options_dic, turn.speaker))
+
+    podcast_path = staging_path("mp3")
+    output = await asyncio.to_thread(
+        PcmEncoder if AUDIO_MASTERING else PodcastAssembler, podcast_path)
+    try:
+        assembler = PodcastMixer(output) if AUDIO_MASTERING else output
+        await asyncio.to_thread(assembler.add_intro)
+        done = 0
+        percent = 20
+        async for segment in synthesize_in_order_async("OpenAI", synthesize,
+                                                       script()):
+            with span("assemble", "OpenAI"):
+                start_ms = await asyncio.to_thread(assembler.add, segment)
+            turn = turns[done]
+            record_turn(turn.speaker, turn.text, start_ms)
+            done += 1
+            total = len(turns) if script_done else max(len(turns),
+                                                      EXPECTED_TURNS)
+            percent = max(percent, 20 + 70 * done / total)
+            if done == 1:   # enough audio to start playing the Podcast
+                report(progress, "audio", percent,
+                       live_file=os.path.relpath(output.part_path,
+                                                 AUDIO_FOLDER))
+            else:
+                report(progress, "audio", percent)
+        report(progress, "export", 90)
+        export_started = time.perf_counter()
+        await asyncio.to_thread(assembler.add_intro)
+        if AUDIO_MASTERING:
+            await asyncio.to_thread(assembler.flush)
+    except BaseException:   # also when the generation is cancelled
+        output.abort()
+        raise
+    await asyncio.to_thread(output.close)
+    observe("export", "OpenAI", time.perf_counter() - export_started)
+
+    print(f"Final podcast exported as {podcast_path}")
+    return os.path.relpath(podcast_path, AUDIO_FOLDER)
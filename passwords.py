@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from werkzeug.security import check_password_hash, generate_password_hash
+
+load_dotenv()
+# scrypt cost of the new password hashes: N (CPU and memory, a power of 2),
+# r (block size) and p (parallelism). Each hash takes 128 * N * r bytes.
+# The hash of a user made with other parameters is replaced at their next
+# login
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 15)))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+PASSWORD_METHOD = (f"scrypt:{PASSWORD_SCRYPT_N}:{PASSWORD_SCRYPT_R}:"
+                   f"{PASSWORD_SCRYPT_P}")
+PASSWORD_SALT_LENGTH = 16
+# Processes that hash and check the passwords, so that a burst of logins
+# does not stall the other requests; 0 to do it in the request thread
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS",
+                                 str(min(4, os.cpu_count() or 1))))
+# Password hashes that may wait for a free process. Beyond that, logins
+# and registrations are refused until the burst is over
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", "32"))
+# Longest wait for a hash, queue included
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", "10"))
+
+
+class PasswordQueueFullError(Exception):
+    """
+    Raised when too many password hashes are waiting for a process
+    """
+
+
+# Errors of a hash or check that could not be done right now, because of
+# the load or of a dead process: the login may be tried again later
+HASHER_BUSY_ERRORS = (PasswordQueueFullError, TimeoutError, BrokenProcessPool)
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords in a pool of processes, started on first
+    use. At most workers + max_queued hashes are running or waiting, the
+    others are refused with PasswordQueueFullError
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max(workers, 1)
+                                                 + max_queued)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawned, a fork would copy the threads of the app
+                self._pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _run(self, fn, *args):
+        """
+        Runs fn(*args) in a process of the pool, or in this thread without
+        workers
+        :return: the result of fn
+        """
+        if not self._slots.acquire(blocking=False):
+            raise PasswordQueueFullError("Too many logins right now. "
+                                         "Please try again in a moment.")
+        try:
+            if not self.workers:
+                return fn(*args)
+            pool = self._executor()
+            future = pool.submit(fn, *args)
+            try:
+                return future.result(timeout=PASSWORD_TIMEOUT)
+            except TimeoutError:   # still queued, do not hash it for nobody
+                future.cancel()
+                raise
+            except BrokenProcessPool:   # a process died, e.g. out of memory
+                with self._lock:
+                    if self._pool is pool:
+                        self._pool = None
+                raise
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """
+        :param password: the password
+        :return: the scrypt hash of the password, with PASSWORD_METHOD
+        """
+        return self._run(generate_password_hash, password, PASSWORD_METHOD,
+                         PASSWORD_SALT_LENGTH)
+
+    def check(self, password_hash, password):
+        """
+        :param password_hash: the stored hash
+        :param password: the password to check
+        :return: True if the password matches the hash
+        """
+        return self._run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """
+    Checks if a stored hash was made with other parameters than the
+    current ones
+    :param password_hash: the stored hash
+    :return: True if the hash should be replaced
+    """
+    return password_hash.split("$", 1)[0] != PASSWORD_METHOD
+
+
+hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_SIZE)
@@ -0,0 +1,196 @@
+"""
+Pre-generates Podcasts in bulk, e.g. every morning for the trending topics.
+Reads a file with one topic per line, or one JSON object per line with a
+"topic" and the settings that replace the default ones, skips the topics
+that already have a Podcast and creates the others concurrently, within
+the requests and tokens per minute limits of each AI provider. The
+Podcasts are stored in the app database and audio folder.
+
+Run from the repository root:
+    python pregenerate.py topics.txt [--workers 4] [--options options.json]
+                          [--openai-rpm 500] [--openai-tpm 200000] ...
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy.exc import OperationalError
+from app import (app, claim_generation_lease, create_podcast, db,
+                 default_options, GenerationLease, init_db, Podcast,
+                 record_job_progress, release_generation_lease, utc_now)
+from cache import normalize_topic
+from ratelimit import PROVIDER_LIMITS, rate_limits
+
+AI_MODELS = ("OpenAI", "Gemini")
+
+
+def read_topics(path, defaults):
+    """
+    Reads the topics file. Empty lines and lines starting with # are
+    ignored, and so are repeated topics
+    :param path: the topics file
+    :param defaults: Dictionary with the default Podcast settings
+    :return: list of (topic, settings)
+    """
+    entries = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            options = dict(defaults)
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise SystemExit(f"{path}:{number}: {e}")
+                topic = str(entry.pop("topic", "")).strip()
+                options.update(entry)
+            else:
+                topic = line
+            if options["ai_model"] not in AI_MODELS:
+                raise SystemExit(f"{path}:{number}: unknown ai_model "
+                                 f"{options['ai_model']}")
+            key = normalize_topic(topic)
+            if key and key not in seen:
+                seen.add(key)
+                entries.append((topic, options))
+    return entries
+
+
+def is_pending(topic):
+    """
+    Checks if a topic still needs a Podcast: it has none yet, or its audio
+    file was evicted, and the web app is not generating it right now
+    :param topic: Podcast topic
+    :return: True if the Podcast must be generated
+    """
+    key = normalize_topic(topic)
+    podcast = Podcast.query.filter_by(normalized_title=key).first()
+    if podcast and not podcast.needs_regeneration:
+        return False
+    lease = db.session.get(GenerationLease, key)
+    return not (lease and lease.expires_at > utc_now())
+
+
+def generate(topic, options):
+    """
+    Creates one Podcast, in a worker thread. The topic lease is taken
+    like the web app does, so that a request for the same topic does not
+    generate it at the same time, and renewed with the progress
+    :param topic: Podcast topic
+    :param options: Dictionary with the Podcast settings
+    :return: the generation time in seconds, None if the topic was
+    generated meanwhile or is being generated by the web app
+    """
+    started = time.perf_counter()
+    lease_id = uuid.uuid4().hex
+    key = normalize_topic(topic)
+    with app.app_context():
+        if not is_pending(topic) or not claim_generation_lease(
+                key, lease_id, db.session.get(GenerationLease, key)):
+            db.session.rollback()
+            return None
+        db.session.commit()
+
+        engine = db.engine  # progress may be reported from other threads
+
+        def progress(stage, percent, **details):
+            try:
+                record_job_progress(engine, lease_id, {})
+            except OperationalError as e:   # e.g. locked, the next one renews
+                print(f"Lease of {topic} not renewed: {e}")
+
+        try:
+            create_podcast(topic, options, progress)
+        finally:
+            db.session.rollback()
+            release_generation_lease(lease_id)
+    return time.perf_counter() - started
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pre-generate Podcasts for a list of topics")
+    parser.add_argument("topics", help="file with one topic per line, or "
+                        "one JSON object with a topic and settings per line")
+    parser.add_argument("--options", help="JSON file with the settings of "
+                        "all the Podcasts, instead of the app defaults")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Podcasts generated at the same time")
+    for provider, (rpm, tpm) in PROVIDER_LIMITS.items():
+        name = provider.lower()
+        parser.add_argument(f"--{name}-rpm", type=int, default=rpm,
+                            help=f"{provider} requests per minute, "
+                                 f"0 for no limit")
+        if provider != "Tavily":   # Tavily counts requests only
+            parser.add_argument(f"--{name}-tpm", type=int, default=tpm,
+                                help=f"{provider} tokens per minute, "
+                                     f"0 for no limit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for provider, limiter in rate_limits.items():
+        name = provider.lower()
+        limiter.configure(getattr(args, f"{name}_rpm"),
+                          getattr(args, f"{name}_tpm", 0))
+    defaults = dict(default_options)
+    if args.options:
+        with open(args.options, encoding="utf-8") as f:
+            defaults.update(json.load(f))
+    entries = read_topics(args.topics, defaults)
+    with app.app_context():
+        init_db()
+        todo = [(topic, options) for topic, options in entries
+                if is_pending(topic)]
+    skipped = len(entries) - len(todo)
+    print(f"{len(todo)} Podcasts to generate, {skipped} already exist or "
+          f"are being generated")
+
+    started = time.perf_counter()
+    failures = []
+    durations = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(generate, topic, options): topic
+                   for topic, options in todo}
+        for number, future in enumerate(as_completed(futures), 1):
+            topic = futures[future]
+            try:
+                seconds = future.result()
+                if seconds is None:
+                    skipped += 1
+                    print(f"[{number}/{len(todo)}] {topic}: skipped, "
+                          f"generated by the web app")
+                    continue
+                durations.append(seconds)
+                print(f"[{number}/{len(todo)}] {topic}: "
+                      f"done in {durations[-1]:.1f}s")
+            except Exception as e:
+                failures.append((topic, e))
+                print(f"[{number}/{len(todo)}] {topic}: failed, {e}")
+    elapsed = time.perf_counter() - started
+
+    rate = len(durations) / elapsed * 60 if elapsed else 0.0
+    print(f"\nGenerated {len(durations)} Podcasts, skipped {skipped}, "
+          f"failed {len(failures)} in {elapsed:.1f}s "
+          f"({rate:.2f} Podcasts per minute)")
+    if durations:
+        print(f"Generation time: {sum(durations) / len(durations):.1f}s "
+              f"on average, {max(durations):.1f}s at most")
+    print(f"{'provider':>8} {'requests':>9} {'tokens':>9} {'waited s':>9}")
+    for provider, limiter in rate_limits.items():
+        stats = limiter.stats()
+        print(f"{provider:>8} {stats['requests']:>9} {stats['tokens']:>9} "
+              f"{stats['waited']:>9}")
+    for topic, error in failures:
+        print(f"Failed: {topic}: {error}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
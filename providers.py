@@ -0,0 +1,87 @@
+"""
+Registry of the AI providers that create the Podcasts, keyed by the
+ai_model setting. A provider module, with its SDK, is imported the first
+time a Podcast is created with it, so that a worker process that only
+serves pages starts without loading the openai, google-genai and pydantic
+packages.
+"""
+import importlib
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+# Module, functions that create the Podcast audio, for the threads and
+# for the asyncio generation engines, and SDK of the module, per provider
+PROVIDERS = {
+    "OpenAI": ("open_ai", "ai_create_podcast", "ai_create_podcast_async",
+               "openai"),
+    "Gemini": ("gemini", "gemini_create_podcast",
+               "gemini_create_podcast_async", "google.genai"),
+}
+# Load all the providers when the app starts instead, e.g. in the master
+# process of a pre-forking server, so that the workers share them
+PRELOAD_PROVIDERS = os.getenv("PRELOAD_PROVIDERS", "") == "1"
+# The OpenAI voices that sound male, the others sound female
+OPENAI_MALE_VOICES = ["ash", "echo", "onyx", "verse"]
+# The Gemini voices that sound female, the others sound male
+GEMINI_FEMALE_VOICES = ["Kore", "Leda", "Aoede", "Callirrhoe", "Autonoe",
+                        "Despina", "ErinomeErinome", "Laomedeia", "Achernar",
+                        "Gacrux", "Pulcherrima", "Vindemiatrix", "Sulafat"]
+
+_creators = {}
+_async_creators = {}
+# Seconds each provider module took to import, for the startup reports
+load_seconds = {}
+_lock = threading.Lock()
+
+
+def podcast_creator(ai_model, asynchronous=False):
+    """
+    Gets the function of a provider that creates the Podcast audio,
+    importing its module and SDK on first use
+    :param ai_model: the provider, a key of PROVIDERS
+    :param asynchronous: True for the coroutine function of the asyncio
+    generation engine
+    :return: function(topic, options, progress) returning the audio file
+    """
+    creators = _async_creators if asynchronous else _creators
+    creator = creators.get(ai_model)
+    if creator:
+        return creator
+    if ai_model not in PROVIDERS:
+        raise ValueError(f"Unknown AI model: {ai_model}")
+    with _lock:
+        if ai_model not in creators:
+            module_name, function, async_function, sdk = PROVIDERS[ai_model]
+            started = time.perf_counter()
+            module = importlib.import_module(module_name)
+            importlib.import_module(sdk)
+            if ai_model not in load_seconds:
+                load_seconds[ai_model] = time.perf_counter() - started
+                print(f"{ai_model} provider loaded in "
+                      f"{load_seconds[ai_model]:.2f}s")
+            _creators.setdefault(ai_model, getattr(module, function))
+            _async_creators.setdefault(ai_model,
+                                       getattr(module, async_function))
+        return creators[ai_model]
+
+
+def preload():
+    """
+    Imports all the provider modules now
+    """
+    for ai_model in PROVIDERS:
+        podcast_creator(ai_model)
+
+
+def is_male_voice(ai_model, voice):
+    """
+    :param ai_model: the provider of the voice
+    :param voice: the voice name
+    :return: True if the voice sounds male
+    """
+    if ai_model == "OpenAI":
+        return voice in OPENAI_MALE_VOICES
+    return voice not in GEMINI_FEMALE_VOICES
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+# Requests and tokens per minute allowed per AI provider, 0 for no limit.
+# Tavily has no tokens, its calls are only counted as requests
+PROVIDER_LIMITS = {
+    "OpenAI": (int(os.getenv("OPENAI_RPM", "0")),
+               int(os.getenv("OPENAI_TPM", "0"))),
+    "Gemini": (int(os.getenv("GEMINI_RPM", "0")),
+               int(os.getenv("GEMINI_TPM", "0"))),
+    "Tavily": (int(os.getenv("TAVILY_RPM", "0")), 0),
+}
+# Tokens written by the model for a typical script, added to the prompt
+# tokens of a script request until the provider reports the real usage
+SCRIPT_TOKENS = 600
+
+
+def estimate_tokens(text):
+    """
+    Rough token count of a text, about 4 characters per token
+    :param text: the text of a request
+    :return: the estimated number of tokens
+    """
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at per_minute tokens per minute, up
+    to one minute worth of tokens. Callers reserve tokens, possibly going
+    into debt, and wait until the debt is paid back: the waiting callers
+    are served in the order in which they came.
+    """
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes tokens from the bucket
+        :param amount: the number of tokens
+        :return: seconds to wait before the tokens are really available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + self.rate * (
+                now - self._updated))
+            self._updated = now
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, amount):
+        """
+        Gives back tokens that were reserved but not used
+        :param amount: the number of tokens
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class RateLimiter:
+    """
+    Requests per minute and tokens per minute limits of an AI provider,
+    shared by all the threads of the process. It also counts the requests,
+    tokens and waiting time, for the throughput reports
+    """
+    def __init__(self, name, rpm=0, tpm=0):
+        self.name = name
+        self.configure(rpm, tpm)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+        self.waited = 0.0
+
+    def configure(self, rpm=0, tpm=0):
+        """
+        Changes the limits, 0 for no limit
+        :param rpm: requests per minute
+        :param tpm: tokens per minute
+        """
+        self._request_bucket = TokenBucket(rpm) if rpm else None
+        self._token_bucket = TokenBucket(tpm) if tpm else None
+
+    def _reserve(self, tokens):
+        """
+        Reserves a request of about this many tokens
+        :return: seconds to wait before making it
+        """
+        wait = 0.0
+        if self._request_bucket:
+            wait = self._request_bucket.reserve(1)
+        if self._token_bucket and tokens:
+            wait = max(wait, self._token_bucket.reserve(tokens))
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            self.waited += wait
+        return wait
+
+    def acquire(self, tokens=0):
+        """
+        Waits until a request of about this many tokens is allowed
+        :param tokens: the estimated tokens of the request
+        """
+        wait = self._reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        """
+        Like acquire(), without blocking the event loop while waiting
+        :param tokens: the estimated tokens of the request
+        """
+        wait = self._reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated, used):
+        """
+        Corrects the estimate of acquire() once the provider reports how
+        many tokens the request really used
+        :param estimated: the tokens passed to acquire()
+        :param used: the tokens reported by the provider, or None
+        """
+        if used is None:
+            return
+        with self._lock:
+            self.tokens += used - estimated
+        if self._token_bucket:
+            if used > estimated:
+                self._token_bucket.reserve(used - estimated)
+            else:
+                self._token_bucket.refund(estimated - used)
+
+    def stats(self):
+        """
+        :return: Dictionary with the requests, tokens and seconds spent
+        waiting for the limits
+        """
+        with self._lock:
+            return {"requests": self.requests, "tokens": self.tokens,
+                    "waited": round(self.waited, 1)}
+
+
+rate_limits = {provider: RateLimiter(provider, rpm, tpm)
+               for provider, (rpm, tpm) in PROVIDER_LIMITS.items()}
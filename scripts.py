@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import json
+import os
+from dotenv import load_dotenv
+from cache import normalize_topic, SQLiteCache
+from metrics import record_script
+from tavili import tavili_answer, tavili_answer_async
+
+load_dotenv()
+# Written scripts, as (speaker, text) turns, so that a Podcast voiced again
+# with other voices or another AI provider needs no new script nor news.
+# A script is only reused for the same news, so it never goes stale
+SCRIPT_CACHE_TTL = int(os.getenv("SCRIPT_CACHE_TTL", str(30 * 24 * 3600)))
+SCRIPT_CACHE_SIZE = int(os.getenv("SCRIPT_CACHE_SIZE", "1000"))
+script_cache = SQLiteCache("scripts", SCRIPT_CACHE_TTL, SCRIPT_CACHE_SIZE)
+
+
+def news_digest(news):
+    """
+    :param news: the news a script is written with
+    :return: the SHA-256 hex digest of the news
+    """
+    return hashlib.sha256(news.encode("utf-8")).hexdigest()
+
+
+def script_key(topic, digest, options_dic):
+    """
+    The script cache key: everything the script text depends on, but not
+    the voices nor the AI provider that speak it
+    :param topic: Podcast topic
+    :param digest: the digest of the news
+    :param options_dic: Dictionary with the Podcast settings
+    :return: the cache key, a SHA-256 hex digest
+    """
+    material = json.dumps([normalize_topic(topic), digest,
+                           options_dic['host1_name'],
+                           options_dic['host2_name'],
+                           options_dic['host1_mood'],
+                           options_dic['host2_mood']])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def script_source(provider, topic, options_dic):
+    """
+    Looks for the script of a Podcast in the script cache. A re-voice has
+    the digest of the news of its Podcast in the settings, so its news are
+    only searched again when its script is no longer cached
+    :param provider: the AI provider that voices the script
+    :param topic: Podcast topic
+    :param options_dic: Dictionary with the Podcast settings
+    :return: tuple of the cached turns, as (speaker, text) pairs, or None,
+    the news to write the script with, or None, and the script cache key
+    """
+    known_digest = options_dic.get("news_digest")
+    if known_digest:
+        key = script_key(topic, known_digest, options_dic)
+        turns = script_cache.get(key)
+        if turns is not None:
+            record_script(provider, known_digest, cached=True)
+            return turns, None, key
+    news = tavili_answer(topic)
+    digest = news_digest(news)
+    key = script_key(topic, digest, options_dic)
+    turns = script_cache.get(key) if digest != known_digest else None
+    record_script(provider, digest, cached=turns is not None)
+    return turns, news, key
+
+
+async def script_source_async(provider, topic, options_dic):
+    """
+    Like script_source(), for the async generation engine. The script cache
+    is read in a worker thread
+    :param provider: the AI provider that voices the script
+    :param topic: Podcast topic
+    :param options_dic: Dictionary with the Podcast settings
+    :return: tuple of the cached turns, or None, the news, or None, and the
+    script cache key
+    """
+    known_digest = options_dic.get("news_digest")
+    if known_digest:
+        key = script_key(topic, known_digest, options_dic)
+        turns = await asyncio.to_thread(script_cache.get, key)
+        if turns is not None:
+            record_script(provider, known_digest, cached=True)
+            return turns, None, key
+    news = await tavili_answer_async(topic)
+    digest = news_digest(news)
+    key = script_key(topic, digest, options_dic)
+    turns = await asyncio.to_thread(script_cache.get, key) \
+        if digest != known_digest else None
+    record_script(provider, digest, cached=turns is not None)
+    return turns, news, key
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import re
+import time
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
+# Podcast audio files, served by the audio route
+AUDIO_FOLDER = os.path.join(os.getcwd(), "static", "audio")
+# Audio files being generated, moved to the store when complete
+STAGING_FOLDER = os.path.join(AUDIO_FOLDER, "staging")
+# Disk space of the Podcast audio files, 0 for no limit. Beyond it, the
+# least recently played Podcasts are deleted, to be generated again
+AUDIO_QUOTA_BYTES = int(os.getenv("AUDIO_QUOTA_BYTES", "0"))
+# Seconds between two runs of the sweeper of orphaned audio files, 0 for
+# no sweeper
+AUDIO_SWEEP_SECONDS = int(os.getenv("AUDIO_SWEEP_SECONDS", "3600"))
+# Files changed more recently than this are never swept: they may belong
+# to a generation that is not in the database yet
+ORPHAN_GRACE_SECONDS = 3600
+# Stored files are named <2 hex>/<2 hex>/<sha256>.<extension>
+_STORED_NAME = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$")
+
+
+def staging_path(extension):
+    """
+    A new, unique, path for an audio file being generated
+    :param extension: the file extension, e.g. mp3
+    :return: the absolute path in the staging folder
+    """
+    os.makedirs(STAGING_FOLDER, exist_ok=True)
+    return os.path.join(STAGING_FOLDER, f"{uuid.uuid4().hex}.{extension}")
+
+
+def file_digest(path):
+    """
+    Hashes a file in chunks, without reading it into memory
+    :param path: the file path
+    :return: the SHA-256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stored_name(digest, extension):
+    """
+    :return: the name, relative to AUDIO_FOLDER, of the stored file with
+    this content. Two levels of subfolders keep the folders small
+    """
+    return f"{digest[:2]}/{digest[2:4]}/{digest}.{extension}"
+
+
+def is_stored_name(name):
+    """
+    :return: True if the name is the one of a content addressed file
+    """
+    return bool(_STORED_NAME.match(name))
+
+
+def store_file(path, digest=None):
+    """
+    Moves a complete audio file to the store, named by its content. When
+    the store already has the same content, the new file is deleted
+    :param path: the file, e.g. in the staging folder
+    :param digest: the SHA-256 of the content, when already known
+    :return: the stored name, relative to AUDIO_FOLDER, and the SHA-256 of
+    the content
+    """
+    digest = digest or file_digest(path)
+    extension = os.path.splitext(path)[1].lstrip(".")
+    name = stored_name(digest, extension)
+    target = os.path.join(AUDIO_FOLDER, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):   # identical output, keep one copy
+        os.remove(path)
+        os.utime(target)   # not an orphan, see ORPHAN_GRACE_SECONDS
+    else:
+        os.replace(path, target)
+    return name, digest
+
+
+def remove_file(name):
+    """
+    Deletes a stored file, if it exists
+    :param name: the name relative to AUDIO_FOLDER
+    :return: True if it was deleted
+    """
+    try:
+        os.remove(os.path.join(AUDIO_FOLDER, name))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def stored_files():
+    """
+    Lists the files of the store
+    :return: generator of (name relative to AUDIO_FOLDER, size, seconds
+    since the last change)
+    """
+    now = time.time()
+    for folder, _, files in os.walk(AUDIO_FOLDER):
+        for file_name in files:
+            path = os.path.join(folder, file_name)
+            name = os.path.relpath(path, AUDIO_FOLDER).replace(os.sep, "/")
+            if is_stored_name(name):
+                stat = os.stat(path)
+                yield name, stat.st_size, now - stat.st_mtime
+
+
+def stale_staging_files():
+    """
+    :return: the paths of the staging files left by generations that
+    stopped long ago, e.g. when their worker process was killed
+    """
+    if not os.path.isdir(STAGING_FOLDER):
+        return []
+    now = time.time()
+    paths = (os.path.join(STAGING_FOLDER, file_name)
+             for file_name in os.listdir(STAGING_FOLDER))
+    return [path for path in paths if os.path.isfile(path)
+            and now - os.path.getmtime(path) > ORPHAN_GRACE_SECONDS]
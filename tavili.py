@@ -1,25 +1,96 @@
+import asyncio
 import os
 from dotenv import load_dotenv
-from tavily import TavilyClient
+from cache import normalize_topic, SQLiteCache
+from gateway import (call, call_async, SEARCH_DEADLINE, tavily_async_client,
+                     tavily_client)
+from metrics import span
 
 load_dotenv()
-# Set up your OpenAI API key
-TAVILI_KEY = os.getenv("TAVILI_KEY")
-client = TavilyClient(TAVILI_KEY)
+# News go stale, so they are cached for a few hours only
+TAVILY_CACHE_TTL = int(os.getenv("TAVILY_CACHE_TTL", str(6 * 3600)))
+TAVILY_CACHE_SIZE = int(os.getenv("TAVILY_CACHE_SIZE", "1000"))
+news_cache = SQLiteCache("tavily", TAVILY_CACHE_TTL, TAVILY_CACHE_SIZE)
+# Used instead of the news when Tavily cannot be reached
+NO_NEWS = "No recent news could be found about this topic."
 
-def tavili_answer(topic):
+
+def search_news(topic):
     """
-    Gets the latest news about the topic using the Tavili API
+    Searches the latest news about the topic using the Tavili API
     the time frame for the news is the last month
     :param topic: the Podcast topic
+    :return: text with the latest news about the topic, or NO_NEWS
+    """
+    with span("search", "Tavily"):
+        response = call("Tavily", lambda timeout: tavily_client().search(
+            query=topic,
+            topic="news",
+            time_range="month",
+            include_answer="basic",
+            timeout=timeout
+        ), SEARCH_DEADLINE)
+    # Tavily answers None when it found no news to summarize
+    answer = response.get('answer') or NO_NEWS
+    print(answer)
+    return answer
+
+
+def tavili_answer(topic):
+    """
+    Gets the latest news about the topic, from the news cache if the same
+    topic was searched recently, otherwise using the Tavili API. If Tavily
+    fails, the Podcast is written without the latest news
+    :param topic: the Podcast topic
     :return: text with the latest news about the topic
     """
-    response = client.search(
-        query=topic,
-        topic="news",
-        time_range="month",
-        include_answer="basic"
-    )
-    print(response['answer'])
-    return response['answer']
+    key = normalize_topic(topic)
+    answer = news_cache.get(key)
+    if answer is None:
+        try:
+            answer = search_news(topic)
+        except Exception as e:
+            print(f"News search failed: {e}")
+            return NO_NEWS
+        news_cache.set(key, answer)
+    return answer
+
+
+async def search_news_async(topic):
+    """
+    Like search_news(), with the async Tavily client
+    :param topic: the Podcast topic
+    :return: text with the latest news about the topic, or NO_NEWS
+    """
+    with span("search", "Tavily"):
+        response = await call_async(
+            "Tavily", lambda timeout: tavily_async_client().search(
+                query=topic,
+                topic="news",
+                time_range="month",
+                include_answer="basic",
+                timeout=timeout
+            ), SEARCH_DEADLINE)
+    # Tavily answers None when it found no news to summarize
+    answer = response.get('answer') or NO_NEWS
+    print(answer)
+    return answer
+
 
+async def tavili_answer_async(topic):
+    """
+    Like tavili_answer(), for the async generation engine. The news cache
+    is read and written in a worker thread
+    :param topic: the Podcast topic
+    :return: text with the latest news about the topic
+    """
+    key = normalize_topic(topic)
+    answer = await asyncio.to_thread(news_cache.get, key)
+    if answer is None:
+        try:
+            answer = await search_news_async(topic)
+        except Exception as e:
+            print(f"News search failed: {e}")
+            return NO_NEWS
+        await asyncio.to_thread(news_cache.set, key, answer)
+    return answer
@@ -0,0 +1,116 @@
+"""
+The transcript of a Podcast that falls back to the other provider: the
+turns of the failed provider must not be saved with the fallback audio.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+app = None
+
+
+def setUpModule():
+    # the app keeps its database and audio files in the working directory
+    global app, previous_cwd, workdir
+    previous_cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="mypodcast-test-")
+    os.makedirs(os.path.join(workdir, "data"))
+    os.chdir(workdir)
+    for key in ("SECRET_KEY", "OPENAI_API_KEY", "GEMINI_API_KEY",
+                "TAVILI_KEY"):
+        os.environ.setdefault(key, "test")
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    app = app_module
+    with app.app.app_context():
+        app.init_db()
+
+
+def tearDownModule():
+    os.chdir(previous_cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def failing_provider(topic, options, progress=None):
+    """
+    A provider that voices two turns, then goes down
+    """
+    from gateway import ProviderUnavailable
+    from metrics import record_script, record_turn
+    record_script(options["ai_model"], "failed news", cached=False)
+    record_turn(options["host1_name"], "The failed first turn", 0)
+    record_turn(options["host2_name"], "The failed second turn", 1500)
+    raise ProviderUnavailable(f"{options['ai_model']} is down")
+
+
+def working_provider(topic, options, progress=None):
+    """
+    A provider that voices one turn into a staged audio file
+    """
+    from metrics import record_script, record_turn
+    from storage import AUDIO_FOLDER, staging_path
+    record_script(options["ai_model"], "fallback news", cached=False)
+    record_turn(options["host1_name"], f"All about {topic}", 0)
+    path = staging_path("mp3")
+    with open(path, "wb") as f:
+        f.write(topic.encode("utf-8"))
+    return os.path.relpath(path, AUDIO_FOLDER)
+
+
+async def failing_provider_async(topic, options, progress=None):
+    return failing_provider(topic, options, progress)
+
+
+async def working_provider_async(topic, options, progress=None):
+    return working_provider(topic, options, progress)
+
+
+class TranscriptFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        import providers
+        self.saved = (dict(providers._creators),
+                      dict(providers._async_creators))
+        providers._creators.update(OpenAI=failing_provider,
+                                   Gemini=working_provider)
+        providers._async_creators.update(OpenAI=failing_provider_async,
+                                         Gemini=working_provider_async)
+        self.context = app.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        import providers
+        self.context.pop()
+        for creators, saved in zip((providers._creators,
+                                    providers._async_creators), self.saved):
+            creators.clear()
+            creators.update(saved)
+
+    def assert_fallback_transcript(self, podcast, topic):
+        turns = app.TranscriptTurn.query.filter_by(
+            podcast_id=podcast.id).order_by(app.TranscriptTurn.position).all()
+        self.assertEqual([(turn.text, turn.start_ms) for turn in turns],
+                         [(f"All about {topic}", 0)])
+        self.assertEqual(podcast.news_digest, "fallback news")
+
+    def test_fallback_drops_the_failed_turns(self):
+        options = dict(app.default_options, ai_model="OpenAI")
+        podcast = app.create_podcast("Threads fallback", options)
+        self.assert_fallback_transcript(podcast, "Threads fallback")
+
+    def test_async_fallback_drops_the_failed_turns(self):
+        options = dict(app.default_options, ai_model="OpenAI")
+        podcast = asyncio.run(app.create_podcast_async("Asyncio fallback",
+                                                       options))
+        self.assert_fallback_transcript(podcast, "Asyncio fallback")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+# Maximum TTS calls in flight per AI provider, shared by all the Podcasts
+# that this process creates at the same time
+TTS_CONCURRENCY = {
+    "OpenAI": int(os.getenv("OPENAI_TTS_CONCURRENCY", "4")),
+    "Gemini": int(os.getenv("GEMINI_TTS_CONCURRENCY", "2")),
+}
+
+_provider_slots = {provider: threading.BoundedSemaphore(limit)
+                   for provider, limit in TTS_CONCURRENCY.items()}
+# The same limits for the async generation engine, per event loop
+_loop_slots = weakref.WeakKeyDictionary()
+
+
+def synthesize_in_order(provider, task, items):
+    """
+    Runs task(item) for all items concurrently, never exceeding the TTS
+    concurrency limit of the provider. Results are yielded in the order of
+    the items, as soon as each one and all the ones before it are ready.
+    items may be a stream, e.g. dialogue turns parsed while the script is
+    still being written: each item is submitted as soon as it arrives
+    :param provider: the AI provider, a key of TTS_CONCURRENCY
+    :param task: function that synthesizes one item
+    :param items: iterable of the items to synthesize, in order
+    :return: generator of the task results, in order
+    """
+    slots = _provider_slots[provider]
+    pool = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY[provider],
+                              thread_name_prefix=f"{provider}-tts")
+    submitted = queue.Queue()   # futures in item order, then None
+    stop = threading.Event()
+
+    def run(item):
+        with slots:
+            return task(item)
+
+    def feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                # each task sees the context of the caller, e.g. the
+                # metrics of its Podcast
+                submitted.put(pool.submit(contextvars.copy_context().run,
+                                          run, item))
+        except Exception as e:   # the items stream failed
+            submitted.put(e)
+        submitted.put(None)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(feed,),
+                     name=f"{provider}-tts-feed", daemon=True).start()
+    try:
+        while (future := submitted.get()) is not None:
+            if isinstance(future, Exception):
+                raise future
+            yield future.result()
+    finally:   # stop the remaining work if a turn failed for good
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def synthesize_in_order_async(provider, task, items):
+    """
+    Like synthesize_in_order(), for the async generation engine: the items
+    are synthesized by tasks of the running event loop instead of threads,
+    never more than the TTS concurrency limit of the provider at a time
+    :param provider: the AI provider, a key of TTS_CONCURRENCY
+    :param task: async function that synthesizes one item
+    :param items: async iterable of the items to synthesize, in order
+    :return: async generator of the task results, in order
+    """
+    loop_slots = _loop_slots.setdefault(asyncio.get_running_loop(), {})
+    if provider not in loop_slots:
+        loop_slots[provider] = asyncio.Semaphore(TTS_CONCURRENCY[provider])
+    slots = loop_slots[provider]
+    submitted = asyncio.Queue()   # tasks in item order, then None
+
+    async def run(item):
+        async with slots:
+            return await task(item)
+
+    async def feed():
+        try:
+            async for item in items:
+                submitted.put_nowait(asyncio.ensure_future(run(item)))
+        except Exception as e:   # the items stream failed
+            submitted.put_nowait(e)
+        submitted.put_nowait(None)
+
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while (future := await submitted.get()) is not None:
+            if isinstance(future, Exception):
+                raise future
+            yield await future
+    finally:   # stop the remaining work if a turn failed for good
+        feeder.cancel()
+        while not submitted.empty():
+            future = submitted.get_nowait()
+            if isinstance(future, asyncio.Future):
+                future.cancel()